@@ -0,0 +1,131 @@
+"""
+Apply operations to overlapping bands of rows or columns in parallel. The
+bands include the halo that the footprint of the operation requires, and
+the results are written directly into the output matrices.
+"""
+import copy
+import threading
+
+import numpy as np
+
+from . import parallel
+from .parallel import chunks, thread_map
+
+# Smaller matrices are not worth dividing over the threads
+min_size = 2**18
+
+
+def get_band(data, footprint, start, stop, copy_arrays=True):
+    """
+    Return a Data2D with a band of lines, copied into memory or as views
+    of the matrices of the data.
+    """
+    if footprint.axis == 0:
+        index = (slice(start, stop), slice(None))
+    else:
+        index = (slice(None), slice(start, stop))
+
+    convert = np.array if copy_arrays else lambda a: a
+
+    band = copy.copy(data)
+    band.stats = {}
+    band.x = convert(data.x[index])
+    band.y = convert(data.y[index])
+    band.z = convert(data.z[index])
+    band.key = None
+    band.tri = None
+    band.interpolator = None
+
+    return band
+
+
+def get_bands(length, footprint, threads):
+    """
+    Divide the output lines into a few bands per thread, which are large
+    compared to the halo so that little is calculated twice.
+    """
+    size = max(-(-length // (4 * threads)),
+               4 * (sum(footprint.halo) + sum(footprint.loss)), 16)
+
+    return chunks(length, size)
+
+
+def can_apply_threaded(data, info, params):
+    """Whether the operation would be applied in parallel bands."""
+    if not info.thread_safe or parallel.threads == 1:
+        return False
+
+    footprint = info.get_footprint(params)
+
+    if footprint is None or data.z.size < min_size:
+        return False
+
+    length = data.z.shape[footprint.axis] - sum(footprint.loss)
+
+    return len(get_bands(length, footprint, parallel.threads)) > 1
+
+
+def apply_threaded(data, info, params):
+    """
+    Apply an operation with a footprint to bands of the data on the
+    threads of the shared pool. The bands are views of the matrices, so
+    operations with a halo should not modify their input in place.
+
+    Matrices that the operation modifies in place or leaves alone are
+    already complete when all bands are done, only the ones that it
+    replaces are written into new output matrices.
+    """
+    footprint = info.get_footprint(params)
+    axis = footprint.axis
+    length = data.z.shape[axis] - sum(footprint.loss)
+
+    outputs = {}
+    masked = []
+    lock = threading.Lock()
+
+    def apply_band(bounds):
+        start, stop = bounds
+        first, last = footprint.get_input(start, stop, data.z.shape[axis])
+        band = get_band(data, footprint, first, last, copy_arrays=False)
+        views = dict((name, getattr(band, name)) for name in ['x', 'y', 'z'])
+
+        info.func(band, **params)
+
+        # Remove the halo, the lines that were lost are not in the band
+        lines = slice(start - first, stop - first)
+        index = (lines, slice(None)) if axis == 0 else (slice(None), lines)
+
+        for name in ['x', 'y', 'z']:
+            a = getattr(band, name)
+
+            if a is views[name]:
+                continue
+
+            if isinstance(a, np.ma.MaskedArray):
+                masked.append(name)
+                a = a.filled(np.nan)
+
+            # The first band to finish creates the output matrices
+            with lock:
+                if name not in outputs:
+                    shape = list(a.shape)
+                    shape[axis] = length
+                    outputs[name] = np.empty(shape, dtype=a.dtype)
+
+            if axis == 0:
+                outputs[name][start:stop] = a[index]
+            else:
+                outputs[name][:, start:stop] = a[index]
+
+    thread_map(apply_band, get_bands(length, footprint, parallel.threads))
+
+    for name in set(masked):
+        outputs[name] = np.ma.masked_invalid(outputs[name], copy=False)
+
+    # Coordinates that did not change are not assigned again, which would
+    # discard the peaks found before
+    for name in outputs:
+        setattr(data, name, outputs[name])
+
+    data.tri = None
+    data.interpolator = None
@@ -0,0 +1,313 @@
+"""
+Apply the operations of a profile to many .dat files without the GUI and
+save the resulting matrices and/or figures, for example:
+
+    qtplot-batch default.ini data/*.dat --matrix .npy --figure .png
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import traceback
+
+import numpy as np
+
+from . import parallel
+from .colormap import Colormap
+from .data import Data2D, DatFile
+from .pipeline import Pipeline
+from .registry import load_plugins
+from .tiling import apply_tiled, load_npy, to_memmap
+from .util import read_profile
+
+logger = logging.getLogger(__name__)
+
+settings_dir = os.path.join(os.path.expanduser('~'), '.qtplot')
+
+
+def find_operations_file(profile_file, profile):
+    """Return the operations file that belongs to a profile, if there is one."""
+    if profile['operations'] != '':
+        return profile['operations']
+
+    name = os.path.splitext(os.path.basename(profile_file))[0]
+    path = os.path.join(settings_dir, 'operations', name + '.json')
+
+    if os.path.exists(path):
+        return path
+
+
+def load_matrix(filename, names, memory_map=False):
+    """
+    Load a matrix saved as .npy, memory-mapped or in memory. The names of
+    the parameters are not stored in the matrix.
+    """
+    if memory_map:
+        data = load_npy(filename)
+    else:
+        mat = np.load(filename)
+        data = Data2D(mat[:,:,0], mat[:,:,1], mat[:,:,2], filename=filename)
+
+    data.x_name, data.y_name, data.z_name = names
+
+    return data
+
+
+def load_data(filename, profile, x_name=None, y_name=None, z_name=None,
+              memory_map=False):
+    """
+    Load a .dat file with the parameters selected in the profile, or a
+    matrix saved as .npy.
+    """
+    names = [x_name or profile['x'], y_name or profile['y'],
+             z_name or profile['z']]
+
+    if os.path.splitext(filename)[1] == '.npy':
+        return load_matrix(filename, names, memory_map)
+
+    dat_file = DatFile(filename)
+
+    # Create the column with the series resistance subtracted
+    V, I = profile['sub_series_V'], profile['sub_series_I']
+
+    if V in dat_file.ids and I in dat_file.ids:
+        try:
+            R = float(profile['sub_series_R'])
+            adjusted = dat_file.get_column(V) - dat_file.get_column(I) * R
+
+            dat_file.set_column(V + ' - Sub series R', adjusted)
+        except ValueError:
+            logger.warning('Could not parse resistance value in the profile')
+
+    # A 1D dataset has no y parameter
+    if names[1] not in dat_file.ids:
+        names[1] = ''
+
+    for axis, name in zip(['x', 'z'], [names[0], names[2]]):
+        if name not in dat_file.ids:
+            raise ValueError('The %s parameter %s is not in the file' %
+                             (axis, name))
+
+    return dat_file.get_data(*names)
+
+
+def format_label(s, filename, data):
+    conversions = {
+        '<filename>': os.path.basename(filename),
+        '<x>': data.x_name,
+        '<y>': data.y_name,
+        '<z>': data.z_name
+    }
+
+    for old, new in conversions.items():
+        s = s.replace(old, new)
+
+    return s
+
+
+def save_figure(data, profile, filename, output):
+    """Render the data like the export window does and save it."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    cmap = profile['colormap'].replace('\\', '/').replace('/', os.path.sep)
+    colormap = Colormap(os.path.join('colormaps', cmap))
+
+    fig = Figure(figsize=(float(profile['width']), float(profile['height'])))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    cb = data.plot(fig, ax, cmap=colormap)
+
+    ax.set_title(format_label(profile['title'], filename, data))
+    ax.set_xlabel(format_label(profile['x_label'], filename, data))
+    ax.set_ylabel(format_label(profile['y_label'], filename, data))
+    cb.set_label(format_label(profile['z_label'], filename, data))
+
+    fig.savefig(output, dpi=float(profile['DPI']), bbox_inches='tight')
+
+
+def init_process():
+    # The files are already processed in parallel, so the operations
+    # themselves should not start more threads or processes
+    parallel.set_threads(1)
+
+    # Processes that are not forked start without the plugins
+    load_plugins()
+
+
+def process_file(args):
+    """
+    Load, process and save a single file. Errors are caught and returned
+    so that one bad file does not stop the others.
+    """
+    filename, options = args
+    tiles = None
+
+    try:
+        profile = read_profile(options['profile'])
+
+        data = load_data(filename, profile, options['x'], options['y'],
+                         options['z'], options['tiled'] is not None)
+
+        if data is None:
+            raise ValueError('The data could not be loaded')
+
+        name = os.path.splitext(os.path.basename(filename))[0]
+
+        if options['operations'] is not None:
+            pipeline = Pipeline.load(options['operations'])
+
+            if options['tiled'] is not None:
+                tiles = os.path.join(options['tiled'], name)
+
+                if not os.path.exists(tiles):
+                    os.makedirs(tiles)
+
+                # Matrices loaded from .npy files are already memory-mapped
+                if not isinstance(data.z, np.memmap):
+                    data = to_memmap(data, tiles)
+
+                data, results = apply_tiled(pipeline, data, tiles)
+            else:
+                data, results = pipeline.apply(data)
+
+        directory = options['output'] or os.path.dirname(filename)
+
+        outputs = []
+
+        for ext in options['matrix']:
+            outputs.append(os.path.join(directory, name + '_matrix' + ext))
+            data.save(outputs[-1])
+
+        for ext in options['figure']:
+            outputs.append(os.path.join(directory, name + ext))
+            save_figure(data, profile, filename, outputs[-1])
+
+        return filename, outputs, None
+    except Exception:
+        return filename, [], traceback.format_exc()
+    finally:
+        # Also remove the memory-mapped files of a file that failed
+        if tiles is not None:
+            shutil.rmtree(tiles, ignore_errors=True)
+
+
+def expand_files(patterns):
+    """Return the files that match a list of filenames or glob patterns."""
+    files = []
+
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+
+        if len(matches) == 0:
+            logger.warning('No files match %s' % pattern)
+
+        files.extend(match for match in matches if match not in files)
+
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Apply the operations of a qtplot profile to .dat files')
+    parser.add_argument('profile', help='profile .ini file')
+    parser.add_argument('files', nargs='+',
+                        help='.dat files, matrices saved as .npy or glob '
+                             'patterns')
+    parser.add_argument('-o', '--operations',
+                        help='operations .json file, by default the one '
+                             'saved with the profile')
+    parser.add_argument('-m', '--matrix', action='append', default=[],
+                        choices=['.dat', '.npy', '.mat'],
+                        help='save the matrix in this format')
+    parser.add_argument('-f', '--figure', action='append', default=[],
+                        help='save a figure with this extension, e.g. .png')
+    parser.add_argument('-d', '--output',
+                        help='output directory, by default next to the input')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='amount of files processed in parallel')
+    parser.add_argument('-t', '--tiled', metavar='DIRECTORY',
+                        help='apply the operations in bands and keep the '
+                             'data in memory-mapped files in this directory, '
+                             'for data that does not fit in memory. Only '
+                             '.npy matrices are not loaded into memory first')
+    parser.add_argument('-x', help='x parameter instead of the profile one')
+    parser.add_argument('-y', help='y parameter instead of the profile one')
+    parser.add_argument('-z', help='z parameter instead of the profile one')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(levelname)s:%(name)s:%(message)s')
+
+    load_plugins()
+
+    if len(args.matrix) == 0 and len(args.figure) == 0:
+        args.matrix = ['.dat']
+
+    if args.output is not None and not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    profile = read_profile(args.profile)
+    operations = args.operations
+
+    if operations is None:
+        operations = find_operations_file(args.profile, profile)
+
+    options = {
+        'profile': args.profile,
+        'operations': operations,
+        'matrix': args.matrix,
+        'figure': args.figure,
+        'output': args.output,
+        'tiled': args.tiled,
+        'x': args.x, 'y': args.y, 'z': args.z,
+    }
+
+    files = expand_files(args.files)
+    tasks = [(filename, options) for filename in files]
+
+    if args.processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.processes, len(tasks)),
+                                    initializer=init_process)
+        results = pool.imap_unordered(process_file, tasks)
+    else:
+        try:
+            # The threads used by operations, 0 to use all processors
+            parallel.set_threads(int(profile['threads']) or
+                                 multiprocessing.cpu_count())
+        except ValueError:
+            logger.warning('Could not parse threads value in the profile')
+
+        pool = None
+        results = map(process_file, tasks)
+
+    failed = []
+
+    for filename, outputs, error in results:
+        if error is None:
+            print('%s -> %s' % (filename, ', '.join(outputs)))
+        else:
+            print('%s failed:\n%s' % (filename, error), file=sys.stderr)
+            failed.append(filename)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('Processed %d files, %d failed' % (len(files), len(failed)))
+
+    for filename in failed:
+        print('    %s' % filename)
+
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def array_key(*arrays):
+    """
+    Return a hash of the shapes, types and contents of numpy arrays
+    which can be used as a cache key.
+    """
+    h = hashlib.sha1()
+
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+
+        h.update(str((a.shape, a.dtype.str)).encode('utf-8'))
+        h.update(a.view(np.uint8))
+
+    return h.hexdigest()
+
+
+class LRUCache:
+    """
+    A thread-safe cache which discards the least recently used
+    items once it contains more than max_items items.
+
+    When max_bytes is given, items are also discarded once their total
+    size exceeds it. The size of an item is returned by get_size.
+    """
+
+    def __init__(self, max_items=8, max_bytes=None, get_size=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+
+            # Move the item to the end to mark it as the most recently used
+            value = self.items.pop(key)
+            self.items[key] = value
+
+            return value
+
+    def put(self, key, value):
+        size = self.get_size(value) if self.get_size is not None else 0
+
+        with self.lock:
+            self.remove(key)
+
+            # Items that do not fit at all are not stored
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self.items[key] = value
+            self.sizes[key] = size
+            self.nbytes += size
+
+            while (len(self.items) > self.max_items or
+                   (self.max_bytes is not None and
+                    self.nbytes > self.max_bytes)):
+                self.remove(next(iter(self.items)))
+
+    def remove(self, key):
+        """Remove an item, the lock should be held by the caller."""
+        if key in self.items:
+            del self.items[key]
+            self.nbytes -= self.sizes.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.nbytes = 0
@@ -31,6 +31,29 @@ void main()
 }
 """
 
+# Vertex and fragment shader used to draw found peaks and their tracks
+peaks_vert = """
+attribute vec2 a_position;
+
+uniform mat4 u_view;
+uniform mat4 u_projection;
+
+void main()
+{
+    gl_Position = u_projection * u_view * vec4(a_position, 0.0, 1.0);
+    gl_PointSize = 4.0;
+}
+"""
+
+peaks_frag = """
+uniform vec4 u_color;
+
+void main()
+{
+    gl_FragColor = u_color;
+}
+"""
+
 # Vertex and fragment shader to draw the colorbar next to the plot
 colormap_vert = """
 attribute vec2 a_position;
@@ -127,13 +150,20 @@ class Canvas(scene.SceneCanvas):
         self.linecut_program = gloo.Program(linecut_vert, linecut_frag)
         self.linecut_program['a_position'] = [self.mouse_start, self.mouse_end]
 
+        self.peaks_program = gloo.Program(peaks_vert, peaks_frag)
+        self.tracks_program = gloo.Program(peaks_vert, peaks_frag)
+        self.has_peaks = False
+        self.has_tracks = False
+
         gloo.set_clear_color((1, 1, 1, 1))
 
-    def set_data(self, data):
+    def set_data(self, data, vertices=None):
         self.data = data
         self.data_changed = True
 
-        vertices = self.generate_vertices(data)
+        # The vertices can be generated beforehand on another thread
+        if vertices is None:
+            vertices = self.generate_vertices(data)
 
         self.xmin = np.nanmin(vertices['a_position'][:, 0])
         self.xmax = np.nanmax(vertices['a_position'][:, 0])
@@ -171,8 +201,37 @@ class Canvas(scene.SceneCanvas):
         self.vbo = gloo.VertexBuffer(vertices)
         self.data_program.bind(self.vbo)
 
+        self.set_peaks(data.peaks)
+
         self.update()
 
+    def set_peaks(self, peaks):
+        """ Upload the positions of found peaks and their tracks """
+        self.has_peaks = peaks is not None and len(peaks) > 0
+
+        if not self.has_peaks:
+            return
+
+        points = peaks[['x', 'y']].values.astype(np.float32)
+
+        # Connect consecutive peaks of the same track with line segments
+        order = np.lexsort((peaks['line'].values, peaks['track'].values))
+        tracks = peaks['track'].values[order]
+        same = tracks[1:] == tracks[:-1]
+
+        segments = np.empty((same.sum() * 2, 2), dtype=np.float32)
+        segments[0::2] = points[order][:-1][same]
+        segments[1::2] = points[order][1:][same]
+
+        for program, positions in [(self.peaks_program, points),
+                                   (self.tracks_program, segments)]:
+            program['u_view'] = self.view
+            program['u_projection'] = self.projection
+            program['u_color'] = (0.0, 0.0, 0.0, 1.0)
+            program['a_position'] = positions
+
+        self.has_tracks = len(segments) > 0
+
     def generate_vertices(self, data):
         """ Generate vertices for the dataset quadrilaterals """
         xq, yq = data.get_quadrilaterals(data.x, data.y)
@@ -318,7 +377,7 @@ class Canvas(scene.SceneCanvas):
             y_points = np.linspace(y_start, y, 500)
 
             if self.data_changed:
-                self.data.generate_triangulation()
+                self.data.generate_interpolator()
                 self.data_changed = False
 
             vals = self.data.interpolate(np.column_stack((x_points, y_points)))
@@ -392,6 +451,13 @@ class Canvas(scene.SceneCanvas):
             self.colorbar_program['a_texcoord'] = [[1], [0], [1], [0]]
             self.colorbar_program.draw('triangle_strip')
 
+            # Drawing of found peaks and the lines connecting their tracks
+            if self.has_peaks:
+                if self.has_tracks:
+                    self.tracks_program.draw('lines')
+
+                self.peaks_program.draw('points')
+
             # Drawing of the linecut
             self.linecut_program.draw('lines')
 
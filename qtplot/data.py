@@ -1,24 +1,35 @@
 import os
+import itertools
 import logging
+import threading
+import warnings
 from collections import OrderedDict
 
 import numpy as np
 from scipy import ndimage, interpolate, io
-from scipy.spatial import qhull
+from scipy.spatial import qhull, cKDTree
 from pandas.io.api import read_table
 import pandas as pd
 
+from .cache import LRUCache, array_key
+from . import fitting
+from .parallel import chunks, thread_map
 from .util import FixedOrderFormatter, eng_format
 
 logger = logging.getLogger(__name__)
 
 
+# Versions of loaded data, a new one is used whenever the data changes
+_versions = itertools.count()
+
+
 class DatFile:
     """ Class which contains the column based DataFrame of the data. """
 
     def __init__(self, filename):
         self.filename = filename
         self.timestamp = ''
+        self.version = next(_versions)
 
         self.ids = []
         self.labels = []
@@ -126,6 +137,10 @@ class DatFile:
 
             self.data = np.hstack((self.data, values[:, np.newaxis]))
 
+        # Only changed after the column, so that data retrieved with the new
+        # version always contains it
+        self.version = next(_versions)
+
     def get_row_info(self, row):
         # Return a dict of all parameter-value pairs in the row
         return OrderedDict(zip(self.ids, self.data[row]))
@@ -159,6 +174,11 @@ class DatFile:
         elif len(setpoint_columns) > 2:
             logger.warning('Multiple setpoint columns with a size property were found, using the first two')
 
+        # A column can be replaced on another thread while the data is
+        # retrieved, the version from before makes sure that it is not
+        # cached as the new data
+        version = self.version
+
         # Retrieve the setpoint data, start with 0 for y
         x_setpoints = self.get_column(setpoint_columns[0])
         y_setpoints = np.zeros(self.data.shape[0])
@@ -195,9 +215,12 @@ class DatFile:
 
         row_numbers = pivot[:,:,5]
 
-        return Data2D(x, y, z, x_setpoints, y_setpoints, row_numbers,
+        data = Data2D(x, y, z, x_setpoints, y_setpoints, row_numbers,
                       x_name, y_name, z_name, setpoint_columns[0],
                       setpoint_columns[1], self.filename, self.timestamp, self)
+        data.key = (version, x_name, y_name, z_name)
+
+        return data
 
 
 def create_kernel(x_dev, y_dev, cutoff, distr):
@@ -212,8 +235,8 @@ def create_kernel(x_dev, y_dev, cutoff, distr):
     hx = np.floor((x_dev * cutoff) / 2.0)
     hy = np.floor((y_dev * cutoff) / 2.0)
 
-    x = np.linspace(-hx, hx, hx * 2 + 1) / x_dev
-    y = np.linspace(-hy, hy, hy * 2 + 1) / y_dev
+    x = np.linspace(-hx, hx, int(hx * 2 + 1)) / x_dev
+    y = np.linspace(-hy, hy, int(hy * 2 + 1)) / y_dev
 
     if x.size == 1: x = np.zeros(1)
     if y.size == 1: y = np.zeros(1)
@@ -226,7 +249,761 @@ def create_kernel(x_dev, y_dev, cutoff, distr):
     return kernel
 
 
-class Data2D:
+normalization_methods = ['min-max', 'z-score', 'percentile clip',
+                         'divide median', 'subtract mean']
+
+
+def normalize_lines(z, axis, method='min-max', lower=1.0, upper=99.0):
+    """
+    Normalize every line of a matrix along an axis (0 for columns, 1 for rows)
+    at once, ignoring NaN values. The matrix is modified in place if it
+    contains floating point values.
+
+    min-max:            Scale the values to the range 0 to 1
+    z-score:            Subtract the mean and divide by the standard deviation
+    percentile clip:    Clip the values to the lower and upper percentiles,
+                        and scale them to the range 0 to 1
+    divide median:      Divide the values by the median
+    subtract mean:      Subtract the mean
+    """
+    if not np.issubdtype(z.dtype, np.floating):
+        z = z.astype(float)
+
+    # Lines that only contain NaN values stay NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if method == 'min-max':
+                low = np.nanmin(z, axis=axis, keepdims=True)
+                high = np.nanmax(z, axis=axis, keepdims=True)
+
+                z -= low
+                z /= high - low
+            elif method == 'z-score':
+                mean = np.nanmean(z, axis=axis, keepdims=True)
+
+                z -= mean
+                z /= np.sqrt(np.nanmean(z * z, axis=axis, keepdims=True))
+            elif method == 'percentile clip':
+                low, high = np.nanpercentile(z, [lower, upper], axis=axis,
+                                             keepdims=True)
+
+                np.clip(z, low, high, out=z)
+                z -= low
+                z /= high - low
+            elif method == 'divide median':
+                z /= np.nanmedian(z, axis=axis, keepdims=True)
+            elif method == 'subtract mean':
+                z -= np.nanmean(z, axis=axis, keepdims=True)
+            else:
+                raise ValueError('Unknown normalization method %s' % method)
+
+    return z
+
+
+def apply_mapping(z, xp, fp, chunk_size=2**20):
+    """
+    Map the values of a float matrix through the piecewise linear function
+    defined by xp and fp, in place and in chunks to limit the temporaries.
+    """
+    flat = z.reshape(-1)
+
+    for start, stop in chunks(len(flat), chunk_size):
+        flat[start:stop] = np.interp(flat[start:stop], xp, fp)
+
+
+def equalize_adaptive(z, tiles=8, clip=0.0, bins=256):
+    """
+    Equalize the histogram within tiles of a matrix, interpolating the
+    mappings of neighbouring tiles to prevent edges between them (CLAHE).
+
+    tiles:  The amount of tiles along each axis
+    clip:   Limit on the histogram counts as a multiple of the average count,
+            the excess is spread evenly over all bins. 0 disables clipping.
+    """
+    rows, cols = z.shape
+    tiles = max(1, min(int(tiles), rows, cols))
+
+    valid = ~np.isnan(z)
+    zmin, zmax = np.nanmin(z), np.nanmax(z)
+
+    # Bin index of every datapoint and the tile it belongs to
+    b = np.zeros(z.shape, dtype=int)
+    b[valid] = np.clip((z[valid] - zmin) / (zmax - zmin) * bins, 0, bins - 1)
+
+    tile_y = np.arange(rows) * tiles // rows
+    tile_x = np.arange(cols) * tiles // cols
+    tile = tile_y[:,np.newaxis] * tiles + tile_x[np.newaxis,:]
+
+    hist = np.bincount((tile * bins + b)[valid], minlength=tiles * tiles * bins)
+    hist = hist.reshape(tiles * tiles, bins).astype(float)
+
+    if clip > 0:
+        limit = clip * hist.sum(axis=1, keepdims=True) / bins
+        excess = np.maximum(hist - limit, 0).sum(axis=1, keepdims=True)
+        hist = np.minimum(hist, limit) + excess / bins
+
+    cdf = np.cumsum(hist, axis=1)
+    cdf /= np.maximum(cdf[:,-1:], 1)
+
+    # Bilinear interpolation weights between the tile centers
+    def weights(n):
+        center = (np.arange(n) + 0.5) * tiles / n - 0.5
+        low = np.clip(np.floor(center).astype(int), 0, tiles - 1)
+        high = np.minimum(low + 1, tiles - 1)
+
+        return low, high, np.clip(center - low, 0, 1)
+
+    y0, y1, wy = [a[:,np.newaxis] for a in weights(rows)]
+    x0, x1, wx = [a[np.newaxis,:] for a in weights(cols)]
+
+    result = (cdf[y0 * tiles + x0, b] * (1 - wy) * (1 - wx) +
+              cdf[y0 * tiles + x1, b] * (1 - wy) * wx +
+              cdf[y1 * tiles + x0, b] * wy * (1 - wx) +
+              cdf[y1 * tiles + x1, b] * wy * wx)
+
+    result = zmin + (zmax - zmin) * result
+    result[~valid] = np.nan
+
+    return result
+
+
+def find_line_peaks(z, window=5, prominence=0.0, width=0.0):
+    """
+    Find the peaks along every row of a matrix at once.
+
+    A peak is the maximum within window datapoints on both sides. Its
+    prominence is its height above the highest of the minima on both sides
+    within the same distance, and its width is measured at half of its
+    prominence. Returns the row and column indices of the peaks with at
+    least the given prominence and width, their prominences and widths.
+    """
+    w = max(1, int(window))
+
+    nans = np.isnan(z)
+    lows = np.where(nans, np.inf, z)
+    highs = np.where(nans, -np.inf, z)
+
+    maxima = ndimage.maximum_filter1d(highs, 2*w + 1, axis=1, mode='nearest')
+
+    # The minima in the windows left and right of every datapoint
+    left = ndimage.minimum_filter1d(lows, w + 1, axis=1, mode='nearest',
+                                    origin=w // 2)
+    right = ndimage.minimum_filter1d(lows, w + 1, axis=1, mode='nearest',
+                                     origin=-((w + 1) // 2))
+
+    prominences = z - np.maximum(left, right)
+
+    with np.errstate(invalid='ignore'):
+        peaks = (highs == maxima) & ~nans & (prominences > 0)
+        peaks &= prominences >= prominence
+
+    rows, cols = np.nonzero(peaks)
+    prominences = prominences[rows, cols]
+    widths = get_peak_widths(z, rows, cols, prominences, w)
+
+    keep = widths >= width
+
+    return rows[keep], cols[keep], prominences[keep], widths[keep]
+
+
+def get_peak_widths(z, rows, cols, prominences, window):
+    """
+    Return the widths in datapoints of peaks in the rows of a matrix at half
+    their prominence, interpolated between the datapoints around the level.
+
+    The level is always crossed within the window on both sides, because
+    the minima there determine the prominence.
+    """
+    peaks = z[rows, cols]
+    level = peaks - prominences / 2.0
+    widths = np.zeros(len(rows))
+
+    for side in [-1, 1]:
+        found = np.zeros(len(rows), dtype=bool)
+        previous = peaks
+
+        for k in range(1, window + 1):
+            index = np.clip(cols + side * k, 0, z.shape[1] - 1)
+            values = z[rows, index]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                crossed = ~found & (values <= level)
+                fraction = (previous - level) / (previous - values)
+
+            widths[crossed] += k - 1 + fraction[crossed]
+            found |= crossed
+
+            # NaN values are skipped like in the minima
+            previous = np.where(np.isnan(values), previous, values)
+
+    return widths
+
+
+def track_peaks(lines, positions, distance):
+    """
+    Link peaks in consecutive lines into tracks, by connecting every peak to
+    the closest peak of the previous line within a distance. When several
+    peaks are closest to the same peak, only the closest one is connected.
+
+    lines and positions have to be sorted by line and then by position.
+    Returns the track number of every peak.
+    """
+    lines = np.asarray(lines)
+    positions = np.asarray(positions, dtype=float)
+    n = len(lines)
+
+    if n == 0:
+        return np.zeros(0, dtype=int)
+
+    # Sort key in which the lines don't overlap, so that a single search
+    # finds the neighbours of every peak in the previous line
+    span = np.max(positions) - np.min(positions) + 2 * distance + 1
+    keys = (lines - lines[0]) * span + (positions - np.min(positions))
+
+    index = np.searchsorted(keys, keys - span)
+    candidates = np.stack((index - 1, index))
+    valid = (candidates >= 0) & (candidates < n)
+    candidates = np.clip(candidates, 0, n - 1)
+
+    valid &= lines[candidates] == lines - 1
+    d = np.where(valid, np.abs(positions[candidates] - positions), np.inf)
+
+    nearest = np.argmin(d, axis=0)
+    parents = candidates[nearest, np.arange(n)]
+    d = d[nearest, np.arange(n)]
+
+    # Of the peaks that claim the same parent only the closest one is linked
+    linked = np.flatnonzero(d <= distance)
+    linked = linked[np.lexsort((d[linked], parents[linked]))]
+    first = np.concatenate(([True], np.diff(parents[linked]) != 0))
+
+    roots = np.arange(n)
+    roots[linked[first]] = parents[linked[first]]
+
+    # Every parent precedes its child, follow the links to the first peak
+    while True:
+        next_roots = roots[roots]
+
+        if np.array_equal(next_roots, roots):
+            break
+
+        roots = next_roots
+
+    return np.unique(roots, return_inverse=True)[1].reshape(-1)
+
+
+def polynomial_backgrounds(z, t, order=1):
+    """
+    Fit a polynomial to every row of a matrix at once and return the fitted
+    values, ignoring NaN values. All rows share the abscissa t.
+
+    The least-squares problems of all rows share one Vandermonde matrix, so
+    their normal equations can be built with two matrix products and solved
+    as a single batch. Rows with too few values for the fit become NaN.
+    """
+    # Scale the abscissa to [-1, 1] to keep the normal equations well
+    # conditioned for higher orders
+    t = np.asarray(t, dtype=float)
+    t = 2 * (t - np.min(t)) / (np.max(t) - np.min(t)) - 1
+
+    vander = np.vander(t, order + 1, increasing=True)
+    k = vander.shape[1]
+
+    weights = (~np.isnan(z)).astype(float)
+    values = np.where(np.isnan(z), 0, z)
+
+    # For every row: A = V^T W V and b = V^T W z
+    products = (vander[:,:,np.newaxis] * vander[:,np.newaxis,:]).reshape(-1, k * k)
+    a = np.dot(weights, products).reshape(-1, k, k)
+    b = np.dot(values, vander)
+
+    # Replace the singular systems so that the batch can be solved
+    singular = weights.sum(axis=1) < k
+    a[singular] = np.eye(k)
+
+    coefficients = np.linalg.solve(a, b[:,:,np.newaxis])[:,:,0]
+    coefficients[singular] = np.nan
+
+    return np.dot(coefficients, vander.T)
+
+
+def interp_lines(t, z, q):
+    """
+    Linearly interpolate every line of z, sampled at the coordinates t of
+    that line, at the coordinates q of the same line. All lines are handled
+    in a single search by offsetting the coordinates of every line past
+    those of the previous one. Coordinates outside of a line result in NaN,
+    datapoints with a NaN coordinate are ignored.
+    """
+    t, z, q = np.asarray(t, dtype=float), np.asarray(z), np.asarray(q)
+    lines, n = t.shape
+
+    # Sort the coordinates of every line, which puts NaN values at the end
+    order = np.argsort(t, axis=1, kind='stable')
+    t = np.take_along_axis(t, order, axis=1)
+    z = np.take_along_axis(z, order, axis=1)
+
+    counts = np.count_nonzero(~np.isnan(t), axis=1)
+    low = t[:, :1]
+    high = t[np.arange(lines), np.maximum(counts - 1, 0)][:, np.newaxis]
+
+    with np.errstate(invalid='ignore'):
+        inside = (q >= low) & (q <= high) & (counts[:, np.newaxis] > 1)
+
+    if not inside.any():
+        return np.full(q.shape, np.nan)
+
+    lo, hi = np.nanmin(t), np.nanmax(t)
+    offsets = np.arange(lines)[:, np.newaxis] * (hi - lo + 1)
+
+    # Keep NaN values out of the search
+    t = np.where(np.isnan(t), hi, t)
+    q = np.where(inside, q, lo)
+
+    index = np.searchsorted((t - lo + offsets).ravel(),
+                            (q - lo + offsets).ravel(), side='right') - 1
+
+    # Keep the indices within the valid points of the line so that the
+    # last point is included
+    start = np.repeat(np.arange(lines) * n, q.shape[1])
+    last = np.repeat(np.maximum(counts - 2, 0), q.shape[1])
+    index = np.clip(index, start, start + last)
+
+    t, z = t.ravel(), z.ravel()
+    t0, t1 = t[index], t[np.minimum(index + 1, t.size - 1)]
+    z0, z1 = z[index], z[np.minimum(index + 1, z.size - 1)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(t1 > t0, (q.ravel() - t0) / (t1 - t0), 0)
+
+    result = (z0 * (1 - w) + z1 * w).reshape(q.shape)
+    result[~inside] = np.nan
+
+    return result
+
+
+class Triangulation:
+    """
+    A triangle mesh which offers the part of the scipy Delaunay interface
+    that qtplot uses: points, simplices, transform and find_simplex.
+
+    This is used for meshes that are not generated by qhull, such as the
+    ones generated directly from the grid topology of the data.
+    """
+
+    def __init__(self, points, simplices):
+        self.points = points
+        self.simplices = simplices
+
+        self._transform = None
+        self._tree = None
+        self._finder = None
+        self._bounds = None
+        self._lock = threading.Lock()
+
+    @property
+    def transform(self):
+        """
+        Affine transformations from point coordinates to barycentric
+        coordinates, in the same layout as Delaunay.transform.
+        """
+        with self._lock:
+            if self._transform is None:
+                vertices = self.points[self.simplices]
+                r = vertices[:,2]
+
+                # Columns of T are the edges from the last vertex
+                a, c = (vertices[:,0] - r).T
+                b, d = (vertices[:,1] - r).T
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    det = a * d - b * c
+
+                    transform = np.empty((len(self.simplices), 3, 2))
+                    transform[:,0,0] = d / det
+                    transform[:,0,1] = -b / det
+                    transform[:,1,0] = -c / det
+                    transform[:,1,1] = a / det
+                    transform[:,2] = r
+
+                self._transform = transform
+
+        return self._transform
+
+    def get_tree(self):
+        """Return a KD-tree of the triangle centroids."""
+        with self._lock:
+            if self._tree is None:
+                vertices = self.points[self.simplices]
+                centroids = vertices.mean(axis=1)
+
+                # Scale the axes so that the average triangle is about as
+                # wide as it is high, which keeps the neighbour queries short
+                # for grids with a very different amount of rows and columns
+                extent = vertices.max(axis=1) - vertices.min(axis=1)
+                self._scale = 1.0 / np.maximum(np.median(extent, axis=0), 1e-12)
+
+                self._tree = cKDTree(centroids * self._scale)
+
+        return self._tree
+
+    def find_simplex(self, xi, eps=1e-9):
+        """
+        Return the indices of the simplices containing the points,
+        or -1 for points that are outside of the mesh.
+        """
+        xi = np.asarray(xi, dtype=float)
+        tree = self.get_tree()
+
+        simplices = np.empty(len(xi), dtype=int)
+        simplices.fill(-1)
+
+        # Test the nearest triangles, and widen the search for the points
+        # that were not found to lie inside any of them
+        remaining = np.arange(len(xi))
+        for k in [8, 64]:
+            k = min(k, len(self.simplices))
+
+            _, candidates = tree.query(xi[remaining] * self._scale, k=k)
+            candidates = candidates.reshape(len(remaining), k)
+
+            transforms = self.transform[candidates]
+            delta = xi[remaining][:,np.newaxis] - transforms[:,:,2]
+            bary = np.einsum('nkjl,nkl->nkj', transforms[:,:,:2], delta)
+            bary = np.concatenate((bary, 1 - bary.sum(axis=2, keepdims=True)),
+                                  axis=2)
+
+            inside = np.all(bary >= -eps, axis=2)
+            found = inside.any(axis=1)
+
+            first = np.argmax(inside, axis=1)
+            simplices[remaining[found]] = candidates[found, first[found]]
+
+            remaining = remaining[~found]
+
+            if len(remaining) == 0 or k == len(self.simplices):
+                break
+
+        # Long and thin triangles can contain a point while their centroids
+        # are far away, locate the points that are left exactly. Testing
+        # every triangle is fast for a few points, for many points an
+        # exact triangle finder is set up.
+        if len(remaining) * len(self.simplices) <= 2**26:
+            for i in remaining:
+                simplices[i] = self.find_exhaustive(xi[i], eps)
+        else:
+            simplices[remaining] = self.get_finder()(xi[remaining,0],
+                                                     xi[remaining,1])
+
+        return simplices
+
+    def find_exhaustive(self, point, eps=1e-9):
+        """Return the index of the simplex containing a point by testing all."""
+        with self._lock:
+            if self._bounds is None:
+                vertices = self.points[self.simplices]
+                self._bounds = (vertices.min(axis=1), vertices.max(axis=1))
+
+        low, high = self._bounds
+        candidates = np.flatnonzero(np.all((low <= point) & (point <= high),
+                                           axis=1))
+
+        transforms = self.transform[candidates]
+        bary = np.einsum('kjl,kl->kj', transforms[:,:2],
+                         point - transforms[:,2])
+        bary = np.column_stack((bary, 1 - bary.sum(axis=1)))
+
+        inside = np.flatnonzero(np.all(bary >= -eps, axis=1))
+
+        return candidates[inside[0]] if len(inside) > 0 else -1
+
+    def get_finder(self):
+        """Return an exact triangle finder, which is slower to set up."""
+        from matplotlib.tri import Triangulation as MplTriangulation
+        from matplotlib.tri import TrapezoidMapTriFinder
+
+        with self._lock:
+            if self._finder is None:
+                mesh = MplTriangulation(self.points[:,0], self.points[:,1],
+                                        self.simplices)
+                self._finder = TrapezoidMapTriFinder(mesh)
+
+        return self._finder
+
+
+def grid_triangulation(x, y, valid):
+    """
+    Generate a triangulation using the grid topology of the data: every
+    cell of which all four corners are valid is split into two triangles.
+
+    The points of the triangulation are the valid points in row-major order.
+    If the grid cells do not form a proper mesh (for example because the
+    coordinates fold back onto themselves), None is returned.
+    """
+    rows, cols = x.shape
+
+    if rows < 2 or cols < 2:
+        return None
+
+    index = np.arange(rows * cols).reshape(rows, cols)
+
+    cells = (valid[:-1,:-1] & valid[:-1,1:] &
+             valid[1:,:-1] & valid[1:,1:])
+
+    if not cells.any():
+        return None
+
+    bottom_left, bottom_right = index[:-1,:-1][cells], index[:-1,1:][cells]
+    top_left, top_right = index[1:,:-1][cells], index[1:,1:][cells]
+
+    simplices = np.concatenate((
+        np.column_stack((bottom_left, bottom_right, top_left)),
+        np.column_stack((bottom_right, top_right, top_left))))
+
+    # All triangles have to be non-degenerate and have the same orientation,
+    # otherwise they overlap and we need a real Delaunay triangulation
+    xc, yc = x.ravel(), y.ravel()
+    x0, x1, x2 = xc[simplices].T
+    y0, y1, y2 = yc[simplices].T
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+
+    if not (np.all(area > 0) or np.all(area < 0)):
+        return None
+
+    # Convert the grid indices into indices of the valid points
+    compact = np.cumsum(valid.ravel()) - 1
+    points = np.column_stack((xc[valid.ravel()], yc[valid.ravel()]))
+
+    return Triangulation(points, compact[simplices])
+
+
+def triangulate(x, y, valid):
+    """
+    Triangulate the valid points of the coordinate matrices. The grid
+    topology is used when possible, qhull is only used for scattered data.
+    """
+    tri = grid_triangulation(x, y, valid)
+
+    if tri is None:
+        logger.info('Data is not gridded, using a Delaunay triangulation')
+
+        tri = qhull.Delaunay(np.column_stack((x[valid], y[valid])))
+
+    return tri
+
+
+class TriangulationCache(LRUCache):
+    """
+    Triangulations keyed by a hash of the normalized coordinates and the
+    mask of valid points, so that they can be shared between Data2D objects
+    that only differ in their values.
+
+    If a directory is set, triangulations of large datasets are also stored
+    on disk so that they can be reused in later sessions.
+    """
+
+    def __init__(self, max_items=4, directory=None, min_points=10**6,
+                 max_files=16):
+        LRUCache.__init__(self, max_items)
+
+        self.directory = directory
+        self.min_points = min_points
+        self.max_files = max_files
+
+    def get_path(self, key):
+        return os.path.join(self.directory, 'tri_%s.npz' % key)
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+
+        path = self.get_path(key)
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as f:
+                tri = Triangulation(f['points'], f['simplices'])
+        except (IOError, ValueError, KeyError):
+            logger.warning('Could not load cached triangulation %s' % path)
+
+            return None
+
+        # Update the modification time, the oldest files are removed first
+        os.utime(path, None)
+
+        return tri
+
+    def save(self, key, tri):
+        if self.directory is None or len(tri.points) < self.min_points:
+            return
+
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            np.savez(self.get_path(key), points=tri.points,
+                     simplices=tri.simplices)
+
+            files = [os.path.join(self.directory, f)
+                     for f in os.listdir(self.directory)
+                     if f.startswith('tri_') and f.endswith('.npz')]
+            files.sort(key=os.path.getmtime)
+
+            for path in files[:-self.max_files]:
+                os.remove(path)
+        except (IOError, OSError):
+            logger.warning('Could not store the triangulation on disk')
+
+    def get_triangulation(self, x, y, valid):
+        """Return the triangulation of the points, generating it if needed."""
+        key = array_key(x, y, valid)
+
+        tri = self.get(key)
+
+        if tri is None:
+            tri = self.load(key)
+
+            if tri is None:
+                tri = triangulate(x, y, valid)
+
+                self.save(key, tri)
+
+            self.put(key, tri)
+
+        return tri
+
+
+triangulation_cache = TriangulationCache()
+
+# Forward Fourier transforms keyed by a hash of the data, so that changing
+# the parameters of a Fourier filter only requires the inverse transform
+spectrum_cache = LRUCache(max_items=2)
+
+
+def get_spectrum(z):
+    """
+    Return the real 2D Fourier transform of a matrix in which NaN values
+    are replaced by the average.
+    """
+    key = array_key(z)
+    spectrum = spectrum_cache.get(key)
+
+    if spectrum is None:
+        spectrum = np.fft.rfft2(np.where(np.isnan(z), np.nanmean(z), z))
+
+        spectrum_cache.put(key, spectrum)
+
+    return spectrum
+
+
+# Caches the fitted parameters so that only the shown map can be changed
+fit_cache = LRUCache(max_items=4)
+
+
+class GridInterpolator:
+    """
+    Bilinear interpolation on a rectilinear grid, where the x coordinates
+    only depend on the column and the y coordinates only on the row.
+
+    Points are located using a binary search on both axes, so no
+    triangulation is needed.
+    """
+
+    def __init__(self, x, y, z, chunk_size=2**18):
+        # Make both axes increasing
+        if x[0] > x[-1]:
+            x, z = x[::-1], z[:,::-1]
+
+        if y[0] > y[-1]:
+            y, z = y[::-1], z[::-1]
+
+        self.x, self.y, self.z = x, y, z
+        self.chunk_size = chunk_size
+
+    def get_weights(self, axis, coords):
+        """Return the lower indices and the weights of the upper ones."""
+        i = np.searchsorted(axis, coords, side='right') - 1
+        i = np.clip(i, 0, len(axis) - 2)
+
+        t = (coords - axis[i]) / (axis[i + 1] - axis[i])
+
+        # Points outside of the grid have no value
+        t[(coords < axis[0]) | (coords > axis[-1])] = np.nan
+
+        return i, t
+
+    def __call__(self, points):
+        """
+        Interpolate points on the grid.
+
+        points: N x 2 numpy array with (x, y) as rows
+        """
+        values = np.empty(len(points))
+
+        # Process the points in chunks to limit the size of the temporaries
+        for start in range(0, len(points), self.chunk_size):
+            chunk = points[start:start + self.chunk_size]
+
+            i, t = self.get_weights(self.x, chunk[:,0])
+            j, u = self.get_weights(self.y, chunk[:,1])
+
+            bottom = self.z[j, i] * (1 - t) + self.z[j, i + 1] * t
+            top = self.z[j + 1, i] * (1 - t) + self.z[j + 1, i + 1] * t
+
+            values[start:start + len(chunk)] = bottom * (1 - u) + top * u
+
+        return values
+
+
+class Statistics(object):
+    """
+    Statistics of an array which are calculated when they are first needed
+    and then kept, so that for example dragging the colormap sliders does
+    not scan the whole array on every change.
+    """
+
+    def __init__(self, a):
+        self.a = a
+        self.values = {}
+
+    def get(self, key, func):
+        if key not in self.values:
+            self.values[key] = func()
+
+        return self.values[key]
+
+    @property
+    def min(self):
+        return self.get('min', lambda: np.nanmin(self.a))
+
+    @property
+    def max(self):
+        return self.get('max', lambda: np.nanmax(self.a))
+
+    @property
+    def nan_count(self):
+        return self.get('nan_count', lambda: np.count_nonzero(np.isnan(self.a)))
+
+    def percentile(self, q):
+        """Return the percentile(s) q of the non-NaN values."""
+        return self.get(('percentile', tuple(np.ravel(q))),
+                        lambda: np.nanpercentile(self.a, q))
+
+    def histogram(self, bins=256):
+        """Return the histogram between the minimum and maximum value."""
+        def calculate():
+            values = self.a[~np.isnan(self.a)]
+
+            return np.histogram(values, bins, range=(self.min, self.max))
+
+        return self.get(('histogram', bins), calculate)
+
+
+class Data2D(object):
     """
     Class which represents 2d data as two matrices with x and y coordinates
     and one with values.
@@ -235,6 +1012,9 @@ class Data2D:
                  x_name='', y_name='', z_name='', x_setpoints_name='',
                  y_setpoints_name='', filename='', timestamp='', dat_file=None,
                  equidistant=(False, False), varying=(False, False)):
+        # Statistics of the x, y and z matrices, see get_stats
+        self.stats = {}
+
         self.x_name, self.y_name, self.z_name = x_name, y_name, z_name
         self.x_setpoints_name = x_setpoints_name
         self.y_setpoints_name = y_setpoints_name
@@ -268,6 +1048,13 @@ class Data2D:
         self.equidistant = equidistant
         self.varying = varying
         self.tri = None
+        self.interpolator = None
+
+        # Table of peaks found by the find_peaks operation
+        self.peaks = None
+
+        # Identifies unmodified data loaded from a file, see get_key
+        self.key = None
 
         # Store column and row averages for linetrace lookup
         self.x_means = np.nanmean(self.x, axis=0)
@@ -284,6 +1071,57 @@ class Data2D:
             yrow = miny + np.arange(y.shape[0]) * diffy
             self.y = np.tile(yrow[:,np.newaxis], (1, y.shape[1]))
 
+    def get_x(self):
+        return self._x
+
+    def set_x(self, x):
+        self._x = x
+        self.stats.pop('x', None)
+        self.peaks = None
+
+    def get_y(self):
+        return self._y
+
+    def set_y(self, y):
+        self._y = y
+        self.stats.pop('y', None)
+        self.peaks = None
+
+    def get_z(self):
+        return self._z
+
+    def set_z(self, z):
+        self._z = z
+        self.stats.pop('z', None)
+
+    # Replacing a matrix discards its statistics. Operations that modify a
+    # matrix in place should assign it again afterwards. Found peaks are
+    # discarded when the coordinates change.
+    x = property(get_x, set_x)
+    y = property(get_y, set_y)
+    z = property(get_z, set_z)
+
+    def get_key(self):
+        """Return a key which identifies the contents of the data."""
+        if self.key is not None:
+            return self.key
+
+        return array_key(self.x, self.y, self.z)
+
+    @property
+    def nbytes(self):
+        arrays = [self.x, self.y, self.z, self.row_numbers,
+                  self.x_setpoints, self.y_setpoints]
+
+        return sum(np.asarray(a).nbytes for a in arrays)
+
+    def get_stats(self, name='z'):
+        """Return the Statistics of the x, y or z matrix."""
+        if name not in self.stats:
+            self.stats[name] = Statistics(getattr(self, name))
+
+        return self.stats[name]
+
     def save(self, filename):
         """
         Save the 2D data to a file.
@@ -292,9 +1130,21 @@ class Data2D:
         """
         _, ext = os.path.splitext(filename)
 
+        # Bands of rows are written at a time, so that memory-mapped data
+        # does not have to fit in memory
+        bands = chunks(self.z.shape[0],
+                       2**24 // (8 * 5 * max(self.z.shape[1], 1)))
+
         if ext == '.npy':
-            mat = np.dstack((self.x.data, self.y.data, self.z.data))
-            np.save(filename, mat)
+            dtype = np.result_type(self.x, self.y, self.z)
+            mat = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                            shape=self.z.shape + (3,))
+
+            for start, stop in bands:
+                for i, a in enumerate([self.x, self.y, self.z]):
+                    mat[start:stop,:,i] = np.ma.getdata(a[start:stop])
+
+            mat.flush()
         elif ext == '.mat':
             mat = np.dstack((self.x.data, self.y.data, self.z.data))
             io.savemat(filename, {'data': mat})
@@ -306,16 +1156,22 @@ class Data2D:
 
                 i = 1
 
-                if len(self.x_setpoints) != 0:
+                # The setpoints no longer belong to the datapoints after an
+                # operation that changed the shape of the data
+                x_setpoints, y_setpoints = [
+                    a if np.size(a) == self.z.size else []
+                    for a in [self.x_setpoints, self.y_setpoints]]
+
+                if len(x_setpoints) != 0:
                     f.write('# Column %d\n' % i)
                     f.write('#\tname: %s\n' % self.x_setpoints_name)
-                    f.write('#\tsize: %d\n' % self.x_setpoints.shape[1])
+                    f.write('#\tsize: %d\n' % x_setpoints.shape[1])
                     i += 1
 
-                if len(self.y_setpoints) != 0:
+                if len(y_setpoints) != 0:
                     f.write('# Column %d\n' % i)
                     f.write('#\tname: %s\n' % self.y_setpoints_name)
-                    f.write('#\tsize: %d\n' % self.y_setpoints.shape[1])
+                    f.write('#\tsize: %d\n' % y_setpoints.shape[1])
                     i += 1
 
                 f.write('# Column %d\n' % i)
@@ -332,24 +1188,29 @@ class Data2D:
                 f.write('\n')
 
                 # Write formatted data
-                a = np.vstack((self.x.ravel(), self.y.ravel(), self.z.ravel()))
+                columns = [a for a in [x_setpoints, y_setpoints]
+                           if len(a) != 0] + [self.x, self.y, self.z]
 
-                if len(self.y_setpoints) != 0:
-                    a = np.vstack((self.y_setpoints.ravel(), a))
-                if len(self.x_setpoints) != 0:
-                    a = np.vstack((self.x_setpoints.ravel(), a))
+                for start, stop in bands:
+                    a = np.vstack([np.ravel(c[start:stop]) for c in columns])
 
-                df = pd.DataFrame(a.T)
-                df.to_csv(f, sep='\t', float_format='%.12e', index=False,
-                          header=False)
+                    df = pd.DataFrame(a.T)
+                    df.to_csv(f, sep='\t', float_format='%.12e', index=False,
+                              header=False)
 
     def set_data(self, x, y, z):
         self.x, self.y, self.z = x, y, z
 
+        # The interpolation of the previous data can't be used anymore
+        self.tri = None
+        self.interpolator = None
+
     def get_limits(self):
-        xmin, xmax = np.nanmin(self.x), np.nanmax(self.x)
-        ymin, ymax = np.nanmin(self.y), np.nanmax(self.y)
-        zmin, zmax = np.nanmin(self.z), np.nanmax(self.z)
+        x, y, z = self.get_stats('x'), self.get_stats('y'), self.get_stats('z')
+
+        xmin, xmax = x.min, x.max
+        ymin, ymax = y.min, y.max
+        zmin, zmax = z.min, z.max
 
         # Thickness for 1d scans, should we do this here or
         # in the drawing code?
@@ -368,44 +1229,97 @@ class Data2D:
         x = self.tri.points[:,0]
         y = self.tri.points[:,1]
 
-        xmin, xmax, ymin, ymax, _, _ = self.get_limits()
+        xmin, xmax, ymin, ymax = self.tri_limits
         x = x * (xmax - xmin) + xmin
         y = y * (ymax - ymin) + ymin
 
         return x, y
 
     def generate_triangulation(self):
-        xc = self.x.ravel()
-        yc = self.y.ravel()
-        zc = self.z.ravel()
-
         # Remove any NaN values as the triangulation can't handle this
-        nans = np.isnan(zc)
-        xc = xc[~nans]
-        yc = yc[~nans]
-        self.no_nan_values = zc[~nans]
+        valid = ~(np.isnan(self.x) | np.isnan(self.y) | np.isnan(self.z))
+        self.no_nan_values = self.z[valid]
 
         # Normalize the coordinates. This improves the triangulation results
         # in cases where the data ranges on both axes are very different
         # in magnitude
         xmin, xmax, ymin, ymax, _, _ = self.get_limits()
-        xc = (xc - xmin) / (xmax - xmin)
-        yc = (yc - ymin) / (ymax - ymin)
+        xc = (self.x - xmin) / (xmax - xmin)
+        yc = (self.y - ymin) / (ymax - ymin)
 
-        self.tri = qhull.Delaunay(np.column_stack((xc, yc)))
+        # Keep the limits for normalizing the points to interpolate
+        self.tri_limits = xmin, xmax, ymin, ymax
+
+        self.tri = triangulation_cache.get_triangulation(xc, yc, valid)
+
+    def get_grid_axes(self, tolerance=1e-2):
+        """
+        Return the x and y axes if the data lies on a rectilinear grid with
+        monotonic axes, otherwise return None.
+
+        The coordinates can deviate from the axes by a fraction (tolerance)
+        of the smallest spacing between the gridlines.
+        """
+        if self.z.shape[0] < 2 or self.z.shape[1] < 2:
+            return None
+
+        x_axis = np.nanmean(self.x, axis=0)
+        y_axis = np.nanmean(self.y, axis=1)
+
+        for axis, coords in [(x_axis, self.x - x_axis[np.newaxis,:]),
+                             (y_axis, self.y - y_axis[:,np.newaxis])]:
+            if np.isnan(axis).any():
+                return None
+
+            spacing = np.diff(axis)
+
+            if not (np.all(spacing > 0) or np.all(spacing < 0)):
+                return None
+
+            if np.nanmax(np.abs(coords)) > tolerance * np.min(np.abs(spacing)):
+                return None
+
+        return x_axis, y_axis
+
+    def generate_interpolator(self):
+        """
+        Select the interpolation method for this data: bilinear sampling if
+        the data is on a rectilinear grid, else barycentric interpolation
+        on a triangulation.
+        """
+        axes = self.get_grid_axes()
+
+        if axes is not None:
+            self.interpolator = GridInterpolator(axes[0], axes[1], self.z)
+        else:
+            self.generate_triangulation()
+            self.interpolator = self.interpolate_triangulation
 
     def interpolate(self, points):
         """
         Interpolate points on the 2d data.
 
+        points: N x 2 numpy array with (x, y) as rows
+        """
+        if self.interpolator is None:
+            self.generate_interpolator()
+
+        return self.interpolator(points)
+
+    def interpolate_triangulation(self, points):
+        """
+        Interpolate points on the 2d data using barycentric interpolation
+        on the triangulation.
+
         points: N x 2 numpy array with (x, y) as rows
         """
         if self.tri is None:
             self.generate_triangulation()
 
-        xmin, xmax, ymin, ymax, _, _ = self.get_limits()
-        points[:,0] = (points[:,0] - xmin) / (xmax - xmin)
-        points[:,1] = (points[:,1] - ymin) / (ymax - ymin)
+        # Normalize a copy of the points in the same way as the coordinates
+        xmin, xmax, ymin, ymax = self.tri_limits
+        points = np.column_stack(((points[:,0] - xmin) / (xmax - xmin),
+                                  (points[:,1] - ymin) / (ymax - ymin)))
 
         # Find the indices of the simplices (triangle in this case)
         # to which the points belong to
@@ -424,11 +1338,8 @@ class Data2D:
 
         values = np.einsum('nj,nj->n', np.take(self.no_nan_values, indices), temp)
 
-        #print values[np.any(temp<0, axis=1)]
-
-        # This should put a NaN for points outside of any simplices
-        # but is for some reason sometimes also true inside a simplex
-        #values[np.any(temp < 0.0, axis=1)] = np.nan
+        # Points outside of any simplex have no value
+        values[simplices == -1] = np.nan
 
         return values
 
@@ -560,7 +1471,9 @@ class Data2D:
         cb.formatter = FixedOrderFormatter('%.0f', 1)
         cb.update_ticks()
         cb.set_label(self.z_name)
-        cb.draw_all()
+        # Matplotlib 3.8 and newer draw the colorbar without this
+        if hasattr(cb, 'draw_all'):
+            cb.draw_all()
 
         fig.tight_layout()
 
@@ -650,7 +1563,7 @@ class Data2D:
         return x_flip, y_flip
 
     def copy(self):
-        return Data2D(np.copy(self.x), np.copy(self.y), np.copy(self.z),
+        copy = Data2D(np.copy(self.x), np.copy(self.y), np.copy(self.z),
                       np.copy(self.x_setpoints), np.copy(self.y_setpoints),
                       np.copy(self.row_numbers),
                       self.x_name, self.y_name, self.z_name,
@@ -658,10 +1571,137 @@ class Data2D:
                       self.filename, self.timestamp, self.dat_file,
                       self.equidistant, self.varying)
 
+        copy.peaks = self.peaks
+
+        return copy
+
     def abs(self):
         """Take the absolute value of every datapoint."""
         self.z = np.absolute(self.z)
 
+    def affine(self, angle=0.0, shear=0.0, x_scale=1.0, y_scale=1.0,
+               method='linear', chunk_size=2**18):
+        """
+        Rotate (in degrees), shear and scale the data around its center.
+        The transformation is done in the plotted x and y coordinates, with
+        the average spacing of the datapoints, and the data is resampled
+        onto the original coordinates.
+        """
+        rows, cols = self.z.shape
+        order = 1 if method == 'linear' else 3
+
+        angle = np.radians(angle)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                             [np.sin(angle), np.cos(angle)]])
+        transform = rotation.dot([[1, shear], [0, 1]]).dot([[x_scale, 0],
+                                                          [0, y_scale]])
+
+        # The size of a datapoint in the x and y coordinates
+        dx = np.nanmean(np.diff(self.x, axis=1)) if cols > 1 else 1.0
+        dy = np.nanmean(np.diff(self.y, axis=0)) if rows > 1 else 1.0
+        spacing = np.diag([dx if np.isfinite(dx) and dx != 0 else 1.0,
+                           dy if np.isfinite(dy) and dy != 0 else 1.0])
+
+        # Every output point is taken from the input at the inverse transform,
+        # which is converted from coordinates to datapoints
+        inverse = np.linalg.inv(spacing).dot(np.linalg.inv(transform)).dot(
+            spacing)
+        center = np.array([(cols - 1) / 2.0, (rows - 1) / 2.0])
+
+        missing = np.isnan(self.z)
+        values = np.where(missing, np.nanmean(self.z), self.z)
+
+        # Calculate the spline coefficients once instead of for every tile,
+        # with the same edge mode as the interpolation
+        if order > 1:
+            values = ndimage.spline_filter(values, order=order,
+                                           mode='constant')
+
+        z = np.empty((rows, cols))
+
+        def transform_rows(bounds):
+            start, stop = bounds
+            c, r = np.meshgrid(np.arange(cols), np.arange(start, stop))
+
+            u, v = inverse.dot([c.ravel() - center[0], r.ravel() - center[1]])
+            coords = [v + center[1], u + center[0]]
+
+            tile = ndimage.map_coordinates(values, coords, order=order,
+                                           mode='constant', cval=np.nan,
+                                           prefilter=False)
+            tile[ndimage.map_coordinates(missing, coords, order=0)] = np.nan
+
+            z[start:stop] = tile.reshape(c.shape)
+
+        thread_map(transform_rows, chunks(rows, chunk_size // max(cols, 1)))
+
+        self.z = z
+
+    def align_rows(self, reference='mean', max_shift=0):
+        """Shift every row to align it with a reference row using cross-correlation."""
+        rows, n = self.z.shape
+
+        # Remove the average and NaN values of every row, they would
+        # otherwise dominate the correlation
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            z = self.z - np.nanmean(self.z, axis=1, keepdims=True)
+
+        z[np.isnan(z)] = 0
+
+        if reference == 'mean':
+            ref = np.mean(z, axis=0)
+        elif reference == 'first':
+            ref = z[0]
+        elif reference == 'middle':
+            ref = z[rows // 2]
+
+        # Zero-pad to prevent the correlation from wrapping around, and
+        # transform all rows in a single call
+        size = 2 * n
+        spectra = np.fft.rfft(z, size, axis=1)
+        spectra *= np.conj(np.fft.rfft(ref, size))
+        correlation = np.fft.irfft(spectra, size, axis=1)
+
+        # Order the lags from -(n - 1) to n - 1
+        correlation = np.hstack((correlation[:,-(n - 1):], correlation[:,:n]))
+        lags = np.arange(-(n - 1), n)
+
+        max_shift = int(max_shift)
+        if 0 < max_shift < n - 1:
+            inside = np.abs(lags) <= max_shift
+            correlation, lags = correlation[:,inside], lags[inside]
+
+        peak = np.argmax(correlation, axis=1)
+
+        # Refine the peak position by fitting a parabola through the
+        # maximum and its neighbours
+        inner = np.clip(peak, 1, correlation.shape[1] - 2)
+        index = np.arange(rows)
+        left = correlation[index, inner - 1]
+        center = correlation[index, inner]
+        right = correlation[index, inner + 1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = 0.5 * (left - right) / (left - 2 * center + right)
+
+        offset[~np.isfinite(offset) | (peak != inner)] = 0
+        shifts = lags[peak] + np.clip(offset, -0.5, 0.5)
+
+        # Resample the shifted rows using linear interpolation
+        positions = np.arange(n)[np.newaxis,:] + shifts[:,np.newaxis]
+        lower = np.clip(np.floor(positions).astype(int), 0, n - 2)
+        weight = positions - lower
+
+        aligned = (self.z[index[:,np.newaxis], lower] * (1 - weight) +
+                   self.z[index[:,np.newaxis], lower + 1] * weight)
+        aligned[(positions < 0) | (positions > n - 1)] = np.nan
+
+        self.z = aligned
+
+        # Return the shift of every row in datapoints
+        return shifts
+
     def autoflip(self):
         """Flip the data so that the X and Y-axes increase to the top and right."""
         self.flip_axes(*self.is_flipped())
@@ -704,19 +1744,41 @@ class Data2D:
 
             self.set_data(xcomp.x[1:-1,:], ycomp.y[:,1:-1], xvalues * xdir + yvalues * ydir)
 
-    def equalize(self):
-        """Perform histogramic equalization on the image."""
-        binn = 65535
+    def equalize(self, method='histogram', samples=100000, tiles=8, clip=0.0):
+        """Perform histogramic equalization on the image, globally or per tile."""
+        if method == 'adaptive':
+            self.z = equalize_adaptive(self.z, tiles, clip)
+            return
+
+        z = np.ascontiguousarray(self.z, dtype=float)
+        no_nans = z[~np.isnan(z)]
+
+        if method == 'histogram':
+            binn = 65535
 
-        # Create a density histogram with surface area 1
-        no_nans = self.z[~np.isnan(self.z)]
-        hist, bins = np.histogram(no_nans.flatten(), binn)
-        cdf = hist.cumsum()
+            # Create a density histogram with surface area 1
+            hist, bins = np.histogram(no_nans, binn)
+            cdf = hist.cumsum()
 
-        cdf = bins[0] + (bins[-1]-bins[0]) * (cdf / float(cdf[-1]))
+            cdf = bins[0] + (bins[-1]-bins[0]) * (cdf / float(cdf[-1]))
+            levels = bins[:-1]
+        elif method == 'subsample':
+            # Estimate the cumulative distribution from the quantiles of
+            # a random subset of the datapoints
+            if 0 < samples < len(no_nans):
+                indices = np.random.RandomState(0).randint(0, len(no_nans),
+                                                           int(samples))
+                no_nans = no_nans[indices]
 
-        new = np.interp(self.z.flatten(), bins[:-1], cdf)
-        self.z = np.reshape(new, self.z.shape)
+            quantiles = np.linspace(0, 1, 1025)
+            levels = np.percentile(no_nans, quantiles * 100)
+
+            zmin, zmax = np.min(no_nans), np.max(no_nans)
+            cdf = zmin + (zmax - zmin) * quantiles
+
+        # Apply the mapping in place
+        apply_mapping(z, levels, cdf)
+        self.z = z
 
     def even_odd(self, even):
         """Extract even or odd rows, optionally flipping odd rows."""
@@ -728,6 +1790,160 @@ class Data2D:
         self.set_data(self.x[indices], self.y[indices], self.z[indices])
         self.row_numbers = self.row_numbers[indices]
 
+    def get_frequencies(self):
+        """
+        Return matrices of the spatial frequencies along x and y of the
+        elements of the real 2D Fourier transform of the data.
+        """
+        rows, cols = self.z.shape
+
+        dx = np.abs(np.nanmean(np.diff(self.x, axis=1))) if cols > 1 else 1
+        dy = np.abs(np.nanmean(np.diff(self.y, axis=0))) if rows > 1 else 1
+
+        return np.meshgrid(np.fft.rfftfreq(cols, dx), np.fft.fftfreq(rows, dy))
+
+    def apply_fourier_mask(self, mask):
+        """Multiply the Fourier transform of the data by a mask and transform back."""
+        nans = np.isnan(self.z)
+
+        spectrum = get_spectrum(self.z)
+        z = np.fft.irfft2(spectrum * mask, self.z.shape)
+        z[nans] = np.nan
+
+        self.z = z
+
+    def fft_band(self, low=0.0, high=0.0, type='pass'):
+        """Keep or remove a band of spatial frequencies, a high frequency of 0 means no limit."""
+        fx, fy = self.get_frequencies()
+        r = np.hypot(fx, fy)
+
+        band = r >= low
+        if high > 0:
+            band &= r <= high
+
+        if type == 'stop':
+            band = ~band
+
+        self.apply_fourier_mask(band)
+
+    def fft_mask(self, x_min=0.0, x_max=0.0, y_min=0.0, y_max=0.0, action='remove'):
+        """Keep or remove a rectangular region of spatial frequencies."""
+        fx, fy = self.get_frequencies()
+
+        # Also mask the mirrored region, which belongs to the same real signal
+        region = ((fx >= x_min) & (fx <= x_max) & (fy >= y_min) & (fy <= y_max) |
+                  (-fx >= x_min) & (-fx <= x_max) & (-fy >= y_min) & (-fy <= y_max))
+
+        if action == 'remove':
+            region = ~region
+
+        self.apply_fourier_mask(region)
+
+    def fft_notch(self, x_freq=0.0, y_freq=0.0, width=1.0, harmonics=1):
+        """Remove a spatial frequency and its harmonics using a gaussian notch filter, the frequencies and width are in 1/x and 1/y units. A frequency of 0 does nothing."""
+        if x_freq == 0 and y_freq == 0:
+            return
+
+        fx, fy = self.get_frequencies()
+
+        mask = np.ones(fx.shape)
+        for n in range(1, int(harmonics) + 1):
+            for sign in [1, -1]:
+                r2 = (fx - sign*n*x_freq)**2 + (fy - sign*n*y_freq)**2
+                mask *= 1 - np.exp(-r2 / (2.0 * width**2))
+
+        self.apply_fourier_mask(mask)
+
+    def fft_power(self, log=True):
+        """Show the power spectrum of the data."""
+        fx, fy = self.get_frequencies()
+
+        power = np.abs(get_spectrum(self.z))**2
+
+        if log:
+            with np.errstate(divide='ignore'):
+                power = np.log10(power)
+
+        # Put the zero frequency in the middle of the y-axis
+        self.set_data(fx, np.fft.fftshift(fy, axes=0),
+                      np.fft.fftshift(power, axes=0))
+        self.row_numbers = np.zeros(power.shape) * np.nan
+
+    def find_peaks(self, lines='rows', window=5, prominence=0.0, width=0.0,
+                   distance=5.0):
+        """Find peaks along every row/column and link them into tracks, they are shown on the plot."""
+        z = self.z if lines == 'rows' else self.z.T
+
+        line, index, prominences, widths = find_line_peaks(z, window,
+                                                           prominence, width)
+        tracks = track_peaks(line, index, distance)
+
+        if lines == 'columns':
+            line, index = index, line
+
+        if np.shape(self.row_numbers) == self.z.shape:
+            rows = self.row_numbers[line, index]
+        else:
+            rows = np.zeros(len(line)) * np.nan
+
+        self.peaks = pd.DataFrame(OrderedDict((
+            ('line', line if lines == 'rows' else index),
+            ('track', tracks),
+            ('x', self.x[line, index]),
+            ('y', self.y[line, index]),
+            ('z', self.z[line, index]),
+            ('prominence', prominences),
+            ('width', widths),
+            ('row', rows),
+        )))
+
+        return self.peaks
+
+    def get_fit(self, model='lorentzian', lines='rows', processes=None):
+        """
+        Fit a model to every row or column, returns a (lines, parameters)
+        array and the residual of every line.
+        """
+        x = self.x if lines == 'rows' else self.y.T
+        z = self.z if lines == 'rows' else self.z.T
+
+        key = (array_key(x, z), model, lines)
+        result = fit_cache.get(key)
+
+        if result is None:
+            result = fitting.fit_lines(model, x, z, processes)
+            fit_cache.put(key, result)
+
+        return result
+
+    def fit_lines(self, model='lorentzian', lines='rows', show='center'):
+        """Fit a lineshape to every row/column and show a parameter map or the fit."""
+        params, residuals = self.get_fit(model, lines)
+        func, names = fitting.models[model]
+
+        if show not in names + ['fit', 'residual']:
+            logger.warning('The %s model has no %s parameter, showing the %s '
+                           'instead' % (model, show, names[0]))
+            show = names[0]
+
+        # The values of every line as a column for rows or a row for columns,
+        # which broadcast against the matrices
+        def per_line(values):
+            return values[:, np.newaxis] if lines == 'rows' else values
+
+        if show in names:
+            values = per_line(params[:, names.index(show)])
+            self.z = np.broadcast_to(values, self.z.shape).copy()
+        else:
+            coords = self.x if lines == 'rows' else self.y
+            fit = func(coords, *[per_line(values) for values in params.T])
+
+            self.z = fit if show == 'fit' else self.z - fit
+
+        # Show the fraction of lines for which the fit converged
+        return OrderedDict((('converged', np.mean(np.isfinite(residuals))),
+                            ('residual', np.nanmedian(residuals))))
+
     def flip(self, x_flip, y_flip):
         """Flip the X or Y axes."""
         self.flip_axes(x_flip, y_flip)
@@ -766,17 +1982,35 @@ class Data2D:
         self.y = np.tile(bincoords[:,np.newaxis], (1, hist.shape[1]))
         self.z = hist
 
-    def interp_grid(self, width, height):
-        """Interpolate the data onto a uniformly spaced grid using barycentric interpolation."""
-        # NOT WOKRING FOR SOME REASON
+    def interp_grid(self, width, height, chunk_size=2**18):
+        """Interpolate the data onto a uniformly spaced grid."""
+        width, height = int(width), int(height)
+
         xmin, xmax, ymin, ymax, _, _ = self.get_limits()
 
         x = np.linspace(xmin, xmax, width)
         y = np.linspace(ymin, ymax, height)
-        xv, yv = np.meshgrid(x, y)
 
-        self.x, self.y = xv, yv
-        self.z = np.reshape(self.interpolate(np.column_stack((xv.flatten(), yv.flatten()))), xv.shape)
+        # Set up the interpolation before the threads start using it
+        if self.interpolator is None:
+            self.generate_interpolator()
+
+        z = np.empty((height, width))
+
+        # Interpolate bands of rows on the thread pool, which limits the
+        # size of the temporary coordinate arrays to that of one band
+        def interp_rows(rows):
+            start, stop = rows
+            xv, yv = np.meshgrid(x, y[start:stop])
+            points = np.column_stack((xv.ravel(), yv.ravel()))
+
+            z[start:stop] = self.interpolate(points).reshape(xv.shape)
+
+        thread_map(interp_rows, chunks(height, chunk_size // max(width, 1)))
+
+        self.set_data(np.tile(x, (height, 1)),
+                      np.tile(y[:,np.newaxis], (1, width)), z)
+        self.row_numbers = np.zeros((height, width)) * np.nan
 
     def interp_x(self, points):
         """Interpolate every row onto a uniformly spaced grid."""
@@ -816,7 +2050,7 @@ class Data2D:
 
     def log(self, subtract, min):
         """The base-10 logarithm of every datapoint."""
-        minimum = np.nanmin(self.z)
+        minimum = self.get_stats('z').min
 
         if subtract:
             #self.z[self.z < 0] = newmin
@@ -835,19 +2069,13 @@ class Data2D:
         """Negate every datapoint."""
         self.z *= -1
 
-    def norm_columns(self):
-        """Transform the values of every column so that they use the full colormap."""
-        def func(x):
-            return (x - np.nanmin(x)) / (np.nanmax(x) - np.nanmin(x))
+    def norm_columns(self, method='min-max', lower=1.0, upper=99.0):
+        """Normalize the values of every column, by default to use the full colormap."""
+        self.z = normalize_lines(self.z, 0, method, lower, upper)
 
-        self.z = np.apply_along_axis(func, 0, self.z)
-
-    def norm_rows(self):
-        """Transform the values of every row so that they use the full colormap."""
-        def func(x):
-            return (x - np.nanmin(x)) / (np.nanmax(x) - np.nanmin(x))
-
-        self.z = np.apply_along_axis(func, 1, self.z)
+    def norm_rows(self, method='min-max', lower=1.0, upper=99.0):
+        """Normalize the values of every row, by default to use the full colormap."""
+        self.z = normalize_lines(self.z, 1, method, lower, upper)
 
     def offset(self, offset=0):
         """Add a value to every datapoint."""
@@ -871,6 +2099,28 @@ class Data2D:
         """Multiply the datapoints by a number."""
         self.z *= factor
 
+    def sub_background(self, lines='rows', method='polynomial', order=1,
+                       percentile=50.0):
+        """Subtract a fitted polynomial or a percentile from every row/column."""
+        if lines == 'rows':
+            z, axis = self.z, np.nanmean(self.x, axis=0)
+        elif lines == 'columns':
+            z, axis = self.z.T, np.nanmean(self.y, axis=1)
+
+        # Fall back to the indices if some coordinates are missing
+        if np.isnan(axis).any() or np.nanmin(axis) == np.nanmax(axis):
+            axis = np.arange(len(axis))
+
+        if method == 'polynomial':
+            background = polynomial_backgrounds(z, axis, int(order))
+        elif method == 'percentile':
+            background = np.nanpercentile(z, percentile, axis=1, keepdims=True)
+
+        if lines == 'columns':
+            background = background.T
+
+        self.z = self.z - background
+
     def sub_linecut(self, type, position):
         """Subtract a horizontal/vertical linecut from every row/column."""
         if type == 'horizontal':
@@ -906,7 +2156,77 @@ class Data2D:
         """Subtract a plane with x and y slopes centered in the middle."""
         xmin, xmax, ymin, ymax, _, _ = self.get_limits()
 
-        self.z -= x_slope*(self.x - (xmax - xmin)/2) + y_slope*(self.y - (ymax - ymin)/2)
+        self.z -= x_slope*(self.x - (xmin + xmax)/2) + y_slope*(self.y - (ymin + ymax)/2)
+
+    def sub_surface(self, order=1, samples=0, left=0, right=-1, bottom=0, top=-1):
+        """Fit a plane or polynomial surface centered in the middle and subtract it."""
+        order, samples = int(order), int(samples)
+        left, right, bottom, top = int(left), int(right), int(bottom), int(top)
+
+        xmin, xmax, ymin, ymax, _, _ = self.get_limits()
+        x0, y0 = (xmin + xmax) / 2.0, (ymin + ymax) / 2.0
+
+        if right < 0:
+            right = self.z.shape[1] + right + 1
+
+        if top < 0:
+            top = self.z.shape[0] + top + 1
+
+        # Only fit to the points within the region
+        region = (slice(bottom, top), slice(left, right))
+        x = self.x[region].ravel() - x0
+        y = self.y[region].ravel() - y0
+        z = self.z[region].ravel()
+
+        valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y) | np.isnan(z)))
+
+        # Fitting to a random subset of points is much faster for large data,
+        # the seed is fixed to get the same surface every time
+        if 0 < samples < len(valid):
+            valid = np.random.RandomState(0).choice(valid, samples, replace=False)
+
+        x, y, z = x[valid], y[valid], z[valid]
+
+        powers = [(i, n - i) for n in range(order + 1) for i in range(n, -1, -1)]
+
+        if len(z) < len(powers):
+            raise ValueError('Not enough datapoints to fit the surface')
+
+        a = np.column_stack([x**i * y**j for i, j in powers])
+
+        # Scale the columns to improve the conditioning of the fit
+        scale = np.sqrt(np.sum(a**2, axis=0))
+        scale[scale == 0] = 1
+
+        coefficients = np.linalg.lstsq(a / scale, z, rcond=None)[0] / scale
+
+        x, y = self.x - x0, self.y - y0
+        for (i, j), c in zip(powers, coefficients):
+            self.z = self.z - c * x**i * y**j
+
+        # Return the coefficients to show them to the user
+        names = ['%s%s' % ('x^%d' % i if i > 1 else 'x' * i,
+                           'y^%d' % j if j > 1 else 'y' * j) or 'c'
+                 for i, j in powers]
+
+        return OrderedDict(zip(names, coefficients))
+
+    def symmetrize(self, axis='y', center=0.0, mode='symmetric'):
+        """Symmetrize or antisymmetrize the data around a value of the X or Y axis."""
+        if axis == 'x':
+            t, z = self.x, self.z
+        else:
+            t, z = self.y.T, self.z.T
+
+        # Resample the data at the coordinates mirrored around the center
+        mirrored = interp_lines(t, z, 2 * center - t)
+
+        if mode == 'symmetric':
+            result = (z + mirrored) / 2
+        else:
+            result = (z - mirrored) / 2
+
+        self.z = result if axis == 'x' else result.T
 
     def xderiv(self, method='midpoint'):
         """Find the rate of change between every datapoint in the x-direction."""
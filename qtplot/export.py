@@ -255,7 +255,7 @@ class ExportWidget(QtGui.QWidget):
                 quadmesh.set_clim(self.main.canvas.colormap.get_limits())
             else:
                 quadmesh = self.ax.tripcolor(tri,
-                                             self.main.data.z.ravel(),
+                                             self.main.data.no_nan_values,
                                              cmap=cmap, rasterized=True)
 
                 quadmesh.set_clim(self.main.canvas.colormap.get_limits())
@@ -295,7 +295,9 @@ class ExportWidget(QtGui.QWidget):
             self.cb.update_ticks()
 
             self.cb.set_label(self.format_label(self.le_z_label.text()))
-            self.cb.draw_all()
+            # Matplotlib 3.8 and newer draw the colorbar without this
+            if hasattr(self.cb, 'draw_all'):
+                self.cb.draw_all()
 
             # Plot the current linecut if neccesary
             if self.cb_linecut.checkState() == QtCore.Qt.Checked:
@@ -0,0 +1,211 @@
+import multiprocessing
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from . import parallel
+from .parallel import chunks
+
+
+def lorentzian(x, center, width, amplitude, offset):
+    """Lorentzian with a full width at half maximum of width."""
+    return amplitude / (1 + (2 * (x - center) / width)**2) + offset
+
+
+def fano(x, center, width, amplitude, offset, asymmetry):
+    """Fano resonance, reduces to a Lorentzian for a large asymmetry."""
+    eps = 2 * (x - center) / width
+
+    return (amplitude * (asymmetry + eps)**2 / ((1 + eps**2) *
+            (1 + asymmetry**2)) + offset)
+
+
+def thermal(x, center, width, amplitude, offset):
+    """Thermally broadened peak, width is the thermal energy kT."""
+    return amplitude / np.cosh((x - center) / (2 * width))**2 + offset
+
+
+# The model functions together with the names of their parameters
+models = OrderedDict((
+    ('lorentzian', (lorentzian, ['center', 'width', 'amplitude', 'offset'])),
+    ('fano', (fano, ['center', 'width', 'amplitude', 'offset', 'asymmetry'])),
+    ('thermal', (thermal, ['center', 'width', 'amplitude', 'offset'])),
+))
+
+# All parameter names that a fit can produce
+parameter_names = ['center', 'width', 'amplitude', 'offset', 'asymmetry']
+
+
+def guess_parameters(model, x, z):
+    """
+    Estimate initial parameters from the position and size of the peak,
+    returns a list of starting points to try.
+    """
+    offset = np.median(z)
+    peak = np.argmax(np.abs(z - offset))
+    amplitude = z[peak] - offset
+
+    # Use the amount of points above half the maximum for the width
+    above = np.count_nonzero(np.abs(z - offset) > np.abs(amplitude) / 2)
+    step = np.abs(x[-1] - x[0]) / max(len(x) - 1, 1)
+    width = max(above, 1) * step
+
+    if model == 'thermal':
+        width /= 3.5
+
+    guess = [x[peak], width, amplitude, offset]
+
+    # The sign and size of the asymmetry can not be estimated reliably
+    if model == 'fano':
+        return [guess + [q] for q in (10.0, 1.0, -1.0)]
+
+    return [guess]
+
+
+def fit_line(model, x, z, p0=None):
+    """
+    Fit a model to a single line, returns the parameters and the root mean
+    square of the residuals, or None if the fit did not converge.
+    """
+    func, names = models[model]
+
+    valid = np.isfinite(x) & np.isfinite(z)
+    x, z = x[valid], z[valid]
+
+    if len(x) <= len(names):
+        return None
+
+    if p0 is None:
+        guesses = guess_parameters(model, x, z)
+    else:
+        guesses = [p0]
+
+    best = None
+
+    for guess in guesses:
+        try:
+            with np.errstate(all='ignore'):
+                popt, pcov = curve_fit(func, x, z, p0=guess,
+                                       maxfev=200 * len(names))
+        except (RuntimeError, ValueError):
+            continue
+
+        residual = np.sqrt(np.mean((func(x, *popt) - z)**2))
+
+        if best is None or residual < best[1]:
+            best = popt, residual
+
+    return best
+
+
+def fit_lines_serial(model, x, z):
+    """
+    Fit a model to every row of x and z. Every fit is seeded with the
+    result of the previous row, which usually is close to the result and
+    saves many iterations compared to starting from a guess.
+    """
+    names = models[model][1]
+
+    params = np.zeros((z.shape[0], len(names))) * np.nan
+    residuals = np.zeros(z.shape[0]) * np.nan
+
+    p0 = None
+
+    for i in range(z.shape[0]):
+        result = fit_line(model, x[i], z[i], p0)
+
+        # Retry from a fresh guess if the seed was a bad starting point
+        if result is None and p0 is not None:
+            result = fit_line(model, x[i], z[i])
+
+        if result is None:
+            p0 = None
+            continue
+
+        params[i], residuals[i] = result
+        p0 = params[i]
+
+    return params, residuals
+
+
+def _fit_band(args):
+    return fit_lines_serial(*args)
+
+
+def get_context():
+    """
+    Return the multiprocessing context of the pool. Forking a process that
+    runs other threads, such as the GUI and the worker thread, can deadlock
+    the child, so the workers are started from a fresh process.
+    """
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+
+# Starting the worker processes and importing scipy in them takes a while,
+# so the pool is kept for the next fits
+_pool = None
+_pool_processes = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(processes):
+    """
+    Return the shared process pool, creating it when it is first needed or
+    when a different amount of processes is asked for.
+    """
+    global _pool, _pool_processes
+
+    with _pool_lock:
+        if _pool is not None and _pool_processes != processes:
+            _pool.close()
+            _pool = None
+
+        if _pool is None:
+            _pool = get_context().Pool(processes)
+            _pool_processes = processes
+
+        return _pool
+
+
+def fit_lines(model, x, z, processes=None, chunk_size=32):
+    """
+    Fit a model to every row of x and z using a pool of processes. Each
+    worker fits a band of neighbouring rows, so that the fits can be seeded
+    with the result of the previous row. The first row of every band starts
+    from a guess, like the first row of the data.
+
+    Returns a (rows, parameters) array and the residual of every row.
+    """
+    if model not in models:
+        raise ValueError('Unknown model: %s' % model)
+
+    x = np.asarray(x, dtype=float)
+    z = np.asarray(z, dtype=float)
+
+    if processes is None:
+        processes = parallel.threads
+
+    bands = chunks(z.shape[0], min(chunk_size,
+                                   -(-z.shape[0] // max(processes, 1))))
+
+    if processes == 1 or len(bands) < 2:
+        return fit_lines_serial(model, x, z)
+
+    # The bands are small compared to the time it takes to fit them, so
+    # they are simply sent to the workers
+    results = get_pool(processes).map(_fit_band, [(model, x[start:stop],
+                                                   z[start:stop])
+                                                  for start, stop in bands])
+
+    params = np.concatenate([params for params, residuals in results])
+    residuals = np.concatenate([residuals for params, residuals in results])
+
+    return params, residuals
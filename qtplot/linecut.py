@@ -40,6 +40,7 @@ class Linecut(QtGui.QDialog):
         self.x, self.y = None, None
         self.linetraces = []
         self.marker = None
+        self.peak_markers = None
         self.colors = cycle('bgrcmykw')
 
         self.ax.xaxis.set_major_formatter(FixedOrderFormatter())
@@ -291,6 +292,10 @@ class Linecut(QtGui.QDialog):
 
         self.linetraces = []
 
+        if self.peak_markers is not None:
+            self.peak_markers.remove()
+            self.peak_markers = None
+
         self.fig.canvas.draw()
 
     def plot_linetrace(self, x, y, z, row_numbers, type, position, title,
@@ -343,6 +348,8 @@ class Linecut(QtGui.QDialog):
             self.linetraces.append(line)
             self.ax.add_line(line)
 
+        self.plot_peaks(x, y, row_numbers)
+
         if self.cb_reset_cmap.checkState() == QtCore.Qt.Checked:
             x, y = np.ma.masked_invalid(x), np.ma.masked_invalid(y)
             minx, maxx = np.min(x), np.max(x)
@@ -359,6 +366,23 @@ class Linecut(QtGui.QDialog):
 
         self.fig.canvas.draw()
 
+    def plot_peaks(self, x, y, row_numbers):
+        """ Mark the found peaks which lie on the linetrace """
+        if self.peak_markers is not None:
+            self.peak_markers.remove()
+            self.peak_markers = None
+
+        peaks = self.main.data.peaks if self.main is not None else None
+
+        if peaks is None or row_numbers is None or len(peaks) == 0:
+            return
+
+        on_line = np.isin(row_numbers, peaks['row'].values)
+
+        if np.any(on_line):
+            self.peak_markers, = self.ax.plot(x[on_line], y[on_line], 'kx',
+                                              markersize=8)
+
     def resizeEvent(self, event):
         self.fig.tight_layout()
         self.canvas.draw()
@@ -1,12 +1,27 @@
 import numpy as np
 import os
 import json
-import math
+import pandas as pd
 import six
 
 from PyQt4 import QtGui, QtCore
 
-from .data import Data2D
+from .cache import LRUCache
+from .pipeline import Pipeline, Step
+from .registry import operations
+
+
+def format_timing(timing):
+    """Return a short description of the timing of an operation."""
+    if timing['cached']:
+        text = 'cached'
+    elif timing['fused'] > 1:
+        text = '%.3f s, fused' % timing['time']
+    else:
+        text = '%.3f s' % timing['time']
+
+    return '(%s, %s, %.1f MB)' % (text, 'x'.join(map(str, timing['shape'])),
+                                  timing['nbytes'] / 2.0**20)
 
 
 class Operation(QtGui.QWidget):
@@ -62,11 +77,59 @@ class Operation(QtGui.QWidget):
             b_current.clicked.connect(self.on_current_linecut)
             layout.addWidget(b_current, height, 2)
 
+        # Read-only field for information returned by the operation, such
+        # as fitted coefficients
+        self.result = None
+        self.le_result = QtGui.QLineEdit()
+        self.le_result.setReadOnly(True)
+        self.le_result.setHidden(True)
+        layout.addWidget(self.le_result, height + 1, 1, 1, 2)
+
+        # Tables such as found peaks can be saved to a file
+        self.b_save_result = QtGui.QPushButton('Save table...')
+        self.b_save_result.clicked.connect(self.on_save_result)
+        self.b_save_result.setHidden(True)
+        layout.addWidget(self.b_save_result, height + 2, 2)
+
     def on_current_linecut(self):
         index = self.items['type'].findText(self.main.canvas.line_type)
         self.items['type'].setCurrentIndex(index)
         self.items['position'].setText(str(self.main.canvas.line_coord))
 
+    def set_result(self, result):
+        """ Show the information that was returned by the operation. """
+        self.result = result
+
+        self.b_save_result.setHidden(not isinstance(result, pd.DataFrame))
+
+        if result is None:
+            self.le_result.setHidden(True)
+            return
+
+        if isinstance(result, pd.DataFrame):
+            text = '%d rows: %s' % (len(result), ', '.join(result.columns))
+        elif isinstance(result, dict):
+            text = ', '.join('%s: %.4g' % (name, value)
+                             for name, value in result.items())
+        elif isinstance(result, np.ndarray):
+            text = ', '.join('%.4g' % value for value in result.ravel())
+        else:
+            text = str(result)
+
+        self.le_result.setText(text)
+        self.le_result.setCursorPosition(0)
+        self.le_result.setHidden(False)
+
+    def on_save_result(self):
+        path = self.main.profile_settings['save_directory']
+        filename = str(QtGui.QFileDialog.getSaveFileName(self,
+                                                         'Save table',
+                                                         path,
+                                                         '*.dat'))
+
+        if filename != '' and isinstance(self.result, pd.DataFrame):
+            self.result.to_csv(filename, sep='\t', index=False)
+
     def get_parameter(self, name):
         """ Return the casted value of a property. """
         if name in self.items:
@@ -116,73 +179,21 @@ class Operations(QtGui.QDialog):
         self.main = parent
         self.columns = None
 
+        # The data after every stage of the queue, keyed by the input data
+        # and the operations up to and including that stage, so that only
+        # the stages after a change have to be recalculated
+        self.cache = LRUCache(max_items=64, max_bytes=2**30,
+                              get_size=lambda item: item[0].nbytes)
+
+        # Timing of every operation during the last run
+        self.trace = []
+
         self.init_ui()
 
     def init_ui(self):
         self.setWindowTitle("Operations")
 
-        # The format of an operation entry is as follows:
-        # 'name': [function, [param1, param2]]
-        # Of which the parameters are tuples:
-        # Number:  ('name', default_value)
-        # Bool:    ('name', default_value)
-        # Options: ('name', [list of string options])
-        self.items = {
-            'abs': [Data2D.abs],
-            'autoflip': [Data2D.autoflip],
-            'crop': [Data2D.crop, [('left', 0),
-                                   ('right', -1),
-                                   ('bottom', 0),
-                                   ('top', -1)]],
-            'dderiv': [Data2D.dderiv, [('theta', 0),
-                                       ('method', [
-                                            'midpoint',
-                                            '2nd order central diff'])]],
-            'equalize': [Data2D.equalize],
-            'even odd': [Data2D.even_odd, [('even', True)]],
-            'flip': [Data2D.flip, [('x_flip', False), ('y_flip', False)]],
-            'gradmag': [Data2D.gradmag, [('method', [
-                                            'midpoint',
-                                            '2nd order central diff'])]],
-            'highpass': [Data2D.highpass, [('x_width', 3.0),
-                                           ('y_height', 3.0), ('method', [
-                                                'gaussian',
-                                                'lorentzian',
-                                                'exponential',
-                                                'thermal'])]],
-            'hist2d': [Data2D.hist2d, [('min', 0.0),
-                                       ('max', 0.0),
-                                       ('bins', 0)]],
-            'interp grid': [Data2D.interp_grid, [('width', 100),
-                                                 ('height', 100)]],
-            'interp x': [Data2D.interp_x, [('points', 100)]],
-            'interp y': [Data2D.interp_y, [('points', 100)]],
-            'log': [Data2D.log, [('subtract', False), ('min', 0.0001)]],
-            'lowpass': [Data2D.lowpass, [('x_width', 3.0),
-                                         ('y_height', 3.0),
-                                         ('method', ['gaussian',
-                                                     'lorentzian',
-                                                     'exponential',
-                                                     'thermal'])]],
-            'negate': [Data2D.negate],
-            'norm y': [Data2D.norm_columns],
-            'norm x': [Data2D.norm_rows],
-            'offset': [Data2D.offset, [('offset', 0.0)]],
-            'offset axes': [Data2D.offset_axes, [('x_offset', 0.0),
-                                                 ('y_offset', 0.0)]],
-            'power': [Data2D.power, [('power', 1.0)]],
-            'scale axes': [Data2D.scale_axes, [('x_scale', 1.0),
-                                               ('y_scale', 1.0)]],
-            'scale data': [Data2D.scale_data, [('factor', 1.0)]],
-            'sub linecut': [Data2D.sub_linecut, [('type', ['horizontal', 'vertical']), ('position', float('nan'))]],
-            'sub linecut avg': [Data2D.sub_linecut_avg, [('type', ['horizontal', 'vertical']), ('position', float('nan')), ('size', 3)]],
-            'sub plane': [Data2D.sub_plane, [('x_slope', 0.0),
-                                             ('y_slope', 0.0)]],
-            'xderiv': [Data2D.xderiv, [('method', ['midpoint',
-                                                   '2nd order central diff'])]],
-            'yderiv': [Data2D.yderiv, [('method', ['midpoint',
-                                                   '2nd order central diff'])]],
-        }
+        self.items = operations
 
         self.options = QtGui.QListWidget(self)
         self.options.addItems(sorted(self.items.keys()))
@@ -212,6 +223,9 @@ class Operations(QtGui.QDialog):
         self.b_save = QtGui.QPushButton('Save...')
         self.b_save.clicked.connect(self.on_save)
 
+        self.b_save_trace = QtGui.QPushButton('Save timing...')
+        self.b_save_trace.clicked.connect(self.on_save_trace)
+
         self.queue = QtGui.QListWidget(self)
         self.queue.currentItemChanged.connect(self.on_selected_changed)
         self.queue.itemClicked.connect(self.on_item_clicked)
@@ -232,6 +246,7 @@ class Operations(QtGui.QDialog):
         vbox.addWidget(self.b_update)
         vbox.addWidget(self.b_load)
         vbox.addWidget(self.b_save)
+        vbox.addWidget(self.b_save_trace)
 
         vbox2 = QtGui.QVBoxLayout()
         vbox2.addWidget(self.queue)
@@ -253,29 +268,18 @@ class Operations(QtGui.QDialog):
     def load(self, filename):
         self.queue.clear()
 
-        with open(filename) as f:
-            operations = json.load(f)
-
-        for i in sorted(operations):
-            operation = operations[i]
-
-            enabled = operation['enabled']
-
-            # The key that doesn't have the value 'enabled' is the name
-            for key in operation:
-                if key != 'enabled':
-                    name = key
-
+        for step in Pipeline.load(filename).steps:
             # Create the item for the operations list
-            item = QtGui.QListWidgetItem(name)
+            item = QtGui.QListWidgetItem(step.name)
 
-            if enabled:
+            if step.enabled:
                 item.setCheckState(QtCore.Qt.Checked)
             else:
                 item.setCheckState(QtCore.Qt.Unchecked)
 
-            op = Operation(name, self.main, *self.items[name])
-            op.set_parameters(operation[name])
+            info = self.items[step.name]
+            op = Operation(step.name, self.main, info.func, info.parameters)
+            op.set_parameters(step.parameters)
 
             # Store the Operation in the widget
             if six.PY2:
@@ -289,7 +293,17 @@ class Operations(QtGui.QDialog):
             self.queue.setCurrentItem(item)
 
     def save(self, filename):
-        operations = {}
+        self.get_pipeline()[0].save(filename)
+
+    def get_pipeline(self):
+        """
+        Return a Pipeline with the operations and parameters in the queue,
+        together with the list of Operation widgets of its steps. The
+        parameters are read from the widgets, so this has to be called
+        from the GUI thread.
+        """
+        steps, ops = [], []
+
         for i in range(self.queue.count()):
             item = self.queue.item(i)
 
@@ -299,50 +313,69 @@ class Operations(QtGui.QDialog):
                 op = item.data(QtCore.Qt.UserRole)
 
             name, params = op.get_parameters()
-            enabled = self.queue.item(i).checkState() == QtCore.Qt.Checked
+            enabled = item.checkState() == QtCore.Qt.Checked
+
+            steps.append(Step(name, params, enabled))
+            ops.append(op)
 
-            operations[i] = {'enabled': enabled}
-            operations[i][name] = params
+        return Pipeline(steps, self.cache), ops
 
-        with open(filename, 'w') as f:
-            f.write(json.dumps(operations, indent=4))
+    def get_linecut(self):
+        """Return the type and position of the current linecut, if any."""
+        canvas = self.main.canvas
 
-    def apply_operations(self, data):
-        copy = data.copy()
+        if canvas.line_coord is not None and canvas.line_type is not None:
+            return canvas.line_type, canvas.line_coord
+
+    def show_results(self, ops, results):
+        """
+        Show the results of the operations, the parameters that were
+        derived from the data such as the default hist2d range, and the
+        time every operation took in the queue.
+        """
+        timings = {}
+
+        for index, params, result, timing in results:
+            op = ops[index]
+
+            for name, value in params.items():
+                if value != op.get_parameter(name):
+                    op.set_parameter(name, value)
+
+            op.set_result(result)
+            timings[op] = timing
 
         for i in range(self.queue.count()):
             item = self.queue.item(i)
 
-            if item.checkState() == QtCore.Qt.Unchecked:
-                continue
-
             if six.PY2:
                 op = item.data(QtCore.Qt.UserRole).toPyObject()
             elif six.PY3:
                 op = item.data(QtCore.Qt.UserRole)
 
-            # Special logic is needed for the hist2 and sub linecut
-            if op.name == 'hist2d':
-                if op.get_parameter('bins') == 0:
-                    bins = np.round(np.sqrt(copy.z.shape[0]))
-                    op.set_parameter('bins', int(bins))
+            if op in timings:
+                item.setText('%s  %s' % (op.name, format_timing(timings[op])))
+            else:
+                item.setText(op.name)
 
-                if op.get_parameter('min') == 0:
-                    min, max = np.nanmin(copy.z), np.nanmax(copy.z)
-                    op.set_parameter('min', min)
-                    op.set_parameter('max', max)
-            elif op.name == 'sub linecut' or op.name == 'sub linecut avg':
-                if (self.main.canvas.line_coord is not None and
-                   self.main.canvas.line_type is not None):
-                    if math.isnan(op.get_parameter('position')):
-                        op.set_parameter('type', self.main.canvas.line_type)
-                        op.set_parameter('position', self.main.canvas.line_coord)
+        self.trace = [timing for index, params, result, timing in results]
 
-            kwargs = op.get_parameters()[1]
+    def on_save_trace(self):
+        path = self.main.profile_settings['save_directory']
+        filename = str(QtGui.QFileDialog.getSaveFileName(self,
+                                                         'Save timing',
+                                                         path,
+                                                         '*.json'))
 
-            op.func(copy, **kwargs)
+        if filename != '':
+            trace = {
+                'filename': self.main.filename,
+                'total': sum(timing['time'] for timing in self.trace),
+                'operations': self.trace,
+            }
 
-        return copy
+            with open(filename, 'w') as f:
+                f.write(json.dumps(trace, indent=4))
 
     def show_window(self):
         self.show()
@@ -362,7 +395,9 @@ class Operations(QtGui.QDialog):
 
             item = QtGui.QListWidgetItem(name)
             item.setCheckState(QtCore.Qt.Checked)
-            operation = Operation(name, self.main, *self.items[name])
+            info = self.items[name]
+            operation = Operation(name, self.main, info.func,
+                                  info.parameters)
 
             if six.PY2:
                 item.setData(QtCore.Qt.UserRole, QtCore.QVariant(operation))
@@ -427,7 +462,7 @@ class Operations(QtGui.QDialog):
 
     def on_select_option(self, current, previous):
         if current:
-            description = self.items[str(current.text())][0].__doc__
+            description = self.items[str(current.text())].description
             self.le_help.setText(description)
 
     def on_selected_changed(self, current, previous):
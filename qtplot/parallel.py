@@ -0,0 +1,65 @@
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+# The amount of threads used for operations that are split into chunks
+threads = multiprocessing.cpu_count()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Marks the threads of the pool, so that nested calls run serially instead
+# of waiting on the threads they are running in
+_local = threading.local()
+
+
+def get_pool():
+    """Return the shared thread pool, creating it when needed."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(threads)
+
+        return _pool
+
+
+def set_threads(n):
+    """Change the amount of threads of the shared thread pool."""
+    global threads, _pool
+
+    with _pool_lock:
+        n = max(1, int(n))
+
+        if n != threads and _pool is not None:
+            _pool.close()
+            _pool = None
+
+        threads = n
+
+
+def chunks(length, size):
+    """Return (start, stop) tuples that divide a range into chunks."""
+    size = max(1, int(size))
+
+    return [(start, min(start + size, length))
+            for start in range(0, length, size)]
+
+
+def thread_map(func, items):
+    """
+    Apply a function to every item using the shared thread pool. The
+    function should spend most of its time in code that releases the GIL,
+    such as numpy and scipy routines.
+    """
+    items = list(items)
+
+    if threads == 1 or len(items) < 2 or getattr(_local, 'in_pool', False):
+        return [func(item) for item in items]
+
+    def run(item):
+        _local.in_pool = True
+
+        return func(item)
+
+    return get_pool().map(run, items)
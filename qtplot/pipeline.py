@@ -0,0 +1,357 @@
+import copy
+import json
+import logging
+import math
+import warnings
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+from .bands import apply_threaded, can_apply_threaded
+from .parallel import chunks, thread_map
+from .registry import operations
+
+logger = logging.getLogger(__name__)
+
+
+def get_defaults(name):
+    """Return an OrderedDict with the default parameters of an operation."""
+    return operations[name].get_defaults()
+
+
+def apply_elementwise(data, steps, chunk_size=2**16):
+    """
+    Apply a list of (name, parameters) elementwise operations to the data.
+    Instead of passing over the whole matrix once for every operation,
+    all operations are applied to one cache-sized block of values before
+    moving on to the next, and the blocks are divided over the threads.
+    The result is identical to applying the operations one by one.
+    """
+    z = data.z
+
+    # Masked and integer data can not be changed in place
+    if isinstance(z, np.ma.MaskedArray) or z.dtype.kind != 'f':
+        for name, params in steps:
+            operations[name].func(data, **params)
+
+        return
+
+    z = np.ascontiguousarray(z)
+    values = z.reshape(-1)
+
+    def apply_block(bounds):
+        block = values[bounds[0]:bounds[1]]
+
+        for name, params in steps:
+            operations[name].elementwise(block, params)
+
+    blocks = chunks(values.size, chunk_size)
+
+    if all(operations[name].thread_safe for name, params in steps):
+        thread_map(apply_block, blocks)
+    else:
+        for bounds in blocks:
+            apply_block(bounds)
+
+    data.z = z
+
+
+def apply_operation(data, name, params):
+    """
+    Apply an operation to the data and return its result. Thread safe
+    operations with a footprint are applied to bands of the data on all
+    threads.
+    """
+    info = operations[name]
+
+    if can_apply_threaded(data, info, params):
+        apply_threaded(data, info, params)
+    else:
+        return info.func(data, **params)
+
+
+def get_preview_factors(shape, max_points, keep_rows=False):
+    """
+    Return the (rows, columns) factors by which data of a shape has to be
+    downsampled to have at most about max_points datapoints, optionally
+    only along the columns.
+    """
+    rows, columns = shape
+    factor = int(math.ceil(math.sqrt(rows * columns / float(max_points))))
+
+    if keep_rows:
+        factor = 1
+
+    # Thin data is only downsampled along its long axis
+    row_factor = max(1, min(factor, rows))
+    column_factor = int(math.ceil(rows * columns /
+                                  float(max_points * row_factor)))
+
+    return row_factor, max(1, min(column_factor, columns))
+
+
+def downsample(data, factors, method='average'):
+    """
+    Return a copy of the data downsampled by (rows, columns) factors,
+    either by taking every n-th datapoint or by averaging blocks of
+    datapoints. Averaging blocks ignores NaN values and drops the lines
+    at the end that do not fill a block.
+    """
+    fy, fx = factors
+    rows, columns = data.z.shape[0] // fy, data.z.shape[1] // fx
+
+    def reduce(a):
+        if method == 'stride':
+            return np.array(a[:rows * fy:fy, :columns * fx:fx])
+
+        blocks = np.ma.filled(a[:rows * fy, :columns * fx], np.nan)
+        blocks = blocks.reshape(rows, fy, columns, fx)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+
+            return np.nanmean(blocks, axis=(1, 3))
+
+    result = copy.copy(data)
+    result.stats = {}
+    result.set_data(reduce(data.x), reduce(data.y), reduce(data.z))
+
+    # Lines of integers can not be averaged
+    for name in ['row_numbers', 'x_setpoints', 'y_setpoints']:
+        a = getattr(data, name)
+
+        if np.shape(a) == data.z.shape:
+            setattr(result, name, np.array(a[:rows * fy:fy, :columns * fx:fx]))
+
+    result.key = ('preview', data.get_key(), tuple(factors), method)
+    result.peaks = None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        result.x_means = np.nanmean(result.x, axis=0)
+        result.y_means = np.nanmean(result.y, axis=1)
+
+    return result
+
+
+class Step(object):
+    """
+    An operation in a pipeline as plain data: its name, a dict of
+    parameters and whether it is enabled.
+    """
+
+    def __init__(self, name, parameters=None, enabled=True):
+        if name not in operations:
+            raise ValueError('Unknown operation: %s' % name)
+
+        self.name = name
+        self.enabled = enabled
+
+        # Parameters that are not given keep their default value
+        self.parameters = get_defaults(name)
+        self.parameters.update(parameters or {})
+
+    @property
+    def info(self):
+        return operations[self.name]
+
+    @property
+    def func(self):
+        return self.info.func
+
+    @property
+    def is_elementwise(self):
+        return self.info.is_elementwise(self.parameters)
+
+    def rescale(self, factors):
+        """
+        Return a copy of the step with the parameters that are given in
+        datapoints scaled for data downsampled by (rows, columns) factors.
+        """
+        params = OrderedDict(self.parameters)
+
+        if self.info.rescale is not None:
+            self.info.rescale(params, factors)
+
+        return Step(self.name, params, self.enabled)
+
+    def resolve(self, data, linecut=None):
+        """
+        Return the parameters with the values that depend on the data, such
+        as the default hist2d range, filled in. The linecut is given as a
+        tuple of (type, position).
+        """
+        params = OrderedDict(self.parameters)
+
+        if self.info.resolve is not None:
+            self.info.resolve(data, params, linecut)
+
+        return params
+
+
+class Pipeline(object):
+    """
+    A sequence of operation steps which can be applied to Data2D objects
+    without any GUI, for example from a script or on a worker thread.
+
+    When a cache is given, the data after every step is kept in it, keyed
+    by the input data and the steps up to and including that step, so that
+    after a change only the steps from the changed one on are applied.
+    Consecutive elementwise steps are applied together and cached as one.
+    """
+
+    def __init__(self, steps=None, cache=None):
+        self.steps = list(steps or [])
+        self.cache = cache
+
+    def get_groups(self):
+        """
+        Return the enabled steps as a list of groups of (index, step)
+        tuples. Consecutive elementwise steps form a single group, all
+        other steps are in a group of their own.
+        """
+        groups = []
+
+        for index, step in enumerate(self.steps):
+            if not step.enabled:
+                continue
+
+            if (step.is_elementwise and len(groups) > 0 and
+               groups[-1][-1][1].is_elementwise):
+                groups[-1].append((index, step))
+            else:
+                groups.append([(index, step)])
+
+        return groups
+
+    def apply(self, data, linecut=None, cancelled=None):
+        """
+        Apply the enabled steps to a copy of the data.
+
+        Returns the data and a list with a (step index, parameters, result,
+        timing) tuple for every applied step, or None if cancelled() became
+        true between two steps. The timing is a dict with the wall time,
+        the shape and size in bytes of the output, whether it came from
+        the cache and with how many steps it was fused.
+        """
+        key = (data.get_key(),)
+        copy = data
+        results = []
+
+        for group in self.get_groups():
+            if cancelled is not None and cancelled():
+                return None
+
+            start = default_timer()
+
+            params = [step.resolve(copy, linecut) for index, step in group]
+
+            for (index, step), p in zip(group, params):
+                key = key + ((step.name, tuple(sorted(p.items()))),)
+
+            cached = self.cache.get(key) if self.cache is not None else None
+
+            # The cached data is never modified, steps work on a copy
+            if cached is None:
+                copy = copy.copy()
+
+                if len(group) > 1:
+                    apply_elementwise(copy, [(step.name, p) for (index, step), p
+                                             in zip(group, params)])
+                    result = None
+                else:
+                    result = apply_operation(copy, group[0][1].name,
+                                             params[0])
+
+                if self.cache is not None:
+                    self.cache.put(key, (copy, result))
+            else:
+                copy, result = cached
+
+            # Fused steps share the time equally, so that the times add up
+            elapsed = (default_timer() - start) / len(group)
+
+            for (index, step), p in zip(group, params):
+                timing = OrderedDict((
+                    ('name', step.name),
+                    ('time', elapsed),
+                    ('shape', list(copy.z.shape)),
+                    ('nbytes', copy.nbytes),
+                    ('cached', cached is not None),
+                    ('fused', len(group)),
+                ))
+
+                logger.debug('%s: %.3f s, %s, %d bytes', step.name, elapsed,
+                             'x'.join(map(str, copy.z.shape)), copy.nbytes,
+                             extra={'timing': timing})
+
+                results.append((index, p, result, timing))
+
+        return copy.copy(), results
+
+    def preview(self, data, max_points=2**18, linecut=None, cancelled=None,
+                method='average'):
+        """
+        Apply the steps to a downsampled copy of the data with at most about
+        max_points datapoints, which is much faster than apply for large
+        data. The parameters that are given in datapoints, such as filter
+        widths and crop indices, are scaled to match the downsampled data.
+
+        Returns the same as apply, the parameters in the results are the
+        scaled ones. Data that is small enough is not downsampled. The rows
+        are not combined if a step treats every row differently.
+        """
+        keep_rows = any(step.info.keep_rows for step in self.steps
+                        if step.enabled)
+        factors = get_preview_factors(data.z.shape, max_points, keep_rows)
+
+        if factors == (1, 1):
+            return self.apply(data, linecut, cancelled)
+
+        key = ('preview', data.get_key(), tuple(factors), method)
+        cached = self.cache.get(key) if self.cache is not None else None
+
+        if cached is None:
+            small = downsample(data, factors, method)
+
+            if self.cache is not None:
+                self.cache.put(key, (small, None))
+        else:
+            small = cached[0]
+
+        preview = Pipeline([step.rescale(factors) for step in self.steps],
+                           self.cache)
+
+        return preview.apply(small, linecut, cancelled)
+
+    def to_dict(self):
+        """Return the steps in the format of the operations .json files."""
+        return dict((str(i), {'enabled': step.enabled,
+                              step.name: dict(step.parameters)})
+                    for i, step in enumerate(self.steps))
+
+    @classmethod
+    def from_dict(cls, operations, cache=None):
+        steps = []
+
+        for i in sorted(operations, key=int):
+            operation = dict(operations[i])
+            enabled = operation.pop('enabled')
+
+            # The key that doesn't have the value 'enabled' is the name
+            name, params = list(operation.items())[0]
+
+            steps.append(Step(name, params, enabled))
+
+        return cls(steps, cache)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(json.dumps(self.to_dict(), indent=4))
+
+    @classmethod
+    def load(cls, filename, cache=None):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f), cache)
@@ -1,7 +1,7 @@
 from __future__ import print_function
 
 from six.moves import configparser
-import numpy as np
+import multiprocessing
 import os
 import logging
 import sys
@@ -9,54 +9,20 @@ from collections import OrderedDict
 
 from PyQt4 import QtGui, QtCore
 
+from . import parallel
 from .colormap import Colormap
-from .data import DatFile, Data2D
+from .data import DatFile, Data2D, triangulation_cache
 from .export import ExportWidget
 from .linecut import Linecut
 from .operations import Operations
+from .registry import load_plugins
 from .settings import Settings
+from .util import profile_defaults
 from .canvas import Canvas
+from .worker import Worker
 
 logger = logging.getLogger(__name__)
 
-profile_defaults = OrderedDict((
-    ('operations', ''),
-    ('sub_series_V', ''),
-    ('sub_series_I', ''),
-    ('sub_series_R', ''),
-    ('open_directory', ''),
-    ('save_directory', ''),
-    ('x', '-'),
-    ('y', '-'),
-    ('z', '-'),
-    ('colormap', 'transform\\Seismic.npy'),
-    ('title', '<filename>'),
-    ('DPI', '80'),
-    ('rasterize', False),
-    ('x_label', '<x>'),
-    ('y_label', '<y>'),
-    ('z_label', '<z>'),
-    ('x_format', '%%.0f'),
-    ('y_format', '%%.0f'),
-    ('z_format', '%%.0f'),
-    ('x_div', '1e0'),
-    ('y_div', '1e0'),
-    ('z_div', '1e0'),
-    ('font', 'Vera Sans'),
-    ('font_size', '12'),
-    ('width', '3'),
-    ('height', '3'),
-    ('cb_orient', 'vertical'),
-    ('cb_pos', '0 0 1 1'),
-    ('triangulation', False),
-    ('tripcolor', False),
-    ('linecut', False),
-    ('line_style', 'solid'),
-    ('line_width', '0.5'),
-    ('marker_style', 'None'),
-    ('marker_size', '6'),
-))
-
 
 class QTPlot(QtGui.QMainWindow):
     """ The main window of the qtplot application. """
@@ -73,6 +39,9 @@ class QTPlot(QtGui.QMainWindow):
         self.abs_filename = None
         self.dat_file = None
 
+        # Show a downsampled preview first for data with more points
+        self.preview_points = 2**18
+
         # In case of a qcodes DataSet(Lite)
         self.data_set = None
 
@@ -84,6 +53,10 @@ class QTPlot(QtGui.QMainWindow):
         self.operations = Operations(self)
         self.settings = Settings(self)
 
+        # Loads and processes the data in the background
+        self.worker = Worker(self.process_data)
+        self.worker.finished.connect(self.on_data_processed)
+
         self.init_ui()
         self.init_settings()
         self.init_logging()
@@ -102,12 +75,17 @@ class QTPlot(QtGui.QMainWindow):
                                                         'profiles')
         self.operations_dir = os.path.join(self.home_dir, '.qtplot',
                                                           'operations')
+        self.cache_dir = os.path.join(self.home_dir, '.qtplot', 'cache')
 
         # Create the program directories if they don't exist yet
-        for dir in [self.settings_dir, self.profiles_dir, self.operations_dir]:
+        for dir in [self.settings_dir, self.profiles_dir, self.operations_dir,
+                    self.cache_dir]:
             if not os.path.exists(dir):
                 os.makedirs(dir)
 
+        # Store triangulations of large datasets between sessions
+        triangulation_cache.directory = self.cache_dir
+
         self.qtplot_ini_file = os.path.join(self.settings_dir, 'qtplot.ini')
 
         defaults = {'default_profile': 'default.ini'}
@@ -567,6 +545,27 @@ class QTPlot(QtGui.QMainWindow):
         except ValueError:
             logger.warning('Could not parse resistance value in the profile')
 
+        try:
+            # The memory in MB used to keep the results of operations
+            size = float(self.profile_settings['cache_size'])
+            self.operations.cache.max_bytes = size * 2**20
+        except ValueError:
+            logger.warning('Could not parse cache size value in the profile')
+
+        try:
+            # Larger data is first shown downsampled, 0 to disable previews
+            self.preview_points = int(self.profile_settings['preview_points'])
+        except ValueError:
+            logger.warning('Could not parse preview points value in the '
+                           'profile')
+
+        try:
+            # The threads used by operations, 0 to use all processors
+            threads = int(self.profile_settings['threads'])
+            parallel.set_threads(threads or multiprocessing.cpu_count())
+        except ValueError:
+            logger.warning('Could not parse threads value in the profile')
+
         self.update_ui(opening_state=True)
 
         self.on_data_change()
@@ -576,10 +575,6 @@ class QTPlot(QtGui.QMainWindow):
         self.export_widget.populate_ui()
         self.linecut.populate_ui()
 
-        # If we are viewing the export tab, update the plot
-        if self.main_widget.currentWidget() == self.export_widget:
-            self.export_widget.on_update()
-
     def get_parameter_names(self):
         if self.dat_file is not None:
             # return list(self.dat_file.df.columns.values)
@@ -607,7 +602,9 @@ class QTPlot(QtGui.QMainWindow):
         or a change/addition of an Operation.
 
         A clean version of the Data2D is retrieved from the DatFile or DataSet,
-        all the operations are applied to the data, and it is plotted.
+        and all the operations are applied to it on a background thread. The
+        canvas keeps showing the previous data until the new data is plotted
+        by on_data_processed.
         """
         if self.dat_file is None and self.data_set is None:
             return
@@ -617,20 +614,69 @@ class QTPlot(QtGui.QMainWindow):
 
         # Update the Data2D from either a qtlab or qcodes dataset
         if self.dat_file is not None:
-            self.data = self.dat_file.get_data(x_name, y_name, data_name)
+            dat_file = self.dat_file
 
-            if self.data is None:
-                return
+            def load():
+                return dat_file.get_data(x_name, y_name, data_name)
         elif self.data_set is not None:
             # Create a Data2D object from qcodes DataSet
             x = self.data_set.arrays[x_name].array
             y = self.data_set.arrays[y_name].array
             z = self.data_set.arrays[data_name].array
 
-            self.data = Data2D(x, y, z)
+            def load():
+                return Data2D(x, y, z)
+
+        # The parameters of the operations are read here on the GUI thread
+        pipeline, ops = self.operations.get_pipeline()
+
+        self.worker.submit(load, pipeline, ops, self.operations.get_linecut(),
+                           self.preview_points)
+
+    def process_data(self, cancelled, load, pipeline, ops, linecut,
+                     preview_points):
+        """
+        Load the data, apply the operations and generate the vertices for
+        the canvas. This runs on the worker thread and stops if the data
+        could not be loaded or a newer request was made.
+
+        Large data is first processed downsampled, which is yielded as a
+        preview before the full resolution result.
+        """
+        data = load()
+
+        if data is None:
+            return
+
+        if 0 < preview_points < data.z.size:
+            output = pipeline.preview(data, preview_points, linecut, cancelled)
+
+            if output is None or cancelled():
+                return
+
+            preview, results = output
+
+            yield (preview, ops, results,
+                   self.canvas.generate_vertices(preview), True)
 
         # Apply the selected operations
-        self.data = self.operations.apply_operations(self.data)
+        output = pipeline.apply(data, linecut, cancelled)
+
+        if output is None or cancelled():
+            return
+
+        data, results = output
+
+        yield data, ops, results, self.canvas.generate_vertices(data), False
+
+    def on_data_processed(self, output):
+        """ Plot the data that was processed on the worker thread. """
+        self.data, ops, results, vertices, is_preview = output
+
+        # The parameters of a preview are scaled to the downsampled data and
+        # should not be shown in the operation widgets
+        if not is_preview:
+            self.operations.show_results(ops, results)
 
         # If we want to reset the colormap for each data update, do so
         if self.cb_reset_cmap.checkState() == QtCore.Qt.Checked:
@@ -638,13 +684,18 @@ class QTPlot(QtGui.QMainWindow):
             self.s_gamma.setValue(0)
             self.on_max_changed(100)
 
-        self.canvas.set_data(self.data)
+        self.canvas.set_data(self.data, vertices)
         # Update the linecut
         self.canvas.draw_linecut(None, old_position=True)
 
-        if np.isnan(self.data.z).any():
+        if not is_preview and self.data.get_stats('z').nan_count > 0:
             logger.warning('The data contains NaN values')
 
+        # If we are viewing the export tab, update the plot with the new data
+        if (not is_preview and
+                self.main_widget.currentWidget() == self.export_widget):
+            self.export_widget.on_update()
+
     def get_axis_names(self):
         """ Get the parameters that are currently selected to be plotted """
         self.x_name = str(self.cb_x.currentText())
@@ -722,7 +773,8 @@ class QTPlot(QtGui.QMainWindow):
 
     def on_min_max_entered(self):
         if self.data is not None:
-            zmin, zmax = np.nanmin(self.data.z), np.nanmax(self.data.z)
+            stats = self.data.get_stats('z')
+            zmin, zmax = stats.min, stats.max
 
             newmin = float(self.le_min.text())
             newmax = float(self.le_max.text())
@@ -738,7 +790,8 @@ class QTPlot(QtGui.QMainWindow):
 
     def on_min_changed(self, value):
         if self.data is not None:
-            min, max = np.nanmin(self.data.z), np.nanmax(self.data.z)
+            stats = self.data.get_stats('z')
+            min, max = stats.min, stats.max
 
             newmin = min + (max - min) * (value / 99.0)
             self.le_min.setText('%.2e' % newmin)
@@ -755,7 +808,8 @@ class QTPlot(QtGui.QMainWindow):
 
     def on_max_changed(self, value):
         if self.data is not None:
-            min, max = np.nanmin(self.data.z), np.nanmax(self.data.z)
+            stats = self.data.get_stats('z')
+            min, max = stats.min, stats.max
 
             # This stuff with the 99 is hacky, something is going on which
             # causes the highest values not to be rendered using the colormap.
@@ -815,6 +869,9 @@ class QTPlot(QtGui.QMainWindow):
 def main():
     app = QtGui.QApplication(sys.argv)
 
+    # The operations of plugins have to be known before the windows are made
+    load_plugins()
+
     if len(sys.argv) > 1:
         QTPlot(filename=sys.argv[1])
     else:
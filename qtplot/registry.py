@@ -0,0 +1,464 @@
+"""
+The registry of all operations that can be applied to Data2D objects.
+
+Besides the function and its parameters, every operation describes how it
+behaves, so that the pipeline, the fusing of elementwise steps, the cache
+and the tiled execution can treat it correctly without knowing it by name.
+
+Operations can be added by plugins: modules that call register() when
+they are imported. Plugins are found through the 'qtplot.operations'
+entry point group of installed packages, and as .py files in the
+~/.qtplot/plugins directory. For example:
+
+    import numpy as np
+    from qtplot.registry import Footprint, register
+
+    def clip(data, low=0.0, high=1.0):
+        data.z = np.clip(data.z, low, high)
+
+    register('clip', clip, [('low', 0.0), ('high', 1.0)],
+             elementwise=lambda z, p: np.clip(z, p['low'], p['high'], out=z),
+             footprint=Footprint())
+"""
+import glob
+import logging
+import math
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import six
+
+from .data import Data2D, normalization_methods
+from .fitting import models, parameter_names
+
+logger = logging.getLogger(__name__)
+
+
+class Footprint(object):
+    """
+    The input that an operation needs for a band of its output.
+
+    axis: 0 if the operation can be applied to bands of rows, 1 if it
+          needs complete columns and is applied to bands of columns.
+    halo: (before, after) amount of neighbouring lines along the axis
+          that are needed, for example by a filter kernel.
+    loss: (before, after) amount of lines along the axis that the
+          operation removes at the edges, for example by a derivative.
+    """
+
+    def __init__(self, axis=0, halo=(0, 0), loss=(0, 0)):
+        self.axis = axis
+        self.halo = halo
+        self.loss = loss
+
+    @property
+    def is_pointwise(self):
+        return (self.axis == 0 and self.halo == (0, 0) and
+                self.loss == (0, 0))
+
+    def get_input(self, start, stop, length):
+        """Return the input lines needed for the output lines start:stop."""
+        return (max(0, start - self.halo[0]),
+                min(length, stop + sum(self.loss) + self.halo[1]))
+
+
+class OperationInfo(object):
+    """
+    An operation and the description of its behaviour.
+
+    func:             Function which modifies a Data2D in place, called
+                      with the parameters as keyword arguments.
+    parameters:       List of (name, default) tuples, the type of the
+                      default determines the widget in the GUI:
+                      Number:  ('name', default_value)
+                      Bool:    ('name', default_value)
+                      Options: ('name', [list of string options])
+    elementwise:      Function (z, params) which applies the operation in
+                      place to a block of values, for operations with a
+                      pointwise footprint.
+    footprint:        Footprint, or a function of the parameters returning
+                      one, if the operation only needs part of the data for
+                      part of its output. None if it needs all of the data.
+    shape_preserving: Whether the output has the shape of the input.
+    thread_safe:      Whether it can be applied to several blocks of data
+                      on different threads at once.
+    resolve:          Function (data, params, linecut) which fills in the
+                      parameters that depend on the data.
+    rescale:          Function (params, factors) which changes parameters
+                      given in datapoints for data that was downsampled by
+                      (rows, columns) factors, used for previews.
+    keep_rows:        Whether the rows should not be combined for previews,
+                      for operations that treat every row differently.
+    """
+
+    def __init__(self, name, func, parameters=None, elementwise=None,
+                 footprint=None, shape_preserving=True, thread_safe=True,
+                 resolve=None, rescale=None, keep_rows=False):
+        self.name = name
+        self.func = func
+        self.parameters = list(parameters or [])
+        self.elementwise = elementwise
+        self.footprint = footprint
+        self.shape_preserving = shape_preserving
+        self.thread_safe = thread_safe
+        self.resolve = resolve
+        self.rescale = rescale
+        self.keep_rows = keep_rows
+
+    @property
+    def description(self):
+        return self.func.__doc__
+
+    def get_defaults(self):
+        """Return an OrderedDict with the default parameters."""
+        return OrderedDict((param, default[0] if type(default) == list
+                            else default)
+                           for param, default in self.parameters)
+
+    def get_footprint(self, params):
+        if callable(self.footprint):
+            return self.footprint(params)
+
+        return self.footprint
+
+    def is_elementwise(self, params):
+        """
+        Whether the elementwise function can be used, which requires the
+        footprint for these parameters to be pointwise.
+        """
+        if self.elementwise is None:
+            return False
+
+        footprint = self.get_footprint(params)
+
+        return footprint is not None and footprint.is_pointwise
+
+
+# All registered operations by name
+operations = {}
+
+# The entry points and files of the plugins that were loaded
+plugins = []
+
+
+def register(name, func, parameters=None, **kwargs):
+    """
+    Add an operation to the registry, see OperationInfo for the arguments.
+    An operation with the same name is replaced.
+    """
+    if name in operations:
+        logger.warning('Replacing the operation %s' % name)
+
+    operations[name] = OperationInfo(name, func, parameters, **kwargs)
+
+    return operations[name]
+
+
+def load_plugins(directory=None):
+    """
+    Import the plugins from the 'qtplot.operations' entry points and the
+    .py files in a directory, by default ~/.qtplot/plugins. A plugin that
+    fails to load is logged and skipped, one that was loaded before is
+    not loaded again.
+    """
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.qtplot',
+                                 'plugins')
+
+    for entry_point in get_entry_points('qtplot.operations'):
+        if entry_point.name in plugins:
+            continue
+
+        try:
+            entry_point.load()
+            plugins.append(entry_point.name)
+        except Exception:
+            logger.exception('Could not load the plugin %s' % entry_point.name)
+
+    for filename in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        if filename in plugins:
+            continue
+
+        name = 'qtplot_plugin_' + os.path.splitext(os.path.basename(filename))[0]
+
+        try:
+            load_source(name, filename)
+            plugins.append(filename)
+        except Exception:
+            sys.modules.pop(name, None)
+            logger.exception('Could not load the plugin %s' % filename)
+
+
+def get_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+
+        return list(pkg_resources.iter_entry_points(group))
+
+    if sys.version_info >= (3, 10):
+        return list(entry_points(group=group))
+
+    return list(entry_points().get(group, []))
+
+
+def load_source(name, filename):
+    if six.PY2:
+        import imp
+
+        return imp.load_source(name, filename)
+
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def resolve_hist2d(data, params, linecut):
+    # A bins of 0 uses sqrt(rows), a min of 0 uses the range of the data
+    if params['bins'] == 0:
+        params['bins'] = int(np.round(np.sqrt(data.z.shape[0])))
+
+    if params['min'] == 0:
+        stats = data.get_stats('z')
+        params['min'], params['max'] = stats.min, stats.max
+
+
+def resolve_linecut(data, params, linecut):
+    # A NaN position uses the linecut, given as a tuple of (type, position)
+    if linecut is not None and math.isnan(params['position']):
+        params['type'], params['position'] = linecut
+
+
+def scale_start(index, factor):
+    """Scale the index of the first line of a range for downsampled data."""
+    return int(math.floor(index / float(factor)))
+
+
+def scale_stop(index, factor):
+    """
+    Scale the index after the last line of a range for downsampled data,
+    negative indices count from the end with -1 as the last line.
+    """
+    if index < 0:
+        return -1 - int(math.floor((-index - 1) / float(factor)))
+
+    return int(math.ceil(index / float(factor)))
+
+
+def scale_count(count, factor, minimum=1):
+    """Scale an amount of datapoints, 0 keeps its special meaning."""
+    if count == 0:
+        return 0
+
+    return max(minimum, int(round(count / float(factor))))
+
+
+def rescale_crop(params, factors):
+    for start, stop, factor in [('left', 'right', factors[1]),
+                                ('bottom', 'top', factors[0])]:
+        params[start] = scale_start(int(params[start]), factor)
+        params[stop] = scale_stop(int(params[stop]), factor)
+
+
+def rescale_filter(params, factors):
+    params['x_width'] = params['x_width'] / float(factors[1])
+    params['y_height'] = params['y_height'] / float(factors[0])
+
+
+def rescale_sub_surface(params, factors):
+    rescale_crop(params, factors)
+
+    params['samples'] = scale_count(int(params['samples']),
+                                    factors[0] * factors[1])
+
+
+def rescale_linecut_avg(params, factors):
+    # Rows are averaged for a horizontal linecut, columns for a vertical one
+    factor = factors[0] if params['type'] == 'horizontal' else factors[1]
+    params['size'] = scale_count(int(params['size']), factor)
+
+
+def rescale_find_peaks(params, factors):
+    # The window, width and distance are along the lines
+    factor = factors[1] if params['lines'] == 'rows' else factors[0]
+
+    params['window'] = scale_count(int(params['window']), factor)
+    params['width'] = params['width'] / float(factor)
+    params['distance'] = params['distance'] / float(factor)
+
+
+def derivative_footprint(p):
+    if p['method'] == 'midpoint':
+        return Footprint(loss=(0, 1))
+    else:
+        return Footprint(loss=(1, 1))
+
+
+def filter_footprint(p):
+    # The half height of the kernel made by create_kernel
+    halo = int(math.floor(p['y_height'] * 7 / 2.0))
+
+    return Footprint(halo=(halo, halo))
+
+
+filter_methods = ['gaussian', 'lorentzian', 'exponential', 'thermal']
+derivative_methods = ['midpoint', '2nd order central diff']
+
+register('abs', Data2D.abs,
+         elementwise=lambda z, p: np.absolute(z, out=z),
+         footprint=Footprint())
+register('affine', Data2D.affine, [('angle', 0.0),
+                                   ('shear', 0.0),
+                                   ('x_scale', 1.0),
+                                   ('y_scale', 1.0),
+                                   ('method', ['linear', 'cubic'])])
+register('align rows', Data2D.align_rows, [('reference', ['mean',
+                                                         'first',
+                                                         'middle']),
+                                           ('max_shift', 0)],
+         rescale=lambda p, f: p.update(max_shift=scale_count(
+             int(p['max_shift']), f[1])))
+register('autoflip', Data2D.autoflip)
+register('crop', Data2D.crop, [('left', 0),
+                               ('right', -1),
+                               ('bottom', 0),
+                               ('top', -1)],
+         shape_preserving=False, rescale=rescale_crop)
+register('dderiv', Data2D.dderiv, [('theta', 0),
+                                   ('method', derivative_methods)],
+         footprint=derivative_footprint, shape_preserving=False)
+register('equalize', Data2D.equalize, [('method', ['histogram',
+                                                   'subsample',
+                                                   'adaptive']),
+                                       ('samples', 100000),
+                                       ('tiles', 8),
+                                       ('clip', 0.0)])
+register('even odd', Data2D.even_odd, [('even', True)],
+         shape_preserving=False, keep_rows=True)
+register('fft band', Data2D.fft_band, [('low', 0.0),
+                                       ('high', 0.0),
+                                       ('type', ['pass', 'stop'])])
+register('fft mask', Data2D.fft_mask, [('x_min', 0.0),
+                                       ('x_max', 0.0),
+                                       ('y_min', 0.0),
+                                       ('y_max', 0.0),
+                                       ('action', ['remove', 'keep'])])
+register('fft notch', Data2D.fft_notch, [('x_freq', 0.0),
+                                         ('y_freq', 0.0),
+                                         ('width', 1.0),
+                                         ('harmonics', 1)])
+register('fft power', Data2D.fft_power, [('log', True)],
+         shape_preserving=False)
+register('find peaks', Data2D.find_peaks, [('lines', ['rows', 'columns']),
+                                           ('window', 5),
+                                           ('prominence', 0.0),
+                                           ('width', 0.0),
+                                           ('distance', 5.0)],
+         rescale=rescale_find_peaks)
+register('fit lines', Data2D.fit_lines, [('model', list(models.keys())),
+                                         ('lines', ['rows', 'columns']),
+                                         ('show', parameter_names +
+                                          ['fit', 'residual'])])
+register('flip', Data2D.flip, [('x_flip', False), ('y_flip', False)])
+register('gradmag', Data2D.gradmag, [('method', derivative_methods)],
+         footprint=derivative_footprint, shape_preserving=False)
+register('highpass', Data2D.highpass, [('x_width', 3.0),
+                                       ('y_height', 3.0),
+                                       ('method', filter_methods)],
+         footprint=filter_footprint, rescale=rescale_filter)
+register('hist2d', Data2D.hist2d, [('min', 0.0),
+                                   ('max', 0.0),
+                                   ('bins', 0)],
+         shape_preserving=False, resolve=resolve_hist2d)
+register('interp grid', Data2D.interp_grid, [('width', 100),
+                                             ('height', 100)],
+         shape_preserving=False,
+         rescale=lambda p, f: p.update(width=scale_count(p['width'], f[1], 2),
+                                       height=scale_count(p['height'], f[0],
+                                                          2)))
+register('interp x', Data2D.interp_x, [('points', 100)],
+         shape_preserving=False,
+         rescale=lambda p, f: p.update(points=scale_count(p['points'], f[1],
+                                                          2)))
+register('interp y', Data2D.interp_y, [('points', 100)],
+         shape_preserving=False,
+         rescale=lambda p, f: p.update(points=scale_count(p['points'], f[0],
+                                                          2)))
+# With subtract the minimum of all data is needed
+register('log', Data2D.log, [('subtract', False), ('min', 0.0001)],
+         elementwise=lambda z, p: np.log10(z, out=z),
+         footprint=lambda p: None if p['subtract'] else Footprint())
+register('lowpass', Data2D.lowpass, [('x_width', 3.0),
+                                     ('y_height', 3.0),
+                                     ('method', filter_methods)],
+         footprint=filter_footprint, rescale=rescale_filter)
+register('negate', Data2D.negate,
+         elementwise=lambda z, p: np.multiply(z, -1, out=z),
+         footprint=Footprint())
+register('norm y', Data2D.norm_columns, [('method', normalization_methods),
+                                         ('lower', 1.0),
+                                         ('upper', 99.0)],
+         footprint=Footprint(axis=1))
+register('norm x', Data2D.norm_rows, [('method', normalization_methods),
+                                      ('lower', 1.0),
+                                      ('upper', 99.0)],
+         footprint=Footprint(axis=0))
+register('offset', Data2D.offset, [('offset', 0.0)],
+         elementwise=lambda z, p: np.add(z, p['offset'], out=z),
+         footprint=Footprint())
+register('offset axes', Data2D.offset_axes, [('x_offset', 0.0),
+                                             ('y_offset', 0.0)],
+         footprint=Footprint())
+register('power', Data2D.power, [('power', 1.0)],
+         elementwise=lambda z, p: np.power(z, p['power'], out=z),
+         footprint=Footprint())
+register('scale axes', Data2D.scale_axes, [('x_scale', 1.0),
+                                           ('y_scale', 1.0)],
+         footprint=Footprint())
+register('scale data', Data2D.scale_data, [('factor', 1.0)],
+         elementwise=lambda z, p: np.multiply(z, p['factor'], out=z),
+         footprint=Footprint())
+register('sub background', Data2D.sub_background, [('lines', ['rows',
+                                                             'columns']),
+                                                   ('method', [
+                                                        'polynomial',
+                                                        'percentile']),
+                                                   ('order', 1),
+                                                   ('percentile', 50.0)],
+         footprint=lambda p: Footprint(axis=0 if p['lines'] == 'rows'
+                                       else 1))
+register('sub linecut', Data2D.sub_linecut, [('type', ['horizontal',
+                                                       'vertical']),
+                                             ('position', float('nan'))],
+         resolve=resolve_linecut)
+register('sub linecut avg', Data2D.sub_linecut_avg, [('type', ['horizontal',
+                                                               'vertical']),
+                                                     ('position',
+                                                      float('nan')),
+                                                     ('size', 3)],
+         resolve=resolve_linecut, rescale=rescale_linecut_avg)
+register('sub plane', Data2D.sub_plane, [('x_slope', 0.0),
+                                         ('y_slope', 0.0)])
+register('sub surface', Data2D.sub_surface, [('order', 1),
+                                             ('samples', 0),
+                                             ('left', 0),
+                                             ('right', -1),
+                                             ('bottom', 0),
+                                             ('top', -1)],
+         rescale=rescale_sub_surface)
+register('symmetrize', Data2D.symmetrize, [('axis', ['y', 'x']),
+                                           ('center', 0.0),
+                                           ('mode', ['symmetric',
+                                                     'antisymmetric'])])
+register('xderiv', Data2D.xderiv, [('method', derivative_methods)],
+         footprint=Footprint(axis=0), shape_preserving=False)
+register('yderiv', Data2D.yderiv, [('method', derivative_methods)],
+         footprint=derivative_footprint, shape_preserving=False)
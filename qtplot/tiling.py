@@ -0,0 +1,325 @@
+"""
+Apply operations to matrices that are too large to fit in memory. The
+matrices are stored in memory-mapped .npy files and every operation is
+applied to one band of rows or columns at a time. Which part of the input
+an operation needs to calculate a band of the output is described by its
+footprint. Bands of columns are read from column-major files, so that
+every band is a contiguous part of the files.
+"""
+import copy
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+from .bands import get_band
+from .data import Data2D
+from .parallel import chunks
+from .pipeline import apply_elementwise, apply_operation
+from .registry import Footprint, operations
+
+logger = logging.getLogger(__name__)
+
+
+def get_footprint(name, params):
+    """Return the footprint of an operation, or None if it has none."""
+    return operations[name].get_footprint(params)
+
+
+def open_memmap(directory, name, dtype, shape, fortran_order=False):
+    path = os.path.join(directory, name + '.npy')
+
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                     shape=shape, fortran_order=fortran_order)
+
+
+def is_column_major(a):
+    """Whether the elements of a column are closer together than a row's."""
+    return abs(a.strides[0]) < abs(a.strides[1])
+
+
+def get_means(x, y, band_bytes):
+    """The column means of x and row means of y, calculated in bands."""
+    if is_column_major(x):
+        y_means, x_means = get_means(y.T, x.T, band_bytes)
+
+        return x_means, y_means
+
+    band_size = max(1, band_bytes // (2 * x.itemsize * x.shape[1]))
+
+    x_sum = np.zeros(x.shape[1])
+    x_count = np.zeros(x.shape[1])
+    y_means = np.empty(y.shape[0])
+
+    for start, stop in chunks(x.shape[0], band_size):
+        band = np.asarray(x[start:stop])
+
+        x_sum += np.nansum(band, axis=0)
+        x_count += np.count_nonzero(~np.isnan(band), axis=0)
+
+        with np.errstate(invalid='ignore'):
+            y_means[start:stop] = np.nanmean(y[start:stop], axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x_sum / x_count, y_means
+
+
+def replace_arrays(data, x, y, z, band_bytes):
+    """Return a shallow copy of the data with other x, y and z matrices."""
+    result = copy.copy(data)
+    result.stats = {}
+    result.set_data(x, y, z)
+    result.key = None
+    result.x_means, result.y_means = get_means(x, y, band_bytes)
+
+    return result
+
+
+def copy_to_memmap(a, directory, name, order='C', band_bytes=2**28):
+    """
+    Copy a matrix into a memory-mapped file in the given order, a square
+    tile at a time.
+    """
+    out = open_memmap(directory, name, a.dtype, a.shape, order == 'F')
+    size = max(1, int(np.sqrt(band_bytes // (2 * a.itemsize))))
+
+    for row_start, row_stop in chunks(a.shape[0], size):
+        for col_start, col_stop in chunks(a.shape[1], size):
+            index = (slice(row_start, row_stop), slice(col_start, col_stop))
+            tile = a[index]
+
+            if isinstance(tile, np.ma.MaskedArray):
+                tile = tile.filled(np.nan)
+
+            out[index] = tile
+
+    out.flush()
+
+    return out
+
+
+def to_memmap(data, directory, name='data', band_bytes=2**28, order='C'):
+    """
+    Return a copy of the data with x, y and z in memory-mapped files, and
+    the setpoints and row numbers if they still belong to the datapoints.
+    """
+    arrays = [copy_to_memmap(getattr(data, axis), directory,
+                             '%s_%s' % (name, axis), order, band_bytes)
+              for axis in ['x', 'y', 'z']]
+
+    result = replace_arrays(data, arrays[0], arrays[1], arrays[2], band_bytes)
+
+    # The columns of the file are not needed anymore
+    result.dat_file = None
+
+    for attr in ['x_setpoints', 'y_setpoints', 'row_numbers']:
+        a = getattr(data, attr)
+
+        if np.shape(a) == data.z.shape and not isinstance(a, np.memmap):
+            setattr(result, attr, copy_to_memmap(a, directory,
+                                                 '%s_%s' % (name, attr),
+                                                 order, band_bytes))
+
+    return result
+
+
+def load_npy(filename, band_bytes=2**28):
+    """
+    Return the data in a matrix saved by Data2D.save as .npy, with x, y
+    and z memory-mapped instead of loaded into memory.
+    """
+    mat = np.load(filename, mmap_mode='r')
+
+    # The matrices are only set afterwards, the constructor would calculate
+    # the means in memory
+    empty = np.zeros((1, 1))
+    data = Data2D(empty, empty, empty, filename=filename)
+
+    return replace_arrays(data, mat[:,:,0], mat[:,:,1], mat[:,:,2],
+                          band_bytes)
+
+
+def apply_banded(data, steps, footprint, directory, name, band_bytes):
+    """
+    Apply a list of (function, parameters) steps with a shared footprint
+    to every band of the data, and write the results to memory-mapped
+    files. Returns the data with the new matrices and the amount of bands.
+    """
+    axis = footprint.axis
+    length = data.z.shape[axis] - sum(footprint.loss)
+
+    if length < 1:
+        raise ValueError('The data is too small for the operation')
+
+    # A band of columns of a row-major file is spread over the whole file,
+    # so the data is first copied into column-major files and vice versa
+    order = 'F' if axis == 1 else 'C'
+    data_in = data
+    converted = None
+
+    if any(is_column_major(a) != (axis == 1)
+           for a in [data.x, data.y, data.z]):
+        data = converted = to_memmap(data, directory, name + '_input',
+                                     band_bytes, order)
+
+    # x, y, z and about as many temporaries for every line
+    line_bytes = 6 * data.z.itemsize * data.z.shape[1 - axis]
+    band_size = max(1, band_bytes // line_bytes - sum(footprint.halo))
+
+    outputs = None
+    bands = chunks(length, band_size)
+
+    for start, stop in bands:
+        first, last = footprint.get_input(start, stop, data.z.shape[axis])
+        band = get_band(data, footprint, first, last)
+
+        for func, params in steps:
+            func(band, **params)
+
+        # Remove the halo, the lines that were lost are not in the band
+        lines = slice(start - first, stop - first)
+        index = (lines, slice(None)) if axis == 0 else (slice(None), lines)
+
+        if outputs is None:
+            outputs = []
+
+            for axis_name in ['x', 'y', 'z']:
+                a = getattr(band, axis_name)
+                shape = list(a.shape)
+                shape[axis] = length
+
+                outputs.append(open_memmap(directory,
+                                           '%s_%s' % (name, axis_name),
+                                           a.dtype, tuple(shape),
+                                           order == 'F'))
+
+        for out, axis_name in zip(outputs, ['x', 'y', 'z']):
+            a = getattr(band, axis_name)
+
+            if isinstance(a, np.ma.MaskedArray):
+                a = a.filled(np.nan)
+
+            if axis == 0:
+                out[start:stop] = a[index]
+            else:
+                out[:, start:stop] = a[index]
+
+    for out in outputs:
+        out.flush()
+
+    result = replace_arrays(data, outputs[0], outputs[1], outputs[2],
+                            band_bytes)
+
+    if converted is not None:
+        remove_files(converted, [data_in, result])
+
+    return result, len(bands)
+
+
+def get_filenames(data):
+    """The files of the memory-mapped matrices of the data."""
+    arrays = [data.x, data.y, data.z, data.x_setpoints, data.y_setpoints,
+              data.row_numbers]
+
+    return set(a.filename for a in arrays
+               if isinstance(a, np.memmap) and a.filename is not None)
+
+
+def remove_files(data, keep=()):
+    """
+    Delete the memory-mapped files of data that is not used anymore, except
+    the files that a list of other data still uses.
+    """
+    kept = set()
+
+    for other in keep:
+        kept.update(get_filenames(other))
+
+    for filename in get_filenames(data) - kept:
+        try:
+            os.remove(filename)
+        except OSError:
+            logger.warning('Could not remove %s' % filename)
+
+
+def apply_tiled(pipeline, data, directory=None, band_bytes=2**28,
+                cancelled=None):
+    """
+    Apply the enabled steps of a pipeline to data that is too large to
+    fit in memory. The data after every step is written to memory-mapped
+    .npy files in the directory, a temporary one by default, and only the
+    files of the final result are kept.
+
+    Steps with a footprint are applied to bands of about band_bytes of
+    input at a time, consecutive elementwise steps are applied to a band
+    at once. Other steps are applied to the whole matrix in memory.
+
+    Returns the data and the results in the same format as Pipeline.apply,
+    with the amount of bands added to the timing.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='qtplot')
+
+    current = data
+    results = []
+
+    for group_index, group in enumerate(pipeline.get_groups()):
+        if cancelled is not None and cancelled():
+            return None
+
+        start = default_timer()
+
+        params = [step.resolve(current, None) for index, step in group]
+        name = 'step%d' % group_index
+
+        if len(group) > 1:
+            # Fused elementwise steps have a pointwise footprint
+            footprint = Footprint()
+            steps = [(apply_elementwise,
+                      {'steps': [(step.name, p) for (index, step), p
+                                 in zip(group, params)]})]
+        else:
+            footprint = get_footprint(group[0][1].name, params[0])
+            steps = [(apply_operation, {'name': group[0][1].name,
+                                        'params': params[0]})]
+
+        if footprint is None:
+            logger.warning('%s can not be applied in bands, the whole matrix '
+                           'is loaded into memory', group[0][1].name)
+
+            result = current.copy()
+            output = steps[0][0](result, **steps[0][1])
+            result = to_memmap(result, directory, name, band_bytes)
+            bands = 1
+        else:
+            result, bands = apply_banded(current, steps, footprint,
+                                         directory, name, band_bytes)
+            output = None
+
+        # Intermediate results are not needed anymore
+        if current is not data:
+            remove_files(current, [data, result])
+
+        current = result
+        elapsed = (default_timer() - start) / len(group)
+
+        for (index, step), p in zip(group, params):
+            timing = OrderedDict((
+                ('name', step.name),
+                ('time', elapsed),
+                ('shape', list(current.z.shape)),
+                ('nbytes', current.nbytes),
+                ('cached', False),
+                ('fused', len(group)),
+                ('bands', bands),
+            ))
+
+            logger.debug('%s: %.3f s in %d bands', step.name, elapsed, bands,
+                         extra={'timing': timing})
+
+            results.append((index, p, output, timing))
+
+    return current, results
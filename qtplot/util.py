@@ -1,6 +1,68 @@
+from six.moves import configparser
 import numpy as np
+from collections import OrderedDict
 from matplotlib.ticker import ScalarFormatter
 
+# The settings of a profile and their default values
+profile_defaults = OrderedDict((
+    ('operations', ''),
+    ('sub_series_V', ''),
+    ('sub_series_I', ''),
+    ('sub_series_R', ''),
+    ('open_directory', ''),
+    ('save_directory', ''),
+    ('x', '-'),
+    ('y', '-'),
+    ('z', '-'),
+    ('colormap', 'transform\\Seismic.npy'),
+    ('title', '<filename>'),
+    ('DPI', '80'),
+    ('rasterize', False),
+    ('x_label', '<x>'),
+    ('y_label', '<y>'),
+    ('z_label', '<z>'),
+    ('x_format', '%%.0f'),
+    ('y_format', '%%.0f'),
+    ('z_format', '%%.0f'),
+    ('x_div', '1e0'),
+    ('y_div', '1e0'),
+    ('z_div', '1e0'),
+    ('font', 'Vera Sans'),
+    ('font_size', '12'),
+    ('width', '3'),
+    ('height', '3'),
+    ('cb_orient', 'vertical'),
+    ('cb_pos', '0 0 1 1'),
+    ('triangulation', False),
+    ('tripcolor', False),
+    ('linecut', False),
+    ('line_style', 'solid'),
+    ('line_width', '0.5'),
+    ('marker_style', 'None'),
+    ('marker_size', '6'),
+    ('cache_size', '1024'),
+    ('threads', '0'),
+    ('preview_points', '262144'),
+))
+
+
+def read_profile(filename):
+    """Read the settings of a profile .ini file into an OrderedDict."""
+    profile_ini = configparser.SafeConfigParser(profile_defaults)
+    profile_ini.read(filename)
+
+    settings = OrderedDict()
+
+    for option in profile_defaults.keys():
+        value = profile_ini.get('DEFAULT', option)
+
+        if value in ['False', 'True']:
+            value = profile_ini.getboolean('DEFAULT', option)
+
+        settings[option] = value
+
+    return settings
+
 
 def eng_format(number, significance):
     if number == 0:
@@ -40,9 +102,16 @@ class FixedOrderFormatter(ScalarFormatter):
 
         return self.format % ((x / self.division) / (10 ** exp))
 
-    def _set_format(self, vmin, vmax):
+    def _set_format(self, *args):
         pass
 
     def _set_orderOfMagnitude(self, range):
         exp = np.floor(np.log10(range / 4 / self.division))
         self.orderOfMagnitude = exp - (exp % 3)
+
+    def _set_order_of_magnitude(self):
+        # Matplotlib 3.1 and newer call this instead of _set_orderOfMagnitude
+        if len(self.locs) > 1 and np.ptp(self.locs) > 0:
+            self._set_orderOfMagnitude(np.ptp(self.locs))
+        else:
+            self.orderOfMagnitude = 0
@@ -0,0 +1,84 @@
+import inspect
+import logging
+import threading
+
+from PyQt4 import QtCore
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(QtCore.QObject):
+    """
+    Calls a function on a background thread and publishes its return value
+    through the finished signal, which is delivered on the GUI thread.
+
+    Only the latest request is kept. The function receives a cancelled()
+    callable as first argument which returns True once a newer request has
+    been made, so that a stale run can stop early. Results of stale runs
+    are never published.
+
+    The function can also be a generator, every value that it yields is
+    published, for example a quick preview before the final result.
+    """
+    finished = QtCore.pyqtSignal(object)
+
+    # Emitted from the background thread with the generation of the run
+    done = QtCore.pyqtSignal(object)
+
+    def __init__(self, func):
+        super(Worker, self).__init__(None)
+
+        self.func = func
+        self.request = None
+        self.generation = 0
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Results arrive on the GUI thread, where the latest request is
+        # checked once more in case a new one was made in the meantime
+        self.done.connect(self.on_done)
+
+    def submit(self, *args):
+        """Request a new run with the given arguments."""
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, args)
+            self.condition.notify()
+
+    def is_stale(self, generation):
+        return generation != self.generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+
+                generation, args = self.request
+                self.request = None
+
+            cancelled = lambda: self.is_stale(generation)
+
+            try:
+                outputs = self.func(cancelled, *args)
+
+                if not inspect.isgenerator(outputs):
+                    outputs = [outputs]
+
+                for output in outputs:
+                    if cancelled():
+                        break
+
+                    if output is not None:
+                        self.done.emit((generation, output))
+            except Exception:
+                logger.exception('Error in background calculation')
+
+    def on_done(self, message):
+        generation, output = message
+
+        if not self.is_stale(generation):
+            self.finished.emit(output)
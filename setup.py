@@ -22,6 +22,7 @@ setup(name='qtplot',
         '': ['*.npy']
       },
       entry_points={
-        'console_scripts': ['qtplot-console = qtplot.qtplot:main'],
+        'console_scripts': ['qtplot-console = qtplot.qtplot:main',
+                            'qtplot-batch = qtplot.batch:main'],
         'gui_scripts': ['qtplot = qtplot.qtplot:main']
       })
@@ -65,9 +65,6 @@ def test_dderiv():
     #kwargs = {'Theta':180,'Method':'midpoint'}
     #equal(Data.dderiv(d_slope_one_y, **kwargs).values, np.zeros((99, 99)))
 
-def test_equalize():
-    pass
-
 def test_even_odd():
     kwargs = {'Even':True}
     equal(Data.even_odd(d_odd_ones, **kwargs).values, np.ones((50,100)))
@@ -81,15 +78,6 @@ def test_gradmag():
     equal(Data.gradmag(d_slope_one_y, **kwargs).values, np.ones((99,99)))
     equal(Data.gradmag(d_slope_min_one_x, **kwargs).values, np.ones((99,99)))
 
-def test_highpass():
-    pass
-
-def test_hist2d():
-    pass
-
-def test_interp_grid():
-    pass
-
 def test_log():
     kwargs = {'Subtract offset':False,'New min':0}
     # log(-1) == NaN
@@ -99,9 +87,6 @@ def test_log():
     # log(1) == log(1)
     equal(Data.log(d_ones, **kwargs).values, np.log(np.ones((100, 100))))
 
-def test_lowpass():
-    pass
-
 def test_neg():
     # -(-1) == 1
     equal(Data.neg(d_min_ones).values, np.ones((100,100)))
@@ -110,12 +95,6 @@ def test_neg():
     # -(1) == -1
     equal(Data.neg(d_ones).values, -np.ones((100,100)))
 
-def test_norm_columns():
-    pass
-
-def test_norm_rows():
-    pass
-
 def test_offset():
     # 0 - 1 == -1
     kwargs = {'Offset':-1}
@@ -127,9 +106,6 @@ def test_offset():
     kwargs = {'Offset':1}
     equal(Data.offset(d_zeros, **kwargs).values, np.ones((100,100)))
 
-def test_offset_axes():
-    pass
-
 def test_power():
     # 1 ^ 0 == 1
     kwargs = {'Power':0}
@@ -147,9 +123,6 @@ def test_power():
     kwargs = {'Power':-1}
     equal(Data.power(d_fours, **kwargs).values, 0.25 * np.ones((100,100)))
 
-def test_scale_axes():
-    pass
-
 def test_scale_data():
     # 0 * 1 = 0
     kwargs = {'Factor':1}
@@ -207,21 +180,12 @@ def test_yderiv():
 if __name__ == '__main__':
     test_abs()
     test_dderiv()
-    test_equalize()
     test_even_odd()
     test_gradmag()
-    test_highpass()
-    test_hist2d()
-    test_interp_grid()
     test_log()
-    test_lowpass()
     test_neg()
-    test_norm_columns()
-    test_norm_rows()
     test_offset()
-    test_offset_axes()
     test_power()
-    test_scale_axes()
     test_scale_data()
     test_sub_linecut()
     test_sub_plane()
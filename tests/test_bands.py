@@ -0,0 +1,95 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from qtplot import bands, parallel
+from qtplot.data import Data2D
+from qtplot.pipeline import Step, apply_elementwise, apply_operation
+from qtplot.registry import operations
+
+x, y = np.meshgrid(np.linspace(0, 1, 150), np.linspace(-1, 2, 130) ** 3)
+z = np.sin(7 * x) * np.cos(5 * y) + 0.1 * np.random.RandomState(0).rand(130, 150) + 1.5
+
+cases = [
+    ('yderiv', {}),
+    ('yderiv', {'method': '2nd order central diff'}),
+    ('xderiv', {}),
+    ('gradmag', {}),
+    ('dderiv', {'theta': 0.4}),
+    ('lowpass', {}),
+    ('highpass', {'x_width': 5.0, 'y_height': 1.0}),
+    ('norm x', {'method': 'z-score'}),
+    ('norm y', {}),
+    ('sub background', {}),
+    ('sub background', {'lines': 'columns'}),
+    ('offset', {'offset': 2.0}),
+    ('offset axes', {'x_offset': 1.0}),
+    ('power', {'power': 2.0}),
+    ('log', {}),
+]
+
+
+def make_data():
+    return Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+
+
+@pytest.fixture
+def threads(monkeypatch):
+    # Divide even small matrices over the threads
+    monkeypatch.setattr(bands, 'min_size', 0)
+    previous = parallel.threads
+
+    yield
+
+    parallel.set_threads(previous)
+
+
+def assert_same(a, b):
+    for name in ['x', 'y', 'z']:
+        A, B = getattr(a, name), getattr(b, name)
+
+        assert type(A) == type(B)
+        npt.assert_allclose(np.ma.filled(A, np.nan), np.ma.filled(B, np.nan),
+                            rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('name, params', cases)
+def test_threaded_equals_serial(threads, name, params):
+    params = Step(name, params).resolve(make_data())
+
+    parallel.set_threads(1)
+    serial = make_data()
+    apply_operation(serial, name, params)
+
+    parallel.set_threads(4)
+    threaded = make_data()
+    assert bands.can_apply_threaded(threaded, operations[name], params)
+    apply_operation(threaded, name, params)
+
+    assert_same(serial, threaded)
+
+
+def test_elementwise_threaded_equals_serial(threads):
+    steps = [('abs', {}), ('offset', {'offset': 1.0}), ('log', {}),
+             ('scale data', {'factor': 2.0})]
+
+    parallel.set_threads(1)
+    serial = make_data()
+    apply_elementwise(serial, steps, chunk_size=1000)
+
+    parallel.set_threads(4)
+    threaded = make_data()
+    apply_elementwise(threaded, steps, chunk_size=1000)
+
+    npt.assert_array_equal(serial.z, threaded.z)
+
+
+def test_bands_cover_output():
+    footprint = operations['lowpass'].get_footprint(
+        operations['lowpass'].get_defaults())
+
+    for length in [1, 17, 100, 1001]:
+        chunks = bands.get_bands(length, footprint, 4)
+
+        assert chunks[0][0] == 0 and chunks[-1][1] == length
+        assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
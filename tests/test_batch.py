@@ -0,0 +1,93 @@
+import json
+import os
+
+import numpy as np
+import numpy.testing as npt
+
+from qtplot.batch import main
+
+equal = npt.assert_array_equal
+
+
+def write_files(directory):
+    with open(os.path.join(directory, 'test.dat'), 'w') as f:
+        f.write('# Filename: test.dat\n# Timestamp: 0\n\n')
+        f.write('# Column 1\n#\tname: gate\n#\tsize: 20\n')
+        f.write('# Column 2\n#\tname: bias\n#\tsize: 15\n')
+        f.write('# Column 3\n#\tname: current\n\n')
+
+        for j in range(15):
+            for i in range(20):
+                f.write('%g\t%g\t%g\n' % (i * 0.1, j * 0.2, np.sin(i * j)))
+
+            f.write('\n')
+
+    with open(os.path.join(directory, 'profile.ini'), 'w') as f:
+        f.write('[DEFAULT]\nx = gate\ny = bias\nz = current\n')
+
+    with open(os.path.join(directory, 'operations.json'), 'w') as f:
+        json.dump({'0': {'enabled': True, 'offset': {'offset': 1.0}},
+                   '1': {'enabled': True, 'abs': {}}}, f)
+
+
+def run(directory, *args):
+    return main([os.path.join(directory, 'profile.ini'),
+                 os.path.join(directory, '*.dat'),
+                 '-o', os.path.join(directory, 'operations.json'),
+                 '-d', os.path.join(directory, 'out'),
+                 '-p', '1'] + list(args))
+
+
+def test_batch(tmp_path):
+    directory = str(tmp_path)
+    write_files(directory)
+
+    assert run(directory, '-m', '.npy', '-m', '.dat', '-f', '.png') == 0
+
+    out = os.path.join(directory, 'out')
+    assert set(os.listdir(out)) == set(['test_matrix.npy', 'test_matrix.dat',
+                                        'test.png'])
+
+    matrix = np.load(os.path.join(out, 'test_matrix.npy'))
+    gate, bias = np.meshgrid(np.arange(20) * 0.1, np.arange(15) * 0.2)
+    current = np.abs(np.sin(np.outer(np.arange(15), np.arange(20))) + 1)
+
+    npt.assert_allclose(matrix[:,:,0], gate)
+    npt.assert_allclose(matrix[:,:,1], bias)
+    npt.assert_allclose(matrix[:,:,2], current, atol=1e-5)
+
+    # The setpoint columns come before the x, y and z columns
+    dat = np.loadtxt(os.path.join(out, 'test_matrix.dat'))
+    assert dat.shape == (300, 5)
+    npt.assert_allclose(np.sort(dat[:,-1]), np.sort(current.ravel()),
+                        atol=1e-5)
+
+
+def test_batch_tiled(tmp_path):
+    directory = str(tmp_path)
+    write_files(directory)
+
+    assert run(directory, '-m', '.npy') == 0
+
+    in_memory = np.load(os.path.join(directory, 'out', 'test_matrix.npy'))
+    os.remove(os.path.join(directory, 'out', 'test_matrix.npy'))
+
+    tiles = os.path.join(directory, 'tiles')
+    assert run(directory, '-m', '.npy', '-t', tiles) == 0
+
+    equal(np.load(os.path.join(directory, 'out', 'test_matrix.npy')),
+          in_memory)
+
+    # The memory-mapped files of the file are removed afterwards
+    assert os.listdir(tiles) == []
+
+
+def test_batch_failed_file(tmp_path):
+    directory = str(tmp_path)
+    write_files(directory)
+
+    with open(os.path.join(directory, 'bad.dat'), 'w') as f:
+        f.write('garbage\n')
+
+    assert run(directory) == 1
+    assert os.listdir(os.path.join(directory, 'out')) == ['test_matrix.dat']
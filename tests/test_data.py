@@ -0,0 +1,641 @@
+import warnings
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from scipy.interpolate import LinearNDInterpolator
+
+from qtplot.data import (Data2D, GridInterpolator, Triangulation,
+                         TriangulationCache, find_line_peaks,
+                         grid_triangulation, interp_lines,
+                         normalization_methods, normalize_lines, track_peaks)
+
+equal = npt.assert_array_equal
+close = npt.assert_allclose
+
+x = np.linspace(-1, 1, 40)
+y = np.linspace(0, 3, 30)
+xc, yc = np.meshgrid(x, y)
+
+
+def make_data(z, x=xc, y=yc):
+    return Data2D(x.copy(), y.copy(), np.array(z, dtype=float),
+                  row_numbers=np.zeros(np.shape(z)))
+
+
+def jittered_grid(rows=60, cols=80, seed=0):
+    """A curvilinear grid with logarithmic x spacing and some jitter."""
+    random = np.random.RandomState(seed)
+
+    x, y = np.meshgrid(np.logspace(-2, 1, cols), np.linspace(0, 1, rows))
+    x = x * (1 + 0.002 * random.randn(rows, cols))
+    y = y + 0.1 * x / 10 + 0.001 * random.randn(rows, cols)
+
+    return x, y
+
+
+def test_grid_triangulation_matches_delaunay():
+    x, y = jittered_grid()
+    z = np.sin(3 * x) * np.cos(4 * y)
+    valid = np.ones(x.shape, dtype=bool)
+
+    tri = grid_triangulation(x, y, valid)
+    assert isinstance(tri, Triangulation)
+    assert len(tri.simplices) == 2 * (x.shape[0] - 1) * (x.shape[1] - 1)
+
+    # Inside a grid cell both interpolate linearly between the corners,
+    # so compare at points on the edges of the cells
+    t = np.linspace(0.1, 0.9, 5)
+    px = x[10, 20] * (1 - t) + x[10, 21] * t
+    py = y[10, 20] * (1 - t) + y[10, 21] * t
+    points = np.column_stack((px, py))
+
+    data = make_data(z, x, y)
+    expected = LinearNDInterpolator(np.column_stack((x.ravel(), y.ravel())),
+                                    z.ravel())(points)
+
+    close(data.interpolate(points.copy()), expected, atol=1e-12)
+
+
+def test_grid_triangulation_masks_invalid_cells():
+    valid = np.ones(xc.shape, dtype=bool)
+    valid[5, 7] = False
+
+    tri = grid_triangulation(xc, yc, valid)
+
+    # The four cells around the point are left out
+    assert len(tri.simplices) == 2 * (29 * 39 - 4)
+    assert len(tri.points) == xc.size - 1
+
+
+def test_grid_triangulation_folded():
+    x = xc.copy()
+    x[:, 20:] = x[:, 20:][:, ::-1]
+
+    assert grid_triangulation(x, yc, np.ones(x.shape, dtype=bool)) is None
+
+
+def test_find_simplex_locates_every_point():
+    x, y = jittered_grid(120, 160)
+    data = make_data(x + y, x, y)
+
+    # Every grid point and the center of every cell is inside the mesh
+    centers_x = (x[:-1, :-1] + x[1:, 1:] + x[:-1, 1:] + x[1:, :-1]) / 4
+    centers_y = (y[:-1, :-1] + y[1:, 1:] + y[:-1, 1:] + y[1:, :-1]) / 4
+    points = np.vstack((np.column_stack((x.ravel(), y.ravel())),
+                        np.column_stack((centers_x.ravel(),
+                                         centers_y.ravel()))))
+
+    values = data.interpolate(points.copy())
+
+    assert not np.isnan(values).any()
+    close(values, points[:, 0] + points[:, 1], atol=1e-9)
+
+
+def test_find_simplex_outside():
+    x, y = jittered_grid()
+    tri = grid_triangulation((x - x.min()) / np.ptp(x),
+                             (y - y.min()) / np.ptp(y),
+                             np.ones(x.shape, dtype=bool))
+
+    equal(tri.find_simplex(np.array([[-0.5, 0.5], [0.5, 1.5]])), [-1, -1])
+
+
+def test_triangulation_cache_shares_normalized_coordinates():
+    cache = TriangulationCache()
+    valid = np.ones(xc.shape, dtype=bool)
+
+    first = cache.get_triangulation(xc, yc, valid)
+    assert cache.get_triangulation(xc.copy(), yc.copy(), valid) is first
+    assert cache.get_triangulation(xc, yc * 2, valid) is not first
+
+
+def test_triangulation_cache_on_disk(tmp_path):
+    valid = np.ones(xc.shape, dtype=bool)
+
+    cache = TriangulationCache(directory=str(tmp_path), min_points=0)
+    first = cache.get_triangulation(xc, yc, valid)
+
+    other = TriangulationCache(directory=str(tmp_path), min_points=0)
+    second = other.get_triangulation(xc, yc, valid)
+
+    equal(first.simplices, second.simplices)
+    equal(first.points, second.points)
+
+
+def test_grid_interpolator():
+    z = 2 * xc + 3 * yc
+    interpolator = GridInterpolator(x, y, z)
+
+    points = np.array([[0.0, 1.0], [0.31, 2.17], [-1.0, 0.0], [1.0, 3.0]])
+    close(interpolator(points), 2 * points[:, 0] + 3 * points[:, 1])
+
+    outside = interpolator(np.array([[1.5, 1.0], [0.0, -0.1]]))
+    assert np.isnan(outside).all()
+
+
+def test_grid_interpolator_descending_axes():
+    z = 2 * xc + 3 * yc
+    points = np.array([[0.0, 1.0], [0.31, 2.17], [-0.99, 0.01]])
+
+    for flip_x, flip_y in [(True, False), (False, True), (True, True)]:
+        xs = x[::-1] if flip_x else x
+        ys = y[::-1] if flip_y else y
+        xv, yv = np.meshgrid(xs, ys)
+
+        interpolator = GridInterpolator(xs, ys, 2 * xv + 3 * yv)
+        close(interpolator(points), 2 * points[:, 0] + 3 * points[:, 1])
+
+
+def test_interpolate_uses_grid():
+    data = make_data(xc * yc)
+    data.generate_interpolator()
+
+    assert isinstance(data.interpolator, GridInterpolator)
+
+
+def test_interp_grid():
+    data = make_data(2 * xc + 3 * yc)
+    data.interp_grid(25, 17)
+
+    assert data.z.shape == (17, 25)
+    close(data.x[0], np.linspace(-1, 1, 25))
+    close(data.y[:, 0], np.linspace(0, 3, 17))
+    close(data.z, 2 * data.x + 3 * data.y, atol=1e-12)
+
+
+def test_interp_grid_chunks():
+    data = make_data(np.sin(xc) * yc)
+    chunked = data.copy()
+
+    data.interp_grid(51, 33)
+    chunked.interp_grid(51, 33, chunk_size=100)
+
+    equal(data.z, chunked.z)
+
+
+def nan_matrix(seed=0):
+    random = np.random.RandomState(seed)
+    z = random.randn(30, 40) * 3 + 2
+    z[random.rand(30, 40) < 0.1] = np.nan
+    z[4] = np.nan
+
+    return z
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_normalize_lines(axis):
+    z = nan_matrix()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        mean = np.nanmean(z, axis=axis, keepdims=True)
+        low = np.nanmin(z, axis=axis, keepdims=True)
+        high = np.nanmax(z, axis=axis, keepdims=True)
+        median = np.nanmedian(z, axis=axis, keepdims=True)
+        std = np.nanstd(z, axis=axis, keepdims=True)
+        p1, p99 = np.nanpercentile(z, [1, 99], axis=axis, keepdims=True)
+
+    expected = {
+        'min-max': (z - low) / (high - low),
+        'z-score': (z - mean) / std,
+        'percentile clip': (np.clip(z, p1, p99) - p1) / (p99 - p1),
+        'divide median': z / median,
+        'subtract mean': z - mean,
+    }
+
+    for method in normalization_methods:
+        result = normalize_lines(z.copy(), axis, method)
+
+        close(result, expected[method], atol=1e-12)
+
+
+def test_norm_rows_and_columns():
+    z = nan_matrix()
+
+    rows = make_data(z)
+    rows.norm_rows('min-max')
+    close(np.nanmin(rows.z[5:], axis=1), 0)
+    close(np.nanmax(rows.z[5:], axis=1), 1)
+
+    columns = make_data(z)
+    columns.norm_columns('z-score')
+    close(np.nanmean(columns.z, axis=0)[np.isfinite(columns.z).any(axis=0)],
+          0, atol=1e-12)
+
+
+def test_normalize_unknown_method():
+    with pytest.raises(ValueError):
+        normalize_lines(np.ones((3, 3)), 1, 'unknown')
+
+
+def test_sub_background_polynomial():
+    # Rows with a different quadratic background and NaN values
+    a, b, c = [np.linspace(-1, 1, 30)[:, np.newaxis] * s for s in (1, 2, 3)]
+    z = a + b * xc + c * xc**2
+    z[3, 5:9] = np.nan
+
+    data = make_data(z)
+    data.sub_background('rows', 'polynomial', order=2)
+
+    close(data.z[np.isfinite(z)], 0, atol=1e-10)
+    assert np.isnan(data.z[3, 5:9]).all()
+
+
+def test_sub_background_columns():
+    z = np.linspace(1, 2, 40)[np.newaxis, :] * yc + np.arange(40)
+
+    data = make_data(z)
+    data.sub_background('columns', 'polynomial', order=1)
+
+    close(data.z, 0, atol=1e-10)
+
+
+def test_sub_background_percentile():
+    z = np.arange(30)[:, np.newaxis] + xc
+
+    data = make_data(z)
+    data.sub_background('rows', 'percentile', percentile=50.0)
+
+    close(data.z, xc - np.median(x), atol=1e-12)
+
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_sub_surface(order):
+    x0, y0 = 0.0, 1.5
+    z = 1.0 + 0.5 * (xc - x0) - 2 * (yc - y0)
+
+    if order > 1:
+        z += 0.3 * (xc - x0) * (yc - y0) - (xc - x0)**2
+    if order > 2:
+        z += 0.1 * (yc - y0)**3
+
+    data = make_data(z)
+    coefficients = data.sub_surface(order)
+
+    close(data.z, 0, atol=1e-10)
+    close(coefficients['c'], 1.0)
+    close(coefficients['x'], 0.5)
+    close(coefficients['y'], -2.0)
+
+
+def test_sub_surface_region_and_samples():
+    z = 0.5 * xc - 2 * yc
+    z[:10] += 100
+
+    data = make_data(z)
+    data.sub_surface(1, samples=200, bottom=10)
+
+    close(data.z[10:], data.z[10, 0], atol=1e-10)
+    close(data.z[:10], data.z[10, 0] + 100, atol=1e-10)
+
+
+def test_align_rows():
+    n = 200
+    t = np.arange(n, dtype=float)
+    shifts = np.array([0, 3, -5, 7.5, -2.25, 11, 0.5, -8])
+
+    z = np.exp(-((t[np.newaxis, :] - 100 - shifts[:, np.newaxis]) / 6)**2)
+    xv, yv = np.meshgrid(t, np.arange(len(shifts), dtype=float))
+
+    data = make_data(z, xv, yv)
+    found = data.align_rows('first')
+
+    close(found, shifts - shifts[0], atol=0.1)
+
+    # The aligned rows all peak at the position of the first
+    peaks = np.nanargmax(data.z, axis=1)
+    assert np.all(np.abs(peaks - peaks[0]) <= 1)
+
+
+def test_align_rows_max_shift():
+    t = np.arange(100, dtype=float)
+    z = np.exp(-((t[np.newaxis, :] - 50 - np.array([[0], [20]])) / 3)**2)
+    xv, yv = np.meshgrid(t, [0.0, 1.0])
+
+    data = make_data(z, xv, yv)
+    found = data.align_rows('first', max_shift=5)
+
+    assert np.all(np.abs(found) <= 5.5)
+
+
+def wave(fx, fy, x=xc, y=yc):
+    return np.cos(2 * np.pi * (fx * x + fy * y))
+
+
+def test_fft_band():
+    # Frequencies on the grid of the transform are removed exactly
+    xv, yv = np.meshgrid(np.arange(64) / 64.0, np.arange(32) / 32.0)
+    low, high = wave(2, 0, xv, yv), wave(10, 0, xv, yv)
+
+    data = make_data(low + high, xv, yv)
+    data.fft_band(low=5, high=0, type='stop')
+    close(data.z, low, atol=1e-12)
+
+    data = make_data(low + high, xv, yv)
+    data.fft_band(low=5, high=0, type='pass')
+    close(data.z, high, atol=1e-12)
+
+
+def test_fft_notch():
+    xv, yv = np.meshgrid(np.arange(64) / 64.0, np.arange(32) / 32.0)
+    signal, noise = wave(2, 1, xv, yv), wave(0, 8, xv, yv)
+
+    data = make_data(signal + noise + 1, xv, yv)
+    data.fft_notch(y_freq=8, width=0.5)
+    close(data.z, signal + 1, atol=1e-6)
+
+
+def test_fft_notch_defaults_do_nothing():
+    z = wave(2, 1) + 5
+
+    data = make_data(z)
+    data.fft_notch()
+
+    equal(data.z, z)
+
+
+def test_fft_keeps_nan():
+    z = wave(2, 1)
+    z[3, 4] = np.nan
+
+    data = make_data(z)
+    data.fft_band(low=1, high=0, type='pass')
+
+    assert np.isnan(data.z[3, 4])
+    assert np.isnan(data.z).sum() == 1
+
+
+def test_fft_power():
+    xv, yv = np.meshgrid(np.arange(64) / 64.0, np.arange(32) / 32.0)
+
+    data = make_data(wave(4, 0, xv, yv), xv, yv)
+    data.fft_power(log=False)
+
+    assert data.z.shape == (32, 33)
+    row, col = np.unravel_index(np.argmax(data.z), data.z.shape)
+    assert (data.x[row, col], data.y[row, col]) == (4, 0)
+
+
+@pytest.mark.parametrize('method', ['histogram', 'subsample'])
+def test_equalize(method):
+    random = np.random.RandomState(0)
+    z = random.exponential(size=(30, 40))
+    z[0, 0] = np.nan
+
+    data = make_data(z)
+    data.equalize(method, samples=500)
+
+    # The values keep their order and become uniformly distributed
+    valid = np.isfinite(z)
+    order = np.argsort(z[valid])
+    assert np.all(np.diff(data.z[valid][order]) >= -1e-9)
+
+    quantiles = np.nanpercentile(data.z, [25, 50, 75])
+    low, high = np.nanmin(z), np.nanmax(z)
+    close((quantiles - low) / (high - low), [0.25, 0.5, 0.75], atol=0.05)
+    assert np.isnan(data.z[0, 0])
+
+
+def test_equalize_adaptive():
+    random = np.random.RandomState(0)
+    z = random.rand(64, 64) + np.linspace(0, 10, 64)[np.newaxis, :]
+
+    data = make_data(z, *np.meshgrid(np.arange(64.0), np.arange(64.0)))
+    data.equalize('adaptive', tiles=4)
+
+    # Every tile is mapped onto the whole range, which removes most of the
+    # gradient that a global mapping would keep
+    left, right = data.z[:, :16].mean(), data.z[:, 48:].mean()
+    assert right - left < 0.5 * (z[:, 48:].mean() - z[:, :16].mean())
+
+
+def test_find_line_peaks():
+    t = np.arange(400.0)
+    z = (1 / (1 + ((t - 100) / 5.0)**2) +
+         0.5 / (1 + ((t - 300) / 15.0)**2))[np.newaxis, :].repeat(3, axis=0)
+
+    rows, cols, prominences, widths = find_line_peaks(z, window=60)
+
+    equal(rows, [0, 0, 1, 1, 2, 2])
+    equal(cols, [100, 300] * 3)
+    close(prominences[:2], [0.99, 0.47], atol=0.01)
+
+    # The width at half prominence is close to the full width at half
+    # maximum for a prominence close to the height
+    close(widths[0], 10, atol=0.2)
+    assert widths[1] > 2 * widths[0]
+
+    rows, cols, prominences, widths = find_line_peaks(z, window=60, width=20)
+    equal(cols, [300] * 3)
+
+    rows, cols, prominences, widths = find_line_peaks(z, window=60,
+                                                      prominence=0.6)
+    equal(cols, [100] * 3)
+
+
+def test_find_line_peaks_nan():
+    z = np.array([[0, 1, 0, np.nan, 0, 3, 0, 0]], dtype=float)
+
+    rows, cols, prominences, widths = find_line_peaks(z, window=2)
+
+    equal(cols, [1, 5])
+    close(prominences, [1, 3])
+
+
+def test_track_peaks():
+    lines = np.array([0, 0, 1, 1, 2, 2, 3])
+    positions = np.array([10, 50, 11, 49, 13, 90, 14])
+
+    tracks = track_peaks(lines, positions, 5)
+
+    equal(tracks[[0, 2, 4, 6]], tracks[0])
+    equal(tracks[[1, 3]], tracks[1])
+    assert len(set(tracks)) == 3
+
+
+def test_track_peaks_closest_wins():
+    tracks = track_peaks(np.array([0, 1, 1]), np.array([10, 12, 9]), 5)
+
+    assert tracks[2] == tracks[0]
+    assert tracks[1] != tracks[0]
+
+
+def test_find_peaks():
+    t = np.arange(200.0)
+    centers = 80 + 0.4 * np.arange(30)
+    z = 1 / (1 + ((t[np.newaxis, :] - centers[:, np.newaxis]) / 4.0)**2)
+    xv, yv = np.meshgrid(t, np.arange(30.0))
+
+    data = make_data(z, xv, yv)
+    peaks = data.find_peaks('rows', window=20, distance=2)
+
+    assert len(peaks) == 30
+    equal(peaks['x'], np.round(centers))
+    assert len(set(peaks['track'])) == 1
+    close(peaks['width'], 8, atol=0.5)
+
+    # A shorter tracking distance than the drift splits the tracks
+    peaks = data.find_peaks('rows', window=20, distance=0.1)
+    assert len(set(peaks['track'])) > 1
+
+
+def test_find_peaks_columns():
+    t = np.arange(100.0)
+    z = np.exp(-((t[:, np.newaxis] - 40) / 3.0)**2).repeat(5, axis=1)
+    xv, yv = np.meshgrid(np.arange(5.0), t)
+
+    data = make_data(z, xv, yv)
+    peaks = data.find_peaks('columns', window=10)
+
+    equal(peaks['y'], [40] * 5)
+    equal(peaks['line'], np.arange(5))
+
+
+def test_peaks_dropped_with_coordinates():
+    t = np.arange(50.0)
+    xv, yv = np.meshgrid(t, np.arange(4.0))
+
+    data = make_data(np.exp(-((xv - 25) / 3.0)**2), xv, yv)
+    data.find_peaks()
+    assert data.peaks is not None
+
+    data.crop(left=5)
+    assert data.peaks is None
+
+
+def test_interp_lines():
+    random = np.random.RandomState(0)
+    t = np.sort(random.rand(5, 30), axis=1)
+    z = random.rand(5, 30)
+    q = random.rand(5, 40) * 1.2 - 0.1
+
+    result = interp_lines(t, z, q)
+
+    for i in range(5):
+        expected = np.interp(q[i], t[i], z[i], left=np.nan, right=np.nan)
+        close(result[i], expected, atol=1e-12)
+
+
+def test_interp_lines_unsorted_and_nan():
+    t = np.array([[3.0, 1.0, np.nan, 2.0], [np.nan] * 4])
+    z = np.array([[30.0, 10.0, 99.0, 20.0], [1.0, 2.0, 3.0, 4.0]])
+    q = np.array([[1.5, 2.5, 0.5, np.nan], [1.0, 2.0, 3.0, 4.0]])
+
+    result = interp_lines(t, z, q)
+
+    close(result[0, :2], [15.0, 25.0])
+    assert np.isnan(result[0, 2:]).all()
+    assert np.isnan(result[1]).all()
+
+
+def test_symmetrize():
+    z = np.sin(3 * yc) * xc + np.cos(2 * xc) * (yc - 1.5)**2
+
+    data = make_data(z)
+    data.symmetrize('x', 0.0, 'symmetric')
+    close(data.z, np.cos(2 * xc) * (yc - 1.5)**2, atol=1e-12)
+
+    data = make_data(z)
+    data.symmetrize('x', 0.0, 'antisymmetric')
+    close(data.z, np.sin(3 * yc) * xc, atol=1e-12)
+
+
+def test_symmetrize_y():
+    # The mirrored coordinates fall between the datapoints
+    z = (yc - 1.5)**2
+
+    data = make_data(z)
+    data.symmetrize('y', 1.4, 'antisymmetric')
+
+    inside = np.abs(yc - 1.4) <= 1.4
+    mirrored = (2 * 1.4 - yc - 1.5)**2
+    close(data.z[inside], ((z - mirrored) / 2)[inside], atol=0.01)
+    assert np.isnan(data.z[~inside]).all()
+
+
+def test_affine_identity():
+    z = np.sin(3 * xc) * yc
+
+    for method in ['linear', 'cubic']:
+        data = make_data(z)
+        data.affine(method=method)
+
+        close(data.z, z, atol=1e-12)
+
+
+def test_affine_physical_angle():
+    # The spacing of x and y is very different, a line at 45 degrees in
+    # the plotted coordinates should be rotated onto the x axis
+    xv, yv = np.meshgrid(np.linspace(0, 10, 201), np.linspace(0, 1, 101))
+    slope = 0.1
+    z = np.exp(-((yv - 0.5 - slope * (xv - 5)) / 0.02)**2)
+
+    data = make_data(z, xv, yv)
+    data.affine(angle=-np.degrees(np.arctan(slope)))
+
+    columns = slice(60, 140)
+    rows = np.nanargmax(np.nan_to_num(data.z[:, columns]), axis=0)
+    equal(yv[rows, 0], 0.5)
+
+
+def test_affine_rotation_quarter():
+    xv, yv = np.meshgrid(np.arange(21.0), np.arange(21.0))
+    z = xv.copy()
+
+    data = make_data(z, xv, yv)
+    data.affine(angle=90)
+
+    # A rotation by 90 degrees around the center turns x into y
+    close(data.z, yv, atol=1e-9)
+
+
+def test_affine_keeps_nan():
+    z = np.sin(3 * xc) * yc
+    z[10, 10] = np.nan
+
+    data = make_data(z)
+    data.affine(x_scale=1.0)
+
+    assert np.isnan(data.z[10, 10])
+    assert np.isnan(data.z).sum() == 1
+
+
+def test_stats():
+    z = np.arange(12.0).reshape(3, 4)
+    z[1, 1] = np.nan
+
+    data = make_data(z, *np.meshgrid(np.arange(4.0), np.arange(3.0)))
+    stats = data.get_stats('z')
+
+    assert (stats.min, stats.max, stats.nan_count) == (0, 11, 1)
+    close(stats.percentile(50), np.nanpercentile(z, 50))
+    assert data.get_stats('z') is stats
+
+
+def test_stats_discarded_on_change():
+    data = make_data(xc + yc)
+    stats = data.get_stats('z')
+    x_stats = data.get_stats('x')
+
+    data.z = data.z * 2
+
+    assert data.get_stats('z') is not stats
+    assert data.get_stats('z').max == 2 * stats.max
+    assert data.get_stats('x') is x_stats
+
+
+def test_lowpass_and_highpass():
+    z = (np.sin(5 * xc) * np.cos(3 * yc) +
+         0.1 * np.random.RandomState(0).rand(*xc.shape))
+
+    # Widths that are not whole numbers give fractional kernel sizes
+    low = make_data(z)
+    low.lowpass(x_width=2.5, y_height=1.5)
+    high = make_data(z)
+    high.highpass(x_width=2.5, y_height=1.5)
+
+    close(low.z + high.z, z)
+    assert (np.abs(np.diff(low.z, axis=1)).mean() <
+            np.abs(np.diff(z, axis=1)).mean())
@@ -0,0 +1,95 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from qtplot import fitting
+from qtplot.data import Data2D
+from qtplot.fitting import fit_lines, fit_lines_serial, fano, lorentzian
+
+close = npt.assert_allclose
+
+t = np.linspace(-10, 10, 201)
+centers = np.linspace(-3, 3, 40)
+widths = np.linspace(1, 2, 40)
+
+x, y = np.meshgrid(t, np.arange(40.0))
+z = lorentzian(x, centers[:, np.newaxis], widths[:, np.newaxis], 2.0, 0.5)
+z += 0.001 * np.random.RandomState(0).randn(*z.shape)
+
+
+def test_fit_lorentzian():
+    params, residuals = fit_lines_serial('lorentzian', x, z)
+
+    close(params[:, 0], centers, atol=1e-3)
+    close(params[:, 1], widths, atol=1e-2)
+    close(params[:, 2], 2.0, atol=1e-2)
+    close(params[:, 3], 0.5, atol=1e-3)
+    assert np.all(residuals < 0.002)
+
+
+def test_fit_fano():
+    z = fano(t, 1.0, 2.0, 1.0, 0.0, 2.0)[np.newaxis, :].repeat(3, axis=0)
+
+    params, residuals = fit_lines_serial('fano', x[:3], z)
+
+    # Different parameters can give the same lineshape, compare the fits
+    close(params[:, :2], [[1.0, 2.0]] * 3, atol=1e-6)
+    close(fano(x[:3], *[p[:, np.newaxis] for p in params.T]), z, atol=1e-6)
+
+
+def test_fit_nan_line():
+    nan = z[:3].copy()
+    nan[1] = np.nan
+    nan[2, :50] = np.nan
+
+    params, residuals = fit_lines_serial('lorentzian', x[:3], nan)
+
+    assert np.isnan(params[1]).all() and np.isnan(residuals[1])
+    close(params[2, 0], centers[2], atol=1e-3)
+
+
+def test_pool_equals_serial():
+    serial = fit_lines('lorentzian', x, z, processes=1)
+    pooled = fit_lines('lorentzian', x, z, processes=2, chunk_size=8)
+
+    # The bands start from a guess instead of the previous row
+    close(pooled[0], serial[0], atol=1e-6)
+    close(pooled[1], serial[1], atol=1e-6)
+
+    # The pool is kept for the next fit
+    pool = fitting.get_pool(2)
+    fit_lines('lorentzian', x, z, processes=2, chunk_size=8)
+    assert fitting.get_pool(2) is pool
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        fit_lines('unknown', x, z)
+
+
+def test_fit_lines_maps():
+    data = Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+
+    center = data.copy()
+    center.fit_lines('lorentzian', 'rows', 'center')
+    close(center.z, centers[:, np.newaxis].repeat(201, axis=1), atol=1e-3)
+
+    residual = data.copy()
+    residual.fit_lines('lorentzian', 'rows', 'residual')
+    assert np.abs(residual.z).max() < 0.005
+
+
+def test_fit_columns():
+    data = Data2D(y.T.copy(), x.T.copy(), z.T.copy(),
+                  row_numbers=np.zeros_like(z.T))
+
+    data.fit_lines('lorentzian', 'columns', 'width')
+    close(data.z, widths[np.newaxis, :].repeat(201, axis=0), atol=1e-2)
+
+
+def test_missing_parameter(caplog):
+    data = Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+    data.fit_lines('lorentzian', 'rows', 'asymmetry')
+
+    assert 'showing the center instead' in caplog.text
+    close(data.z[:, 0], centers, atol=1e-3)
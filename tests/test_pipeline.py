@@ -0,0 +1,206 @@
+import logging
+
+import numpy as np
+import numpy.testing as npt
+
+from qtplot.cache import LRUCache
+from qtplot.data import Data2D, DatFile
+from qtplot.pipeline import Pipeline, Step
+
+equal = npt.assert_array_equal
+
+x, y = np.meshgrid(np.linspace(0, 1, 120), np.linspace(-1, 2, 90))
+z = np.sin(7 * x) * np.cos(5 * y) + 1.5
+
+
+class CountingCache(LRUCache):
+    """Counts the results that are stored, which are the cache misses."""
+
+    def __init__(self, *args, **kwargs):
+        LRUCache.__init__(self, *args, **kwargs)
+        self.puts = 0
+
+    def put(self, key, value):
+        self.puts += 1
+        LRUCache.put(self, key, value)
+
+
+def make_data():
+    return Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+
+
+def write_dat(path):
+    with open(str(path), 'w') as f:
+        f.write('# Filename: test.dat\n# Timestamp: 0\n\n')
+        f.write('# Column 1\n#\tname: gate\n#\tsize: 20\n')
+        f.write('# Column 2\n#\tname: bias\n#\tsize: 15\n')
+        f.write('# Column 3\n#\tname: current\n\n')
+
+        for j in range(15):
+            for i in range(20):
+                f.write('%g\t%g\t%g\n' % (i * 0.1, j * 0.2, i * j))
+
+    return DatFile(str(path))
+
+
+def test_fused_equals_unfused():
+    steps = [Step('abs'), Step('offset', {'offset': 1.0}), Step('log'),
+             Step('scale data', {'factor': 2.0}), Step('negate')]
+
+    pipeline = Pipeline(steps)
+    assert len(pipeline.get_groups()) == 1
+
+    fused, _ = pipeline.apply(make_data())
+
+    unfused = make_data()
+
+    for step in steps:
+        unfused, _ = Pipeline([step]).apply(unfused)
+
+    for name in ['x', 'y', 'z']:
+        equal(getattr(fused, name), getattr(unfused, name))
+
+
+def test_fused_stops_at_other_steps():
+    steps = [Step('abs'), Step('yderiv'), Step('offset', {'offset': 1.0}),
+             Step('negate', enabled=False), Step('negate')]
+
+    groups = Pipeline(steps).get_groups()
+
+    assert [[index for index, step in group] for group in groups] == \
+        [[0], [1], [2, 4]]
+
+
+def test_timings(caplog):
+    caplog.set_level(logging.DEBUG, logger='qtplot.pipeline')
+
+    steps = [Step('abs'), Step('negate'), Step('crop', {'left': 20})]
+    result, results = Pipeline(steps).apply(make_data())
+
+    timings = [timing for _, _, _, timing in results]
+    assert [timing['name'] for timing in timings] == ['abs', 'negate', 'crop']
+    assert [timing['fused'] for timing in timings] == [2, 2, 1]
+    assert timings[0]['time'] == timings[1]['time']
+
+    assert timings[0]['shape'] == [90, 120]
+    assert timings[2]['shape'] == [90, 100]
+    assert timings[2]['nbytes'] == result.nbytes
+
+    # Every timing is logged with the dict attached
+    records = [record for record in caplog.records
+               if hasattr(record, 'timing')]
+    assert [record.timing for record in records] == timings
+
+
+def test_cache_hits():
+    cache = CountingCache(max_items=16)
+    data = make_data()
+    data.key = ('test',)
+
+    pipeline = Pipeline([Step('yderiv'), Step('abs'), Step('norm y')], cache)
+
+    first, _ = pipeline.apply(data)
+    assert cache.puts == 3
+
+    second, _ = pipeline.apply(data)
+    assert cache.puts == 3
+    equal(first.z, second.z)
+
+    # Only the steps from the changed one on are applied again
+    pipeline.steps[2] = Step('norm y', {'method': 'z-score'})
+    pipeline.apply(data)
+    assert cache.puts == 4
+
+
+def test_cache_returns_copies():
+    cache = LRUCache(max_items=16)
+    pipeline = Pipeline([Step('offset', {'offset': 1.0})], cache)
+
+    data = make_data()
+    first, _ = pipeline.apply(data)
+    first.z[:] = 0
+
+    second, _ = pipeline.apply(data)
+    equal(second.z, z + 1.0)
+
+
+def test_key_of_unmodified_data():
+    data = make_data()
+    key = data.get_key()
+
+    assert make_data().get_key() == key
+
+    data.z = data.z + 1
+    assert data.get_key() != key
+
+
+def test_key_changes_with_column(tmp_path):
+    dat_file = write_dat(tmp_path / 'test.dat')
+
+    first = dat_file.get_data('gate', 'bias', 'current')
+    second = dat_file.get_data('gate', 'bias', 'current')
+    assert first.key == second.key
+
+    dat_file.set_column('current', dat_file.get_column('current') * 2)
+    third = dat_file.get_data('gate', 'bias', 'current')
+    assert third.key != first.key
+    equal(third.z, first.z * 2)
+
+
+def test_preview_key():
+    cache = LRUCache(max_items=16)
+    data = make_data()
+    pipeline = Pipeline([Step('abs')], cache)
+
+    preview, results = pipeline.preview(data, max_points=1000)
+    assert preview.z.size <= 1000
+    assert not results[0][3]['cached']
+
+    _, results = pipeline.preview(data, max_points=1000)
+    assert results[0][3]['cached']
+
+    # A different amount of points is a different preview
+    _, results = pipeline.preview(data, max_points=2000)
+    assert not results[0][3]['cached']
+
+
+def test_preview_keeps_rows():
+    data = make_data()
+
+    preview, _ = Pipeline([Step('even odd')]).preview(data, max_points=1000)
+    full, _ = Pipeline([Step('even odd')]).apply(data)
+
+    assert preview.z.shape[0] == full.z.shape[0]
+
+
+def test_cache_miss_after_column_change(tmp_path):
+    cache = CountingCache(max_items=16)
+    dat_file = write_dat(tmp_path / 'test.dat')
+    pipeline = Pipeline([Step('yderiv'), Step('abs')], cache)
+
+    first, _ = pipeline.apply(dat_file.get_data('gate', 'bias', 'current'))
+    assert cache.puts == 2
+
+    dat_file.set_column('current', dat_file.get_column('current') * 2)
+    second, _ = pipeline.apply(dat_file.get_data('gate', 'bias', 'current'))
+
+    assert cache.puts == 4
+    equal(second.z, first.z * 2)
+
+
+def test_hist2d_defaults():
+    step = Step('hist2d')
+    data = make_data()
+
+    # sqrt(90 rows) bins over the range of the data
+    params = step.resolve(data)
+    assert params['bins'] == 9
+    assert (params['min'], params['max']) == (z.min(), z.max())
+
+    result, _ = Pipeline([step]).apply(data)
+
+    assert result.z.shape == (9, 120)
+    equal(result.z.sum(axis=0), 90)
+
+    edges = np.linspace(z.min(), z.max(), 10)
+    npt.assert_allclose(result.y[:, 0], (edges[:-1] + edges[1:]) / 2)
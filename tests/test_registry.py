@@ -0,0 +1,92 @@
+import numpy as np
+import numpy.testing as npt
+
+from qtplot import registry
+from qtplot.data import Data2D
+from qtplot.pipeline import Pipeline, Step
+from qtplot.registry import Footprint, load_plugins, operations
+
+equal = npt.assert_array_equal
+
+x, y = np.meshgrid(np.linspace(0, 1, 20), np.linspace(-1, 2, 15))
+z = np.sin(7 * x) * np.cos(5 * y)
+
+plugin = '''
+import numpy as np
+from qtplot.registry import Footprint, register
+
+def clip(data, low=0.0, high=1.0):
+    data.z = np.clip(data.z, low, high)
+
+register('test clip', clip, [('low', 0.0), ('high', 1.0)],
+         elementwise=lambda z, p: np.clip(z, p['low'], p['high'], out=z),
+         footprint=Footprint())
+'''
+
+
+def make_data():
+    return Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+
+
+def test_builtin_operations():
+    for name in ['abs', 'yderiv', 'lowpass', 'crop', 'find peaks']:
+        assert name in operations
+
+    info = operations['offset']
+    assert info.is_elementwise(info.get_defaults())
+    assert not operations['yderiv'].is_elementwise({})
+
+
+def test_footprint_input():
+    footprint = Footprint(axis=0, halo=(2, 3), loss=(0, 1))
+
+    assert footprint.get_input(0, 10, 100) == (0, 14)
+    assert footprint.get_input(50, 60, 100) == (48, 64)
+    assert footprint.get_input(90, 100, 100) == (88, 100)
+    assert not footprint.is_pointwise
+    assert Footprint().is_pointwise
+
+
+def test_load_plugin(tmp_path):
+    (tmp_path / 'clip.py').write_text(plugin)
+    (tmp_path / 'broken.py').write_text('raise ImportError\n')
+
+    try:
+        load_plugins(str(tmp_path))
+        assert 'test clip' in operations
+
+        # The plugin is fused with the built-in elementwise operations
+        steps = [Step('offset', {'offset': 0.5}),
+                 Step('test clip', {'low': 0.0, 'high': 1.0})]
+        pipeline = Pipeline(steps)
+        assert len(pipeline.get_groups()) == 1
+
+        result, _ = pipeline.apply(make_data())
+        equal(result.z, np.clip(z + 0.5, 0.0, 1.0))
+
+        # Plugins are only loaded once
+        count = len(registry.plugins)
+        load_plugins(str(tmp_path))
+        assert len(registry.plugins) == count
+    finally:
+        operations.pop('test clip', None)
+
+
+def test_rescale():
+    params = operations['crop'].get_defaults()
+    params.update({'left': 10, 'right': -10, 'bottom': 4, 'top': -4})
+
+    operations['crop'].rescale(params, (2, 5))
+
+    assert (params['left'], params['right']) == (2, -2)
+    assert (params['bottom'], params['top']) == (2, -2)
+
+
+def test_rescale_find_peaks():
+    params = operations['find peaks'].get_defaults()
+    params.update({'window': 10, 'width': 4.0, 'distance': 6.0})
+
+    operations['find peaks'].rescale(params, (3, 2))
+
+    assert (params['window'], params['width'], params['distance']) == \
+        (5, 2.0, 3.0)
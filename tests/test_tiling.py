@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from qtplot.data import Data2D
+from qtplot.pipeline import Pipeline, Step
+from qtplot.tiling import apply_tiled, load_npy, to_memmap
+
+x, y = np.meshgrid(np.linspace(0, 1, 97), np.linspace(-1, 2, 113) ** 3)
+z = np.sin(7 * x) * np.cos(5 * y) + 0.1 * np.random.RandomState(0).rand(113, 97)
+
+cases = [
+    [Step('yderiv')],
+    [Step('yderiv', {'method': '2nd order central diff'})],
+    [Step('xderiv')],
+    [Step('gradmag')],
+    [Step('dderiv', {'theta': 0.3, 'method': '2nd order central diff'})],
+    [Step('lowpass', {'x_width': 2.0, 'y_height': 2.0})],
+    [Step('highpass')],
+    [Step('norm x', {'method': 'z-score'})],
+    [Step('norm y', {'method': 'percentile clip'})],
+    [Step('sub background', {'lines': 'columns', 'order': 2})],
+    [Step('sub background')],
+    [Step('abs'), Step('offset', {'offset': 1.0}), Step('log'),
+     Step('scale data', {'factor': 2.0})],
+    [Step('offset axes', {'x_offset': 0.5, 'y_offset': -1.0}),
+     Step('scale axes', {'x_scale': 2.0, 'y_scale': -3.0})],
+    [Step('yderiv'), Step('norm y'), Step('lowpass'),
+     Step('log', {'subtract': True}), Step('crop', {'left': 3})],
+]
+
+
+def make_data():
+    return Data2D(x.copy(), y.copy(), z.copy(), row_numbers=np.zeros_like(z))
+
+
+def assert_same(a, b):
+    for name in ['x', 'y', 'z']:
+        A = np.ma.filled(getattr(a, name), np.nan)
+        B = np.asarray(getattr(b, name))
+
+        assert A.shape == B.shape
+        npt.assert_allclose(A, B, rtol=0, atol=1e-12)
+
+    npt.assert_allclose(a.x_means, b.x_means)
+    npt.assert_allclose(a.y_means, b.y_means)
+
+
+@pytest.mark.parametrize('steps', cases,
+                         ids=lambda steps: '-'.join(s.name for s in steps))
+def test_tiled_equals_in_memory(tmp_path, steps):
+    pipeline = Pipeline(steps)
+    data = make_data()
+
+    expected, _ = pipeline.apply(data)
+
+    directory = str(tmp_path)
+    result, results = apply_tiled(pipeline, to_memmap(data, directory),
+                                  directory, band_bytes=40000)
+
+    assert isinstance(result.z, np.memmap)
+    assert len(results) == len(steps)
+    assert_same(expected, result)
+
+
+def test_intermediate_files_removed(tmp_path):
+    pipeline = Pipeline([Step('norm y'), Step('yderiv'), Step('norm y')])
+
+    directory = str(tmp_path)
+    data = to_memmap(make_data(), directory)
+    result, _ = apply_tiled(pipeline, data, directory, band_bytes=40000)
+
+    files = set(os.listdir(directory))
+    assert files == set(['data_x.npy', 'data_y.npy', 'data_z.npy',
+                         'step2_x.npy', 'step2_y.npy', 'step2_z.npy',
+                         'data_row_numbers.npy'])
+
+    # Bands of columns are written to column-major files
+    assert result.z.flags.f_contiguous
+
+
+def test_load_npy(tmp_path):
+    data = make_data()
+    filename = str(tmp_path / 'data.npy')
+    data.save(filename)
+
+    loaded = load_npy(filename)
+    assert isinstance(loaded.z, np.memmap)
+
+    pipeline = Pipeline([Step('xderiv'), Step('norm y'), Step('abs')])
+
+    expected, _ = pipeline.apply(data)
+    tiles = tmp_path / 'tiles'
+    tiles.mkdir()
+    result, _ = apply_tiled(pipeline, loaded, str(tiles), band_bytes=40000)
+
+    assert_same(expected, result)
+    assert os.path.exists(filename)
+
+
+def test_save_in_bands(tmp_path):
+    directory = str(tmp_path)
+    data = make_data()
+    data.z = np.ma.masked_invalid(np.where(data.z > 0.5, np.nan, data.z))
+
+    data.save(os.path.join(directory, 'memory.npy'))
+    to_memmap(data, directory).save(os.path.join(directory, 'memmap.npy'))
+
+    expected = np.dstack((x, y, np.ma.getdata(data.z)))
+
+    for name in ['memory.npy', 'memmap.npy']:
+        npt.assert_array_equal(np.load(os.path.join(directory, name)),
+                               expected)
+
+
+def test_whole_matrix(tmp_path, caplog):
+    # Equalizing needs the histogram of all the data
+    pipeline = Pipeline([Step('abs'), Step('equalize')])
+    data = make_data()
+
+    expected, _ = pipeline.apply(data)
+
+    directory = str(tmp_path)
+    result, _ = apply_tiled(pipeline, to_memmap(data, directory), directory,
+                            band_bytes=40000)
+
+    assert 'equalize can not be applied in bands' in caplog.text
+    assert_same(expected, result)